@@ -0,0 +1,84 @@
+"""
+Compara perfiles de memoria (AUREA_PROFILE_ALLOC) entre dos releases: pico
+total y por fase, y los sitios de asignación que más crecieron.
+
+    python alloc_diff.py viejo.json nuevo.json
+    python alloc_diff.py debug_specs/alloc_v1 debug_specs/alloc_v2   # carpetas: pico máximo por plantilla
+
+Sale con código 1 si algún pico crece más que --threshold.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+# diferencias por debajo de esto son ruido
+NOISE_FLOOR_MB = 1.0
+
+
+def _load(path: str) -> dict:
+    """plantilla => perfil (en carpetas, el de mayor pico por plantilla)."""
+    files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+    profiles = {}
+    for fname in files:
+        with open(fname, encoding="utf-8") as fh:
+            p = json.load(fh)
+        if p.get("status") != "ok":
+            continue
+        best = profiles.get(p["template"])
+        if best is None or p["peak_mb"] > best["peak_mb"]:
+            profiles[p["template"]] = p
+    return profiles
+
+
+def _delta(old: float, new: float, threshold: float) -> tuple:
+    regressed = new - old > NOISE_FLOOR_MB and new > old * (1 + threshold)
+    pct = f"{(new / old - 1) * 100:+.0f}%" if old else "nuevo"
+    return f"{old:9.2f} -> {new:9.2f} MB ({pct})", regressed
+
+
+def compare(old: dict, new: dict, threshold: float, top: int) -> int:
+    regressions = 0
+    for template in sorted(set(old) & set(new)):
+        a, b = old[template], new[template]
+        print(f"{template}: {a.get('release')} -> {b.get('release')}")
+        line, bad = _delta(a["peak_mb"], b["peak_mb"], threshold)
+        print(f"  {'pico':12s} {line}{'  REGRESIÓN' if bad else ''}")
+        regressions += bad
+        for name in sorted(set(a["phases"]) | set(b["phases"])):
+            pa = a["phases"].get(name, {}).get("peak_mb", 0.0)
+            pb = b["phases"].get(name, {}).get("peak_mb", 0.0)
+            line, bad = _delta(pa, pb, threshold)
+            print(f"  {name:12s} {line}{'  REGRESIÓN' if bad else ''}")
+            regressions += bad
+
+        sites_a = {s["site"]: s["size_kb"] for s in a.get("top", [])}
+        sites_b = {s["site"]: s["size_kb"] for s in b.get("top", [])}
+        growth = sorted(
+            ((sites_b.get(k, 0.0) - sites_a.get(k, 0.0), k) for k in set(sites_a) | set(sites_b)),
+            reverse=True,
+        )
+        print("  sitios (KB, viejo -> nuevo):")
+        for diff, site in growth[:top]:
+            print(f"    {diff:+10.1f}  {site}  ({sites_a.get(site, 0.0)} -> {sites_b.get(site, 0.0)})")
+    for template in sorted(set(old) ^ set(new)):
+        print(f"{template}: solo en {'viejo' if template in old else 'nuevo'}")
+    return regressions
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("old")
+    ap.add_argument("new")
+    ap.add_argument("--threshold", type=float, default=0.25, help="crecimiento permitido del pico (0.25 = +25%%)")
+    ap.add_argument("--top", type=int, default=10, help="sitios de asignación a listar")
+    args = ap.parse_args()
+
+    regressions = compare(_load(args.old), _load(args.new), args.threshold, args.top)
+    print(f"{regressions} regresiones (umbral +{args.threshold * 100:.0f}%)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
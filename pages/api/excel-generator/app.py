@@ -1,18 +1,49 @@
 import os
+import posixpath
 import re
+import contextvars
+import csv
 import json
-from io import BytesIO
+import queue
+import random
+import shutil
+import sys
+import time
+import uuid
+import importlib
+import hashlib
+import heapq
+import threading
+import tracemalloc
+import warnings
+import zipfile
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from copy import copy
+from itertools import chain, islice
+from io import BytesIO, TextIOWrapper
+from tempfile import SpooledTemporaryFile
 from datetime import datetime
+from html import unescape as html_unescape
 
-from flask import Flask, request, send_file, jsonify, make_response
+from flask import Flask, Response, request, send_file, jsonify, make_response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import ClosingIterator
 
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import Cell, ERROR_CODES, ILLEGAL_CHARACTERS_RE, MergedCell
+from openpyxl.compat import NUMERIC_TYPES, safe_string
+from openpyxl.utils.datetime import to_excel
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from openpyxl.utils import get_column_letter
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.utils import get_column_letter, column_index_from_string, quote_sheetname
 from openpyxl.worksheet.table import Table, TableStyleInfo, TableColumn
 from openpyxl.worksheet.datavalidation import DataValidation
-from openpyxl.chart import PieChart, BarChart, Reference
+from openpyxl.chart import PieChart, BarChart, LineChart, Reference
 from openpyxl.formatting.rule import FormulaRule
+from openpyxl.worksheet.formula import ArrayFormula
+from openpyxl.writer.excel import ExcelWriter
 
 
 # ============================================================
@@ -25,13 +56,23 @@ app = Flask(__name__)
 # ------------------------------------------------------------
 def _cors(resp):
     resp.headers["Access-Control-Allow-Origin"] = "*"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match"
+    resp.headers["Access-Control-Expose-Headers"] = (
+        "ETag, Content-Disposition, Server-Timing, X-AUREA-Cache, X-AUREA-Rows, X-AUREA-Row-Errors, "
+        "X-AUREA-Row-Error-Detail"
+    )
     resp.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS, GET"
     resp.headers["Cache-Control"] = "no-store"
     resp.headers["X-AUREA"] = "excel"
     return resp
 
 
+def xml_escape(text: str) -> str:
+    # igual que xml.sax.saxutils.escape sin entidades extra (saxutils arrastra
+    # urllib.request al importar => más arranque en frío)
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
 def _safe_filename(name: str) -> str:
     name = (name or "AUREA_excel.xlsx").strip()
     name = re.sub(r"[^\w.\- ]+", "_", name)
@@ -60,19 +101,53 @@ def _to_dict(x):
     return {"value": x}
 
 
-def _as_number(v):
+# Montos como texto: "MXN 1,234.50", "$ 1.234,50", "(350.00)", "12,5", "1 200"
+# camino rápido: el formato común (punto decimal, comas de miles, MXN/$ opcionales)
+_AMOUNT_RE = re.compile(r"\s*(?:MXN)?\s*(-?)\s*\$?\s*(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d*))?\s*(?:MXN)?\s*", re.IGNORECASE)
+_NUMBER_NOISE_RE = re.compile(r"MXN|[$\s]", re.IGNORECASE)
+_NUMBER_THOUSANDS_RE = re.compile(r"[+-]?\d{1,3}(?:,\d{3})+(?:\.\d*)?")
+_NUMBER_RE = re.compile(r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+
+
+def _number_from_str(s: str):
+    """float del texto o None. Con "," y "." el último separador es el decimal."""
+    m = _AMOUNT_RE.fullmatch(s)
+    if m:
+        sign, whole, frac = m.groups()
+        n = float(f"{whole.replace(',', '')}.{frac or 0}")
+        return -n if sign else n
+    s = _NUMBER_NOISE_RE.sub("", s)
+    if not s:
+        return 0.0
+    neg = s[0] == "(" and s[-1] == ")"
+    if neg:
+        s = s[1:-1]
+    if "," in s:
+        if "." in s:
+            s = s.replace(".", "").replace(",", ".") if s.rfind(",") > s.rfind(".") else s.replace(",", "")
+        elif _NUMBER_THOUSANDS_RE.fullmatch(s):
+            s = s.replace(",", "")
+        else:
+            s = s.replace(",", ".")
+    elif s.count(".") > 1:
+        s = s.replace(".", "")
+    if not _NUMBER_RE.fullmatch(s):
+        return None
+    return -float(s) if neg else float(s)
+
+
+def _parse_number(v):
+    """Como _as_number pero regresa None si el valor no es numérico (vacío => 0.0)."""
     if v is None:
         return 0.0
     if isinstance(v, (int, float)):
         return float(v)
-    s = str(v).strip()
-    if not s:
-        return 0.0
-    s = s.replace("MXN", "").replace("$", "").replace(",", "").strip()
-    try:
-        return float(s)
-    except Exception:
-        return 0.0
+    return _number_from_str(str(v))
+
+
+def _as_number(v):
+    n = _parse_number(v)
+    return 0.0 if n is None else n
 
 
 def _looks_like_services_template(text: str) -> bool:
@@ -88,6 +163,437 @@ def _now_str():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+# ------------------------------------------------------------
+# Métricas: tiempos por fase del build (header Server-Timing) y registro
+# en formato Prometheus para /metrics. Sin dependencias: histogramas y
+# contadores en memoria del proceso (con varios workers, uno por worker).
+# AUREA_METRICS=0 => phase() regresa un context manager vacío y compartido.
+# ------------------------------------------------------------
+METRICS_ENABLED = os.getenv("AUREA_METRICS", "1") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (10e3, 50e3, 100e3, 500e3, 1e6, 5e6, 10e6, 50e6, 100e6)
+
+
+def _prom_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    __slots__ = ("name", "help", "labels", "series", "lock")
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for values, v in sorted(self.series.items()):
+                lines.append(f"{self.name}{_prom_labels(self.labels, values)} {v:g}")
+        return lines
+
+
+class Counter(_Metric):
+    __slots__ = ()
+    kind = "counter"
+
+    def inc(self, *values, amount: float = 1):
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = "gauge"
+
+    def dec(self, *values):
+        self.inc(*values, amount=-1)
+
+
+class Histogram(_Metric):
+    __slots__ = ("buckets",)
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *values, value: float):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(values)
+            if s is None:
+                s = self.series[values] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self.lock:
+            for values, (counts, total, n) in sorted(self.series.items()):
+                acc = 0
+                for le, c in zip(self.buckets, counts):
+                    acc += c
+                    lines.append(f"{self.name}_bucket{_prom_labels(names, values + (f'{le:g}',))} {acc}")
+                lines.append(f"{self.name}_bucket{_prom_labels(names, values + ('+Inf',))} {n}")
+                lines.append(f"{self.name}_sum{_prom_labels(self.labels, values)} {total:g}")
+                lines.append(f"{self.name}_count{_prom_labels(self.labels, values)} {n}")
+        return lines
+
+
+METRIC_REQUEST_SECONDS = Histogram(
+    "aurea_excel_request_seconds", "Latencia de /api/excel/generate por plantilla.", ("template",))
+METRIC_PHASE_SECONDS = Histogram(
+    "aurea_excel_phase_seconds", "Tiempo por fase del build por plantilla.", ("template", "phase"))
+METRIC_OUTPUT_BYTES = Histogram(
+    "aurea_excel_output_bytes", "Tamaño del xlsx generado por plantilla.", ("template",), SIZE_BUCKETS)
+METRIC_REQUESTS = Counter(
+    "aurea_excel_requests_total", "Requests de /api/excel/generate por plantilla y cache.", ("template", "cache"))
+METRIC_ERRORS = Counter(
+    "aurea_excel_errors_total", "Builds fallidos por ruta y tipo de error.", ("route", "error"))
+METRIC_IN_FLIGHT = Gauge(
+    "aurea_excel_in_flight", "Builds de /api/excel/generate en curso.")
+METRICS = (METRIC_REQUEST_SECONDS, METRIC_PHASE_SECONDS, METRIC_OUTPUT_BYTES,
+           METRIC_REQUESTS, METRIC_ERRORS, METRIC_IN_FLIGHT)
+
+
+class PhaseTimer:
+    """
+    Tiempos exclusivos por fase de un build: una fase anidada descuenta su
+    tiempo de la fase que la contiene => las fases suman el total.
+    """
+
+    __slots__ = ("template", "totals", "profile", "_stack", "_start")
+
+    def __init__(self, profile=None):
+        self.template = "unknown"
+        self.totals = {}
+        self.profile = profile  # AllocProfile si el request se perfila (ver AUREA_PROFILE_ALLOC)
+        self._stack = []
+        self._start = time.perf_counter()
+
+    def __call__(self, name: str):
+        return _PhaseScope(self, name)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def server_timing(self) -> str:
+        parts = [f"{name};dur={secs * 1000:.1f}" for name, secs in self.totals.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def observe(self):
+        for name, secs in self.totals.items():
+            METRIC_PHASE_SECONDS.observe(self.template, name, value=secs)
+
+
+class _PhaseScope:
+    __slots__ = ("timer", "name", "start", "child", "peak")
+
+    def __init__(self, timer: PhaseTimer, name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.child = 0.0
+        stack = self.timer._stack
+        if self.timer.profile is not None:
+            self.timer.profile.enter(self, stack)
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = self.timer._stack
+        stack.pop()
+        totals = self.timer.totals
+        totals[self.name] = totals.get(self.name, 0.0) + elapsed - self.child
+        if stack:
+            stack[-1].child += elapsed
+        if self.timer.profile is not None:
+            self.timer.profile.exit(self, stack)
+        return False
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+_PHASE_TIMER = contextvars.ContextVar("aurea_phase_timer", default=None)
+
+
+def phase(name: str):
+    """with phase("rows"): ... => suma al PhaseTimer del request actual (si hay)."""
+    timer = _PHASE_TIMER.get()
+    return _NO_PHASE if timer is None else timer(name)
+
+
+def start_phase_timer():
+    """
+    PhaseTimer activo para el contexto actual; None si las métricas están
+    apagadas y el request no quedó en la muestra de perfilado de memoria.
+    """
+    profile = AllocProfile.sample()
+    if not METRICS_ENABLED and profile is None:
+        return None
+    timer = PhaseTimer(profile)
+    _PHASE_TIMER.set(timer)
+    return timer
+
+
+def count_error(route: str, error: BaseException):
+    if METRICS_ENABLED:
+        METRIC_ERRORS.inc(route, type(error).__name__)
+
+
+def observe_request(timer, cache: str, size):
+    """Cierra las métricas de un request de /api/excel/generate."""
+    if timer is None or not METRICS_ENABLED:
+        return
+    METRIC_REQUESTS.inc(timer.template, cache)
+    METRIC_REQUEST_SECONDS.observe(timer.template, value=timer.elapsed())
+    if size is not None:
+        METRIC_OUTPUT_BYTES.observe(timer.template, value=size)
+    timer.observe()
+
+
+def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ------------------------------------------------------------
+# Perfilado de memoria (opt-in): tracemalloc alrededor del build con pico
+# por fase (inclusivo: una fase incluye a sus anidadas) y los N sitios de
+# asignación con más memoria viva. tracemalloc es global del proceso (con
+# gthread cuenta lo que asignen todos los hilos) => solo se perfila un
+# request que corre solo: si hay otros en curso no se perfila, y si otro
+# entra mientras se perfila el reporte se descarta (skipped_shared).
+#   AUREA_PROFILE_ALLOC=1      todos los requests; 0.05 => 5% muestreado
+#   AUREA_PROFILE_DIR          JSON por build (default debug_specs/alloc; "" => no se escribe)
+#   AUREA_PROFILE_ENDPOINT=1   GET /debug/alloc con los últimos perfiles
+# ------------------------------------------------------------
+def _profile_rate(value: str) -> float:
+    try:
+        return min(max(float(value or 0), 0.0), 1.0)
+    except ValueError:
+        return 0.0
+
+
+PROFILE_ALLOC_RATE = _profile_rate(os.getenv("AUREA_PROFILE_ALLOC", "0"))
+PROFILE_TOP_N = max(1, int(os.getenv("AUREA_PROFILE_TOP_N", "15")))
+PROFILE_DIR = os.getenv("AUREA_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "debug_specs", "alloc"))
+PROFILE_ENDPOINT = os.getenv("AUREA_PROFILE_ENDPOINT", "0") == "1"
+PROFILE_RELEASE = os.getenv("AUREA_RELEASE", "dev")
+PROFILE_STATS = {"profiled": 0, "skipped_busy": 0, "skipped_shared": 0}
+_PROFILES = deque(maxlen=max(1, int(os.getenv("AUREA_PROFILE_KEEP", "20"))))
+_PROFILE_LOCK = threading.Lock()
+# requests en curso (todo el WSGI, cuerpos en streaming incluidos) y el perfil activo
+_PROFILE_STATS_LOCK = threading.Lock()
+_PROFILE_STATE = {"requests": 0, "active": None}
+_MB = 1024 * 1024
+
+
+def _profile_count(key: str):
+    with _PROFILE_STATS_LOCK:
+        PROFILE_STATS[key] += 1
+
+
+class _InFlightRequests:
+    """Middleware WSGI: cuenta requests en curso hasta que el servidor cierra el cuerpo."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        with _PROFILE_STATS_LOCK:
+            _PROFILE_STATE["requests"] += 1
+            if _PROFILE_STATE["active"] is not None:
+                _PROFILE_STATE["active"].shared = True
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.done()
+            raise
+        return ClosingIterator(body, self.done)
+
+    @staticmethod
+    def done():
+        with _PROFILE_STATS_LOCK:
+            _PROFILE_STATE["requests"] -= 1
+
+
+class AllocProfile:
+    __slots__ = ("peaks", "outer", "top", "top_phase", "top_current", "owns_tracing", "shared")
+
+    def __init__(self):
+        self.peaks = {}
+        self.outer = 0
+        self.top = None
+        self.top_phase = None
+        self.top_current = -1
+        self.shared = False
+        self.owns_tracing = not tracemalloc.is_tracing()
+        if self.owns_tracing:
+            tracemalloc.start()
+        else:
+            tracemalloc.clear_traces()
+        tracemalloc.reset_peak()
+
+    @classmethod
+    def sample(cls):
+        """AllocProfile si este request se perfila; None en otro caso."""
+        if PROFILE_ALLOC_RATE <= 0 or (PROFILE_ALLOC_RATE < 1 and random.random() >= PROFILE_ALLOC_RATE):
+            return None
+        if not _PROFILE_LOCK.acquire(blocking=False):
+            _profile_count("skipped_busy")
+            return None
+        with _PROFILE_STATS_LOCK:
+            # este request ya está contado: cualquier otro ensuciaría el tracemalloc
+            busy = _PROFILE_STATE["requests"] > 1
+            if busy:
+                PROFILE_STATS["skipped_busy"] += 1
+        if busy:
+            _PROFILE_LOCK.release()
+            return None
+        try:
+            profile = cls()
+        except Exception:
+            _PROFILE_LOCK.release()
+            raise
+        with _PROFILE_STATS_LOCK:
+            _PROFILE_STATE["active"] = profile
+        return profile
+
+    def _credit(self, stack, peak: int):
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        else:
+            self.outer = max(self.outer, peak)
+
+    def enter(self, scope, stack):
+        # el pico acumulado hasta aquí es de la fase que contiene a esta
+        current, peak = tracemalloc.get_traced_memory()
+        self._credit(stack, peak)
+        tracemalloc.reset_peak()
+        scope.peak = current
+
+    def exit(self, scope, stack):
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(scope.peak, peak)
+        self.peaks[scope.name] = max(self.peaks.get(scope.name, 0), peak)
+        self._credit(stack, peak)
+        tracemalloc.reset_peak()
+        if current > self.top_current:
+            # sitios de asignación en el momento con más memoria viva al cerrar una fase
+            self.top_current = current
+            self.top_phase = scope.name
+            self.top = tracemalloc.take_snapshot()
+
+    def finish(self, timer, status: str):
+        """Reporte del build; None si otro request corrió mientras se perfilaba."""
+        with _PROFILE_STATS_LOCK:
+            _PROFILE_STATE["active"] = None
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self.outer, peak, *self.peaks.values())
+            if current > self.top_current:
+                self.top_phase, self.top = "end", tracemalloc.take_snapshot()
+            report = {
+                "release": PROFILE_RELEASE,
+                "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "python": sys.version.split()[0],
+                "template": timer.template,
+                "status": status,
+                "elapsed_s": round(timer.elapsed(), 4),
+                "peak_mb": round(peak / _MB, 3),
+                "phases": {
+                    name: {"peak_mb": round(self.peaks.get(name, 0) / _MB, 3), "seconds": round(secs, 4)}
+                    for name, secs in timer.totals.items()
+                },
+                "top_phase": self.top_phase,
+                "top": _alloc_sites(self.top),
+            }
+        finally:
+            self.top = None
+            if self.owns_tracing:
+                tracemalloc.stop()
+            _PROFILE_LOCK.release()
+        if self.shared:
+            _profile_count("skipped_shared")
+            return None
+        _profile_count("profiled")
+        _PROFILES.append(report)
+        _dump_profile(report)
+        return report
+
+
+def _alloc_site(frame) -> str:
+    # las 2 últimas partes de la ruta => comparables entre máquinas y releases
+    parts = frame.filename.replace("\\", "/").split("/")
+    return f"{'/'.join(parts[-2:])}:{frame.lineno}"
+
+
+def _alloc_sites(snapshot) -> list:
+    if snapshot is None:
+        return []
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+    return [
+        {"site": _alloc_site(stat.traceback[0]), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]
+    ]
+
+
+def _dump_profile(report: dict):
+    if not PROFILE_DIR:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"alloc_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{report['template']}_{uuid.uuid4().hex[:6]}.json"
+        with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2, ensure_ascii=False)
+    except OSError:
+        pass
+
+
+if PROFILE_ALLOC_RATE > 0:
+    app.wsgi_app = _InFlightRequests(app.wsgi_app)
+
+
+def finish_profile(timer, status: str = "ok"):
+    if timer is not None and timer.profile is not None:
+        profile, timer.profile = timer.profile, None
+        profile.finish(timer, status)
+
+
 # ------------------------------------------------------------
 # Styling helpers
 # ------------------------------------------------------------
@@ -95,24 +601,113 @@ NAVY = "0B1220"
 NAVY_2 = "111B2E"
 GOLD = "D6B25E"
 WHITE = "FFFFFF"
+ALERT_RED = "7A1E1E"
 
 thin = Side(style="thin", color="263043")
 border_thin = Border(left=thin, right=thin, top=thin, bottom=thin)
 
 money_fmt = '"MXN" #,##0.00'
 
+fill_navy = PatternFill("solid", fgColor=NAVY)
+fill_navy_2 = PatternFill("solid", fgColor=NAVY_2)
+fill_alert = PatternFill("solid", fgColor=ALERT_RED)
+
+font_white = Font(color=WHITE)
+font_white_bold = Font(bold=True, color=WHITE)
+font_bold = Font(bold=True)
+
+align_left = Alignment(horizontal="left", vertical="center")
+align_center = Alignment(horizontal="center", vertical="center")
+
+
+class CellStyle:
+    """
+    Estilo de celda inmutable del registro. Los objetos Font/Fill/Border/Alignment
+    se crean una sola vez por proceso y se comparten entre todos los workbooks.
+    """
+    __slots__ = ("font", "fill", "border", "alignment", "number_format")
+
+    def __init__(self, font=None, fill=None, border=None, alignment=None, number_format=None):
+        self.font = font
+        self.fill = fill
+        self.border = border
+        self.alignment = alignment
+        self.number_format = number_format
+
+    def with_format(self, number_format):
+        return CellStyle(self.font, self.fill, self.border, self.alignment, number_format)
+
+
+_kpi = CellStyle(font=font_white_bold, fill=fill_navy, border=border_thin, alignment=align_left)
+_header = CellStyle(font=font_white_bold, fill=fill_navy_2, border=border_thin, alignment=align_center)
+_data = CellStyle(border=border_thin, alignment=align_left)
+_category = CellStyle(font=font_white_bold, fill=fill_navy, border=border_thin)
+
+STYLES = {
+    "title": CellStyle(font=Font(bold=True, size=14, color=GOLD), alignment=align_left),
+    "header": _header,
+    "header_money": _header.with_format(money_fmt),
+    "section": CellStyle(font=font_white_bold, fill=fill_navy_2, alignment=align_center),
+    "banner": CellStyle(font=font_white_bold, fill=fill_navy),
+    "meta_label": CellStyle(font=font_white_bold, fill=fill_navy, alignment=align_left),
+    "meta_value": CellStyle(font=font_white, fill=fill_navy, alignment=align_left),
+    "data": _data,
+    "data_money": _data.with_format(money_fmt),
+    "kpi": _kpi,
+    "kpi_money": _kpi.with_format(money_fmt),
+    "alert_label": _kpi,
+    "alert_value": CellStyle(font=font_white, fill=fill_navy, border=border_thin, alignment=align_center),
+    "alert_flag": CellStyle(font=font_white_bold, fill=fill_navy, border=border_thin, alignment=align_center),
+    "category": _category,
+    "category_money": _category.with_format(money_fmt),
+    "top_text": CellStyle(font=font_white, fill=fill_navy, border=border_thin, alignment=align_left),
+    "bold": CellStyle(font=font_bold),
+    "bold_money": CellStyle(font=font_bold, number_format=money_fmt),
+    "boxed": CellStyle(border=border_thin),
+    "boxed_money": CellStyle(border=border_thin, number_format=money_fmt),
+}
+
+# formatos por tipo de columna del spec v1.1 (currency => *_money)
+SPEC_FORMATS = {"date": "yyyy-mm-dd", "percent": "0.00%", "integer": "0", "number": "#,##0.00"}
+for _t, _fmt in SPEC_FORMATS.items():
+    STYLES[f"data_{_t}"] = _data.with_format(_fmt)
+    STYLES[f"kpi_{_t}"] = _kpi.with_format(_fmt)
+    STYLES[f"header_{_t}"] = _header.with_format(_fmt)
+
+
+def apply_style(cell, name: str):
+    """
+    Aplica un estilo del registro por referencia.
+    La primera vez por workbook registra fuente/relleno/borde/alineación
+    (hash + dedup de openpyxl); después solo copia el StyleArray ya resuelto.
+    """
+    bound = cell.parent.parent.__dict__.setdefault("_aurea_styles", {})
+    arr = bound.get(name)
+    if arr is not None:
+        cell._style = copy(arr)
+        return
+
+    st = STYLES[name]
+    cell._style = StyleArray()
+    if st.font is not None:
+        cell.font = st.font
+    if st.fill is not None:
+        cell.fill = st.fill
+    if st.border is not None:
+        cell.border = st.border
+    if st.alignment is not None:
+        cell.alignment = st.alignment
+    if st.number_format is not None:
+        cell.number_format = st.number_format
+    bound[name] = copy(cell._style)
+
+
 def style_title(cell):
-    cell.font = Font(bold=True, size=14, color=GOLD)
-    cell.alignment = Alignment(horizontal="left", vertical="center")
+    apply_style(cell, "title")
 
 def style_header_row(ws, row, start_col, end_col):
-    fill = PatternFill("solid", fgColor=NAVY_2)
     for c in range(start_col, end_col + 1):
-        cell = ws.cell(row=row, column=c)
-        cell.fill = fill
-        cell.font = Font(bold=True, color=WHITE)
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-        cell.border = border_thin
+        apply_style(ws.cell(row=row, column=c), "header")
 
 def set_col_widths(ws, widths: dict):
     for col_letter, w in widths.items():
@@ -122,439 +717,3760 @@ def set_col_widths(ws, widths: dict):
 # ============================================================
 # Excel builder (ledger + dashboard + charts + alerts)
 # ============================================================
-def build_excel(payload: dict) -> BytesIO:
-    payload = _to_dict(payload)
+TEMPLATE_LEDGER = "ledger"
+TEMPLATE_SERVICES = "services"
+TEMPLATE_SPEC = "spec"
 
-    prompt = str(payload.get("prompt") or payload.get("text") or "")
-    file_name = _safe_filename(payload.get("fileName") or payload.get("filename") or "AUREA_excel.xlsx")
 
-    rows = payload.get("rows")
-    rows = rows if isinstance(rows, list) else []
+def _text(v):
+    # openpyxl rechaza caracteres de control en strings => se limpian antes
+    return ILLEGAL_CHARACTERS_RE.sub("", v) if isinstance(v, str) else v
 
-    use_services_template = _looks_like_services_template(prompt)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "AUREA"
-    dash = wb.create_sheet("Dashboard")
+# Fechas como texto: ISO (con hora opcional), dd/mm/aaaa y aaaa/mm/dd
+_DATE_ISO_RE = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})(?:[T ](\d{1,2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?Z?)?")
+_DATE_DMY_RE = re.compile(r"(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})")
 
-    # hoja listas oculta (validaciones pro)
-    lists = wb.create_sheet("_lists")
-    lists.sheet_state = "hidden"
 
-    # look
-    ws.sheet_view.showGridLines = True
-    dash.sheet_view.showGridLines = True
+def _parse_date(s: str):
+    """datetime del texto o None (fechas imposibles como 2024-02-30 también => None)."""
+    s = s.strip()
+    m = _DATE_ISO_RE.fullmatch(s)
+    try:
+        if m:
+            return datetime(*(int(g or 0) for g in m.groups()))
+        m = _DATE_DMY_RE.fullmatch(s)
+        if m:
+            return datetime(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+    except ValueError:
+        pass
+    return None
 
-    # Freeze panes
-    ws.freeze_panes = "A4"
-    dash.freeze_panes = "A4"
 
-    # Header
-    ws["A1"] = "AUREA 33 • AUREA"
-    style_title(ws["A1"])
-    ws.merge_cells("A1:F1")
+# ============================================================
+# Normalización de rows por columnas: el mapeo de alias se resuelve una vez
+# por bloque (unión de llaves vistas) y cada columna se convierte completa,
+# con memo por valor (los estados de cuenta repiten fechas, categorías, montos).
+# ============================================================
+LEDGER_ALIASES = (
+    ("Fecha", "fecha"),
+    ("Concepto", "concepto"),
+    ("Categoría", "categoria", "category"),
+    ("Forma de pago", "pago", "payment"),
+    ("Ingreso", "ingreso"),
+    ("Egreso", "egreso"),
+)
+LEDGER_CHUNK_ROWS = 8192
 
-    ws["A2"] = "Generado:"
-    ws["B2"] = _now_str()
-    ws["A2"].font = Font(bold=True, color=WHITE)
-    ws["B2"].font = Font(color=WHITE)
-    ws["A2"].fill = PatternFill("solid", fgColor=NAVY)
-    ws["B2"].fill = PatternFill("solid", fgColor=NAVY)
-    ws["A2"].alignment = Alignment(horizontal="left", vertical="center")
-    ws["B2"].alignment = Alignment(horizontal="left", vertical="center")
 
-    # ============================================================
-    # TEMPLATE 1: Ledger contable PRO
-    # ============================================================
-    if not use_services_template:
-        headers = ["Fecha", "Concepto", "Categoría", "Forma de pago", "Ingreso", "Egreso"]
-        header_row = 3
-        for i, h in enumerate(headers, start=1):
-            ws.cell(row=header_row, column=i, value=h)
-        style_header_row(ws, header_row, 1, 6)
+def ledger_key_map(keys) -> tuple:
+    """Por columna del ledger, los alias presentes en keys en orden de prioridad."""
+    return tuple(tuple(k for k in aliases if k in keys) for aliases in LEDGER_ALIASES)
 
-        # rango data
-        data_first = header_row + 1
-        data_rows = 5000
-        data_last = data_first + data_rows - 1
-        total_row = data_last + 1  # fila de totales dentro de la tabla
 
-        # columnas
-        set_col_widths(ws, {
-            "A": 14, "B": 24, "C": 16, "D": 18, "E": 14, "F": 14
-        })
+def _pick_column(items: list, keys: tuple) -> list:
+    # mismo criterio que item.get(a) or item.get(b) or ...
+    if not keys:
+        return [None] * len(items)
+    values = [d.get(keys[0]) for d in items]
+    for k in keys[1:]:
+        values = [v or d.get(k) for v, d in zip(values, items)]
+    return values
 
-        # -------------------------
-        # Listas para validación
-        # -------------------------
-        payments = ["Efectivo", "Transferencia", "Depósito", "Tarjeta Débito", "Tarjeta Crédito"]
-        categorias_default = ["Alimentos", "Servicios", "Transporte", "Salud", "Hogar", "Negocio", "Educación", "Ocio", "Otros"]
-
-        lists["A1"] = "Pagos"
-        lists["B1"] = "Categorias"
-        lists["A1"].font = Font(bold=True)
-        lists["B1"].font = Font(bold=True)
-
-        for i, p in enumerate(payments, start=2):
-            lists[f"A{i}"] = p
-        for i, c in enumerate(categorias_default, start=2):
-            lists[f"B{i}"] = c
-
-        pay_range = f"_lists!$A$2:$A${len(payments)+1}"
-        cat_range = f"_lists!$B$2:$B${len(categorias_default)+1}"
-
-        # Validación pagos (col D)
-        dv_pay = DataValidation(type="list", formula1=f"={pay_range}", allow_blank=True)
-        dv_pay.prompt = "Selecciona forma de pago"
-        dv_pay.error = "Elige un valor del listado."
-        ws.add_data_validation(dv_pay)
-        dv_pay.add(f"D{data_first}:D{data_last}")
-
-        # Validación categorías (col C)
-        dv_cat = DataValidation(type="list", formula1=f"={cat_range}", allow_blank=True)
-        dv_cat.prompt = "Selecciona categoría"
-        dv_cat.error = "Elige una categoría del listado."
-        ws.add_data_validation(dv_cat)
-        dv_cat.add(f"C{data_first}:C{data_last}")
 
-        # -------------------------
-        # Formatos / bordes base
-        # -------------------------
-        for r in range(data_first, data_last + 1):
-            for c in range(1, 7):
-                cell = ws.cell(row=r, column=c)
-                cell.border = border_thin
-                cell.alignment = Alignment(horizontal="left", vertical="center")
-            ws.cell(row=r, column=5).number_format = money_fmt
-            ws.cell(row=r, column=6).number_format = money_fmt
+def _text_column(values: list) -> list:
+    # una sola búsqueda sobre la columna completa; casi nunca hay que limpiar
+    if not ILLEGAL_CHARACTERS_RE.search("".join([v for v in values if v.__class__ is str])):
+        return values
+    sub = ILLEGAL_CHARACTERS_RE.sub
+    return [sub("", v) if v.__class__ is str else v for v in values]
 
-        # -------------------------
-        # Prefill rows (opcional)
-        # -------------------------
-        write_r = data_first
-        for item in rows[:300]:
-            if not isinstance(item, dict):
-                continue
-            ws.cell(write_r, 1, item.get("Fecha") or item.get("fecha"))
-            ws.cell(write_r, 2, item.get("Concepto") or item.get("concepto"))
-            ws.cell(write_r, 3, item.get("Categoría") or item.get("categoria") or item.get("category"))
-            ws.cell(write_r, 4, item.get("Forma de pago") or item.get("pago") or item.get("payment"))
-            ws.cell(write_r, 5, _as_number(item.get("Ingreso") or item.get("ingreso")))
-            ws.cell(write_r, 6, _as_number(item.get("Egreso") or item.get("egreso")))
-            write_r += 1
 
-        # -------------------------
-        # Excel Table REAL (tbl_data)
-        # Incluye Totals Row (para sumar) pero KPIs usan #Data => NO DUPLICA
-        # -------------------------
-        table_ref = f"A{header_row}:F{total_row}"
-        tab = Table(displayName="tbl_data", ref=table_ref)
-
-        # columnas con total function
-        tab.tableColumns = [
-            TableColumn(id=1, name="Fecha"),
-            TableColumn(id=2, name="Concepto"),
-            TableColumn(id=3, name="Categoría"),
-            TableColumn(id=4, name="Forma de pago"),
-            TableColumn(id=5, name="Ingreso", totalsRowFunction="sum"),
-            TableColumn(id=6, name="Egreso", totalsRowFunction="sum"),
-        ]
-        tab.totalsRowCount = 1
+def _number_column(values: list) -> list:
+    memo = {}
+    out = []
+    for v in values:
+        t = v.__class__
+        if t is float:
+            out.append(v)
+        elif t is int:
+            out.append(float(v))
+        elif t is str:
+            n = memo.get(v)
+            if n is None:
+                n = memo[v] = _number_from_str(v) or 0.0
+            out.append(n)
+        else:
+            out.append(_as_number(v))
+    return out
 
-        tab.tableStyleInfo = TableStyleInfo(
-            name="TableStyleMedium9",
-            showFirstColumn=False,
-            showLastColumn=False,
-            showRowStripes=True,
-            showColumnStripes=False
-        )
-        ws.add_table(tab)
 
-        # estilo de la totals row (fila total_row)
-        for c in range(1, 7):
-            cell = ws.cell(row=total_row, column=c)
-            cell.fill = PatternFill("solid", fgColor=NAVY_2)
-            cell.font = Font(bold=True, color=WHITE)
-            cell.border = border_thin
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        ws.cell(row=total_row, column=5).number_format = money_fmt
-        ws.cell(row=total_row, column=6).number_format = money_fmt
+def _date_column(values: list) -> list:
+    # lo que no es fecha se queda como texto (igual que antes)
+    memo = {}
+    out = []
+    for v in values:
+        if v.__class__ is str:
+            d = memo.get(v)
+            if d is None:
+                d = memo[v] = _parse_date(v) or _text(v)
+            out.append(d)
+        else:
+            out.append(v)
+    return out
 
-        # -------------------------
-        # Reglas de calidad (condicional)
-        # 1) Falta categoría si hay monto
-        # 2) Ingreso y Egreso a la vez (error humano)
-        # -------------------------
-        # Falta categoría si (Ingreso>0 o Egreso>0) y C vacío
-        ws.conditional_formatting.add(
-            f"C{data_first}:C{data_last}",
-            FormulaRule(
-                formula=[f'=AND($C{data_first}="",OR($E{data_first}>0,$F{data_first}>0))'],
-                fill=PatternFill("solid", fgColor="7A1E1E")
-            )
-        )
-        # Ingreso y Egreso en la misma fila
-        ws.conditional_formatting.add(
-            f"E{data_first}:F{data_last}",
-            FormulaRule(
-                formula=[f"=AND($E{data_first}>0,$F{data_first}>0)"],
-                fill=PatternFill("solid", fgColor="7A1E1E")
-            )
-        )
 
-        # ============================================================
-        # Dashboard PRO (Structured Refs: NO DUPLICA JAMÁS)
-        # ============================================================
-        dash["A1"] = "AUREA 33 • Dashboard"
-        style_title(dash["A1"])
-        dash.merge_cells("A1:F1")
-
-        # KPI header
-        dash["A3"] = "KPI"
-        dash["B3"] = "Valor"
-        style_header_row(dash, 3, 1, 2)
-
-        dash["A4"] = "Ingresos"
-        dash["A5"] = "Egresos"
-        dash["A6"] = "Balance"
-        dash["A7"] = "Ingresos (Efectivo)"
-        dash["A8"] = "Egresos (Tarjeta)"
-
-        # ✅ Fórmulas con #Data (solo datos, excluye totals row)
-        dash["B4"] = '=SUM(tbl_data[[#Data],[Ingreso]])'
-        dash["B5"] = '=SUM(tbl_data[[#Data],[Egreso]])'
-        dash["B6"] = "=B4-B5"
-        dash["B7"] = '=SUMIFS(tbl_data[[#Data],[Ingreso]],tbl_data[[#Data],[Forma de pago]],"Efectivo")'
-        dash["B8"] = '=SUMIFS(tbl_data[[#Data],[Egreso]],tbl_data[[#Data],[Forma de pago]],"Tarjeta*")'
-
-        for r in range(4, 9):
-            dash[f"A{r}"].border = border_thin
-            dash[f"B{r}"].border = border_thin
-            dash[f"A{r}"].fill = PatternFill("solid", fgColor=NAVY)
-            dash[f"B{r}"].fill = PatternFill("solid", fgColor=NAVY)
-            dash[f"A{r}"].font = Font(color=WHITE, bold=True)
-            dash[f"B{r}"].font = Font(color=WHITE, bold=True)
-            dash[f"B{r}"].number_format = money_fmt
-            dash[f"A{r}"].alignment = Alignment(horizontal="left", vertical="center")
-            dash[f"B{r}"].alignment = Alignment(horizontal="left", vertical="center")
-
-        dash.column_dimensions["A"].width = 24
-        dash.column_dimensions["B"].width = 16
-
-        # Alertas
-        dash["D3"] = "Alertas"
-        dash.merge_cells("D3:F3")
-        dash["D3"].fill = PatternFill("solid", fgColor=NAVY_2)
-        dash["D3"].font = Font(color=WHITE, bold=True)
-        dash["D3"].alignment = Alignment(horizontal="center", vertical="center")
-
-        dash["D4"] = "Balance negativo"
-        dash["D5"] = "Egresos >= 5000"
-        dash["D6"] = "Sin categoría"
-
-        dash["E4"] = "=IF(B6<0,1,0)"
-        dash["E5"] = '=COUNTIF(tbl_data[[#Data],[Egreso]],">=5000")'
-        dash["E6"] = '=COUNTIF(tbl_data[[#Data],[Categoría]],"")'
-
-        dash["F4"] = '=IF(E4=1,"⚠️","✅")'
-        dash["F5"] = '=IF(E5>0,"⚠️","✅")'
-        dash["F6"] = '=IF(E6>0,"⚠️ Completar","✅")'
-
-        for r in range(4, 7):
-            for col in ["D", "E", "F"]:
-                cell = dash[f"{col}{r}"]
-                cell.border = border_thin
-                cell.fill = PatternFill("solid", fgColor=NAVY)
-                cell.font = Font(color=WHITE, bold=(col != "E"))
-                cell.alignment = Alignment(horizontal="center" if col != "D" else "left", vertical="center")
-
-        dash.column_dimensions["D"].width = 18
-        dash.column_dimensions["E"].width = 12
-        dash.column_dimensions["F"].width = 14
-
-        dash.conditional_formatting.add(
-            "B6",
-            FormulaRule(formula=["B6<0"], fill=PatternFill("solid", fgColor="7A1E1E"))
-        )
+LEDGER_COLUMN_KINDS = (_date_column, _text_column, _text_column, _text_column, _number_column, _number_column)
 
-        # Gastos por categoría + Pie
-        dash["D9"] = "Gastos por Categoría"
-        dash.merge_cells("D9:E9")
-        dash["D9"].fill = PatternFill("solid", fgColor=NAVY_2)
-        dash["D9"].font = Font(color=WHITE, bold=True)
-        dash["D9"].alignment = Alignment(horizontal="center", vertical="center")
-
-        dash["D10"] = "Categoría"
-        dash["E10"] = "Total"
-        style_header_row(dash, 10, 4, 5)
-
-        base_row = 11
-        for i, cat in enumerate(categorias_default):
-            r = base_row + i
-            dash[f"D{r}"] = cat
-            dash[f"E{r}"] = f'=SUMIFS(tbl_data[[#Data],[Egreso]],tbl_data[[#Data],[Categoría]],"{cat}")'
-            dash[f"D{r}"].border = border_thin
-            dash[f"E{r}"].border = border_thin
-            dash[f"D{r}"].fill = PatternFill("solid", fgColor=NAVY)
-            dash[f"E{r}"].fill = PatternFill("solid", fgColor=NAVY)
-            dash[f"D{r}"].font = Font(color=WHITE, bold=True)
-            dash[f"E{r}"].font = Font(color=WHITE, bold=True)
-            dash[f"E{r}"].number_format = money_fmt
-
-        dash.column_dimensions["D"].width = 16
-        dash.column_dimensions["E"].width = 14
-
-        pie = PieChart()
-        pie.title = "Distribución de Egresos"
-        labels = Reference(dash, min_col=4, min_row=base_row, max_row=base_row + len(categorias_default) - 1)
-        data_ref = Reference(dash, min_col=5, min_row=base_row - 1, max_row=base_row + len(categorias_default) - 1)
-        pie.add_data(data_ref, titles_from_data=True)
-        pie.set_categories(labels)
-        pie.height = 10
-        pie.width = 20
-        pie.legend.position = "r"
-        pie.dataLabels = None
-        dash.add_chart(pie, "D21")
-
-        # Top 10 Egresos
-        dash["A10"] = "Top 10 Egresos"
-        dash.merge_cells("A10:C10")
-        dash["A10"].fill = PatternFill("solid", fgColor=NAVY_2)
-        dash["A10"].font = Font(color=WHITE, bold=True)
-        dash["A10"].alignment = Alignment(horizontal="center", vertical="center")
-
-        dash["A11"] = "Concepto"
-        dash["B11"] = "Categoría"
-        dash["C11"] = "Egreso"
-        style_header_row(dash, 11, 1, 3)
-
-        top_start = 12
-        for i in range(10):
-            r = top_start + i
-            dash[f"C{r}"] = f"=LARGE(tbl_data[[#Data],[Egreso]],{i+1})"
-            dash[f"A{r}"] = f'=IFERROR(INDEX(tbl_data[[#Data],[Concepto]],MATCH(C{r},tbl_data[[#Data],[Egreso]],0)),"")'
-            dash[f"B{r}"] = f'=IFERROR(INDEX(tbl_data[[#Data],[Categoría]],MATCH(C{r},tbl_data[[#Data],[Egreso]],0)),"")'
-            for col in ["A", "B", "C"]:
-                cell = dash[f"{col}{r}"]
-                cell.border = border_thin
-                cell.fill = PatternFill("solid", fgColor=NAVY)
-                cell.font = Font(color=WHITE, bold=(col == "C"))
-                cell.alignment = Alignment(horizontal="left", vertical="center")
-            dash[f"C{r}"].number_format = money_fmt
-
-        dash.column_dimensions["A"].width = 24
-        dash.column_dimensions["B"].width = 16
-        dash.column_dimensions["C"].width = 14
 
-        bar = BarChart()
-        bar.title = "Top Egresos"
-        bar.height = 8
-        bar.width = 18
-        cats = Reference(dash, min_col=1, min_row=top_start, max_row=top_start + 9)
-        vals = Reference(dash, min_col=3, min_row=11, max_row=top_start + 9)
-        bar.add_data(vals, titles_from_data=True)
-        bar.set_categories(cats)
-        bar.legend = None
-        dash.add_chart(bar, "A23")
+def normalize_ledger_rows(items):
+    """
+    Iterable de rows del payload (dicts; lo demás se ignora) => tuplas de las
+    6 columnas del ledger. Procesa por bloques de LEDGER_CHUNK_ROWS, así que
+    acepta generadores (ingesta CSV/NDJSON) sin materializarlos completos.
+    """
+    it = iter(items)
+    while True:
+        raw = list(islice(it, LEDGER_CHUNK_ROWS))
+        if not raw:
+            return
+        chunk = [d for d in raw if isinstance(d, dict)]
+        if not chunk:
+            continue
+        key_map = ledger_key_map(set().union(*chunk))
+        columns = [kind(_pick_column(chunk, keys)) for kind, keys in zip(LEDGER_COLUMN_KINDS, key_map)]
+        yield from zip(*columns)
 
-    # ============================================================
-    # TEMPLATE 2: Servicios (se mantiene, solo mejorado leve)
-    # ============================================================
-    else:
-        ws["A3"] = "Plantilla de Servicios (precio fijo × estudios realizados)"
-        ws["A3"].font = Font(bold=True, color=WHITE)
-        ws["A3"].fill = PatternFill("solid", fgColor=NAVY)
-        ws.merge_cells("A3:F3")
 
-        headers = ["Servicio", "Nombre del servicio", "Precio unitario", "Estudios realizados", "Total generado", "Notas"]
-        start_row = 5
-        for i, h in enumerate(headers, start=1):
-            ws.cell(row=start_row, column=i, value=h)
-        style_header_row(ws, start_row, 1, 6)
+LEDGER_HEADERS = ["Fecha", "Concepto", "Categoría", "Forma de pago", "Ingreso", "Egreso"]
+LEDGER_WIDTHS = {"A": 14, "B": 24, "C": 16, "D": 18, "E": 14, "F": 14}
+LEDGER_STYLES = ["data_date"] + ["data"] * 3 + ["data_money"] * 2
+LEDGER_PAYMENTS = ["Efectivo", "Transferencia", "Depósito", "Tarjeta Débito", "Tarjeta Crédito"]
+LEDGER_CATEGORIES = ["Alimentos", "Servicios", "Transporte", "Salud", "Hogar", "Negocio", "Educación", "Ocio", "Otros"]
 
-        data_first = start_row + 1
-        data_last = data_first + 299
+# Listas de _lists según los rows: defaults + valores distintos de los rows
+# (juntados en la misma pasada, ver LedgerSummary), con tope por lista. El
+# Dashboard lleva todas las categorías de _lists. Los valores que no pueden
+# ser criterio exacto de SUMIFS (comodines * ? ~, operadores = < > al
+# inicio, códigos de error) quedan en los datos pero fuera de las listas.
+LEDGER_LISTS_MAX = max(len(LEDGER_CATEGORIES), len(LEDGER_PAYMENTS), int(os.getenv("AUREA_LEDGER_LISTS_MAX", "50")))
+LEDGER_LIST_VALUE_MAX = 255
+_LIST_UNSAFE_RE = re.compile(r"[*?~]|^[=<>]")
 
-        set_col_widths(ws, {
-            "A": 22, "B": 30, "C": 16, "D": 18, "E": 16, "F": 20
-        })
 
-        servicios_default = [
-            "Tomografía simple",
-            "Tomografía contrastada",
-            "Angiotomografía",
-            "Ultrasonido básico",
-            "Doppler / Ecografía Doppler",
-            "Rayos X digital",
-        ]
+class LedgerLists(namedtuple("LedgerLists", "payments categories")):
+    """Pagos y categorías de _lists; el Dashboard lleva las mismas categorías (tuplas => sirve como llave de cache)."""
 
-        # listas en _lists
-        lists["D1"] = "Servicios"
-        lists["D1"].font = Font(bold=True)
-        for i, s in enumerate(servicios_default, start=2):
-            lists[f"D{i}"] = s
-        serv_range = f"_lists!$D$2:$D${len(servicios_default)+1}"
 
-        dv_serv = DataValidation(type="list", formula1=f"={serv_range}", allow_blank=True)
-        ws.add_data_validation(dv_serv)
-        dv_serv.add(f"A{data_first}:A{data_last}")
+def ledger_list_value(v) -> bool:
+    """True si v puede ir a _lists / al Dashboard."""
+    return (v.__class__ is str and bool(v.strip()) and len(v) <= LEDGER_LIST_VALUE_MAX and v not in ERROR_CODES
+            and not _LIST_UNSAFE_RE.search(v) and not ILLEGAL_CHARACTERS_RE.search(v))
 
-        for r in range(data_first, data_last + 1):
-            ws.cell(r, 5).value = f"=C{r}*D{r}"
-            for c in range(1, 7):
-                ws.cell(r, c).border = border_thin
-                ws.cell(r, c).alignment = Alignment(horizontal="left", vertical="center")
-            ws.cell(r, 3).number_format = money_fmt
-            ws.cell(r, 5).number_format = money_fmt
 
-        dash["A1"] = "AUREA 33 • Dashboard (Servicios)"
-        style_title(dash["A1"])
-        dash.merge_cells("A1:E1")
+def _merge_list(defaults, seen) -> tuple:
+    known = {d.casefold() for d in defaults}
+    extra = [v for v in seen if v.casefold() not in known]
+    return tuple(defaults) + tuple(extra[:LEDGER_LISTS_MAX - len(defaults)])
 
-        dash["A3"] = "Total generado"
-        dash["B3"] = f"=SUM(AUREA!E{data_first}:AUREA!E{data_last})"
-        dash["B3"].number_format = money_fmt
-        dash["A3"].font = Font(bold=True)
-        dash["B3"].font = Font(bold=True)
 
-        dash["A5"] = "Servicio"
-        dash["B5"] = "Total"
-        style_header_row(dash, 5, 1, 2)
+def ledger_lists(payments=(), categories=()) -> LedgerLists:
+    """
+    payments / categories: valores distintos de los rows (uno por casefold, en
+    orden de aparición). Los defaults van primero y conservan su escritura.
+    El Dashboard lleva todas las categorías (también las que aún no se usan):
+    lo que se elija después en el listado o llegue por /api/excel/append ya
+    tiene su fila y su rebanada del pie.
+    """
+    return LedgerLists(_merge_list(LEDGER_PAYMENTS, payments), _merge_list(LEDGER_CATEGORIES, categories))
 
-        for i in range(len(servicios_default)):
-            r = 6 + i
-            dash[f"A{r}"] = servicios_default[i]
-            dash[f"B{r}"] = f'=SUMIF(AUREA!A{data_first}:AUREA!A{data_last},"{servicios_default[i]}",AUREA!E{data_first}:AUREA!E{data_last})'
-            dash[f"B{r}"].number_format = money_fmt
-            dash[f"A{r}"].border = border_thin
-            dash[f"B{r}"].border = border_thin
 
-        bar = BarChart()
-        bar.title = "Total por servicio"
-        bar.height = 10
-        bar.width = 20
-        cats = Reference(dash, min_col=1, min_row=6, max_row=6 + len(servicios_default) - 1)
-        vals = Reference(dash, min_col=2, min_row=5, max_row=6 + len(servicios_default) - 1)
-        bar.add_data(vals, titles_from_data=True)
-        bar.set_categories(cats)
-        bar.legend = None
-        dash.add_chart(bar, "A12")
+LEDGER_DEFAULT_LISTS = ledger_lists()
 
-    # Save
+
+def ledger_list_ranges(lists: LedgerLists) -> tuple:
+    """(pay_range, cat_range) de las validaciones sobre _lists."""
+    return f"_lists!$A$2:$A${len(lists.payments) + 1}", f"_lists!$B$2:$B${len(lists.categories) + 1}"
+
+
+def _build_ledger_lists(ws, lists: LedgerLists = LEDGER_DEFAULT_LISTS):
+    """Listas para validación en la hoja oculta _lists. Regresa (pay_range, cat_range)."""
+    ws["A1"] = "Pagos"
+    ws["B1"] = "Categorias"
+    apply_style(ws["A1"], "bold")
+    apply_style(ws["B1"], "bold")
+
+    for i, p in enumerate(lists.payments, start=2):
+        ws[f"A{i}"] = p
+    for i, c in enumerate(lists.categories, start=2):
+        ws[f"B{i}"] = c
+    return ledger_list_ranges(lists)
+
+
+def _add_ledger_validations(ws, pay_range, cat_range, data_first, data_last):
+    # Validación pagos (col D)
+    dv_pay = DataValidation(type="list", formula1=f"={pay_range}", allow_blank=True)
+    dv_pay.prompt = "Selecciona forma de pago"
+    dv_pay.error = "Elige un valor del listado."
+    ws.data_validations.append(dv_pay)  # igual que add_data_validation, válido también en write-only
+    dv_pay.add(f"D{data_first}:D{data_last}")
+
+    # Validación categorías (col C)
+    dv_cat = DataValidation(type="list", formula1=f"={cat_range}", allow_blank=True)
+    dv_cat.prompt = "Selecciona categoría"
+    dv_cat.error = "Elige una categoría del listado."
+    ws.data_validations.append(dv_cat)
+    dv_cat.add(f"C{data_first}:C{data_last}")
+
+
+def _add_ledger_table(ws, name, header_row, total_row):
+    """
+    Excel Table REAL (tbl_data)
+    Incluye Totals Row (para sumar) pero KPIs usan #Data => NO DUPLICA
+    """
+    table_ref = f"A{header_row}:F{total_row}"
+    tab = Table(displayName=name, ref=table_ref)
+
+    # columnas con total function
+    tab.tableColumns = [
+        TableColumn(id=1, name="Fecha"),
+        TableColumn(id=2, name="Concepto"),
+        TableColumn(id=3, name="Categoría"),
+        TableColumn(id=4, name="Forma de pago"),
+        TableColumn(id=5, name="Ingreso", totalsRowFunction="sum"),
+        TableColumn(id=6, name="Egreso", totalsRowFunction="sum"),
+    ]
+    tab.totalsRowCount = 1
+
+    tab.tableStyleInfo = TableStyleInfo(
+        name="TableStyleMedium9",
+        showFirstColumn=False,
+        showLastColumn=False,
+        showRowStripes=True,
+        showColumnStripes=False
+    )
+    ws.add_table(tab)
+
+
+def _add_ledger_quality_rules(ws, data_first, data_last):
+    """
+    Reglas de calidad (condicional)
+    1) Falta categoría si hay monto
+    2) Ingreso y Egreso a la vez (error humano)
+    """
+    # Falta categoría si (Ingreso>0 o Egreso>0) y C vacío
+    ws.conditional_formatting.add(
+        f"C{data_first}:C{data_last}",
+        FormulaRule(
+            formula=[f'=AND($C{data_first}="",OR($E{data_first}>0,$F{data_first}>0))'],
+            fill=fill_alert
+        )
+    )
+    # Ingreso y Egreso en la misma fila
+    ws.conditional_formatting.add(
+        f"E{data_first}:F{data_last}",
+        FormulaRule(
+            formula=[f"=AND($E{data_first}>0,$F{data_first}>0)"],
+            fill=fill_alert
+        )
+    )
+
+
+# Estrategia de fórmulas del Dashboard:
+#   classic => LARGE + INDEX/MATCH por fila del Top 10 y un SUMIFS por categoría
+#              (cualquier Excel; en ledgers grandes recalcula lento)
+#   dynamic => Top 10 con un solo SORTBY/TAKE y categorías con un SUMIFS
+#              compartido (fórmulas de matriz; requiere Excel 365 / 2021+)
+DASH_CLASSIC = "classic"
+DASH_DYNAMIC = "dynamic"
+DASH_FORMULA_MODES = (DASH_CLASSIC, DASH_DYNAMIC)
+DASHBOARD_FORMULAS = os.getenv("AUREA_DASHBOARD_FORMULAS", DASH_CLASSIC)
+DASHBOARD_FORMULAS = DASHBOARD_FORMULAS if DASHBOARD_FORMULAS in DASH_FORMULA_MODES else DASH_CLASSIC
+
+
+def dashboard_formulas(payload: dict) -> str:
+    mode = payload.get("dashboardFormulas")
+    return mode if mode in DASH_FORMULA_MODES else DASHBOARD_FORMULAS
+
+
+def _tbl_cols(tables, col: str) -> list:
+    return [f"{t}[[#Data],[{col}]]" for t in tables]
+
+
+def _tbl_each(tables, expr: str) -> str:
+    """Suma la misma expresión sobre cada tabla de datos ({t} = nombre de tabla)."""
+    return "=" + "+".join(expr.replace("{t}", t) for t in tables)
+
+
+def _tbl_stack(tables, col: str) -> str:
+    """
+    Columna de datos como un solo rango. Con hojas de continuación
+    (más de 1 tabla) se apilan con VSTACK (Excel 365).
+    """
+    cols = _tbl_cols(tables, col)
+    return cols[0] if len(cols) == 1 else f"_xlfn.VSTACK({','.join(cols)})"
+
+
+def _build_ledger_dashboard(dash, tables, categorias, formulas: str = DASH_CLASSIC):
+    """
+    Dashboard PRO (Structured Refs: NO DUPLICA JAMÁS).
+    tables: nombres de las tablas de datos (tbl_data + continuaciones).
+    formulas: DASH_CLASSIC (una fórmula por celda) o DASH_DYNAMIC (ver DASHBOARD_FORMULAS).
+    """
+    dash["A1"] = "AUREA 33 • Dashboard"
+    style_title(dash["A1"])
+    dash.merge_cells("A1:F1")
+
+    # KPI header
+    dash["A3"] = "KPI"
+    dash["B3"] = "Valor"
+    style_header_row(dash, 3, 1, 2)
+
+    dash["A4"] = "Ingresos"
+    dash["A5"] = "Egresos"
+    dash["A6"] = "Balance"
+    dash["A7"] = "Ingresos (Efectivo)"
+    dash["A8"] = "Egresos (Tarjeta)"
+
+    # ✅ Fórmulas con #Data (solo datos, excluye totals row)
+    dash["B4"] = f"=SUM({','.join(_tbl_cols(tables, 'Ingreso'))})"
+    dash["B5"] = f"=SUM({','.join(_tbl_cols(tables, 'Egreso'))})"
+    dash["B6"] = "=B4-B5"
+    dash["B7"] = _tbl_each(tables, 'SUMIFS({t}[[#Data],[Ingreso]],{t}[[#Data],[Forma de pago]],"Efectivo")')
+    dash["B8"] = _tbl_each(tables, 'SUMIFS({t}[[#Data],[Egreso]],{t}[[#Data],[Forma de pago]],"Tarjeta*")')
+
+    for r in range(4, 9):
+        apply_style(dash[f"A{r}"], "kpi")
+        apply_style(dash[f"B{r}"], "kpi_money")
+
+    dash.column_dimensions["A"].width = 24
+    dash.column_dimensions["B"].width = 16
+
+    # Alertas
+    dash["D3"] = "Alertas"
+    dash.merge_cells("D3:F3")
+    apply_style(dash["D3"], "section")
+
+    dash["D4"] = "Balance negativo"
+    dash["D5"] = "Egresos >= 5000"
+    dash["D6"] = "Sin categoría"
+
+    dash["E4"] = "=IF(B6<0,1,0)"
+    dash["E5"] = _tbl_each(tables, 'COUNTIF({t}[[#Data],[Egreso]],">=5000")')
+    dash["E6"] = _tbl_each(tables, 'COUNTIF({t}[[#Data],[Categoría]],"")')
+
+    dash["F4"] = '=IF(E4=1,"⚠️","✅")'
+    dash["F5"] = '=IF(E5>0,"⚠️","✅")'
+    dash["F6"] = '=IF(E6>0,"⚠️ Completar","✅")'
+
+    for r in range(4, 7):
+        apply_style(dash[f"D{r}"], "alert_label")
+        apply_style(dash[f"E{r}"], "alert_value")
+        apply_style(dash[f"F{r}"], "alert_flag")
+
+    dash.column_dimensions["D"].width = 18
+    dash.column_dimensions["E"].width = 12
+    dash.column_dimensions["F"].width = 14
+
+    dash.conditional_formatting.add(
+        "B6",
+        FormulaRule(formula=["B6<0"], fill=fill_alert)
+    )
+
+    # Gastos por categoría + Pie
+    dash["D9"] = "Gastos por Categoría"
+    dash.merge_cells("D9:E9")
+    apply_style(dash["D9"], "section")
+
+    dash["D10"] = "Categoría"
+    dash["E10"] = "Total"
+    style_header_row(dash, 10, 4, 5)
+
+    base_row = 11
+    last_row = base_row + len(categorias) - 1
+    for i, cat in enumerate(categorias):
+        r = base_row + i
+        dash[f"D{r}"] = cat
+        if formulas == DASH_CLASSIC:
+            crit = cat.replace('"', '""')
+            dash[f"E{r}"] = _tbl_each(tables, 'SUMIFS({t}[[#Data],[Egreso]],{t}[[#Data],[Categoría]],"' + crit + '")')
+        apply_style(dash[f"D{r}"], "category")
+        apply_style(dash[f"E{r}"], "category_money")
+    if formulas == DASH_DYNAMIC:
+        # un solo SUMIFS con la lista de categorías como criterio: los rangos de
+        # la tabla se resuelven una vez para todas las filas
+        crit = f"D{base_row}:D{last_row}"
+        dash[f"E{base_row}"] = ArrayFormula(
+            f"E{base_row}:E{last_row}",
+            _tbl_each(tables, "SUMIFS({t}[[#Data],[Egreso]],{t}[[#Data],[Categoría]]," + crit + ")"),
+        )
+
+    dash.column_dimensions["D"].width = 16
+    dash.column_dimensions["E"].width = 14
+
+    pie = PieChart()
+    pie.title = "Distribución de Egresos"
+    labels = Reference(dash, min_col=4, min_row=base_row, max_row=base_row + len(categorias) - 1)
+    data_ref = Reference(dash, min_col=5, min_row=base_row - 1, max_row=base_row + len(categorias) - 1)
+    pie.add_data(data_ref, titles_from_data=True)
+    pie.set_categories(labels)
+    pie.height = 10
+    pie.width = 20
+    pie.legend.position = "r"
+    pie.dataLabels = None
+    # debajo de la última categoría (con pocas, en D21 / A23 como siempre)
+    dash.add_chart(pie, f"D{max(21, last_row + 2)}")
+
+    # Top 10 Egresos
+    dash["A10"] = "Top 10 Egresos"
+    dash.merge_cells("A10:C10")
+    apply_style(dash["A10"], "section")
+
+    dash["A11"] = "Concepto"
+    dash["B11"] = "Categoría"
+    dash["C11"] = "Egreso"
+    style_header_row(dash, 11, 1, 3)
+
+    top_start = 12
+    egreso = _tbl_stack(tables, "Egreso")
+    concepto = _tbl_stack(tables, "Concepto")
+    categoria = _tbl_stack(tables, "Categoría")
+    for i in range(10):
+        r = top_start + i
+        if formulas == DASH_CLASSIC:
+            dash[f"C{r}"] = f"=LARGE({egreso},{i+1})"
+            dash[f"A{r}"] = f'=IFERROR(INDEX({concepto},MATCH(C{r},{egreso},0)),"")'
+            dash[f"B{r}"] = f'=IFERROR(INDEX({categoria},MATCH(C{r},{egreso},0)),"")'
+        apply_style(dash[f"A{r}"], "top_text")
+        apply_style(dash[f"B{r}"], "top_text")
+        apply_style(dash[f"C{r}"], "kpi_money")
+    if formulas == DASH_DYNAMIC:
+        # un solo ordenamiento de filas completas (sin MATCH => sin conceptos
+        # repetidos en empates); EXPAND rellena con "" si hay menos de 10
+        rows = f"_xlfn.HSTACK({concepto},{categoria},{egreso})"
+        has_egreso = f'{egreso}<>""'
+        dash[f"A{top_start}"] = ArrayFormula(
+            f"A{top_start}:C{top_start + 9}",
+            f"=IFERROR(_xlfn.EXPAND(_xlfn.TAKE(_xlfn.SORTBY(_xlfn._xlws.FILTER({rows},{has_egreso}),"
+            f'_xlfn._xlws.FILTER({egreso},{has_egreso}),-1),10),10,3,""),"")',
+        )
+
+    dash.column_dimensions["A"].width = 24
+    dash.column_dimensions["B"].width = 16
+    dash.column_dimensions["C"].width = 14
+
+    bar = BarChart()
+    bar.title = "Top Egresos"
+    bar.height = 8
+    bar.width = 18
+    cats = Reference(dash, min_col=1, min_row=top_start, max_row=top_start + 9)
+    vals = Reference(dash, min_col=3, min_row=11, max_row=top_start + 9)
+    bar.add_data(vals, titles_from_data=True)
+    bar.set_categories(cats)
+    bar.legend = None
+    dash.add_chart(bar, f"A{max(23, last_row + 4)}")
+
+
+# ------------------------------------------------------------
+# Valores precalculados del Dashboard: se calculan en la misma pasada que
+# escribe los rows y se guardan como resultado cacheado (<v>) de cada
+# fórmula => previews, visores móviles y conversores a PDF muestran los
+# números sin recalcular. Las fórmulas se quedan para ediciones posteriores.
+# Mismas celdas y mismas reglas que _build_ledger_dashboard (criterios de
+# texto sin distinguir mayúsculas, como SUMIFS/COUNTIF).
+# ------------------------------------------------------------
+DASH_TOP_N = 10
+# celda con fórmula sin resultado, o celda vacía (las de un rango de fórmula de matriz)
+_FORMULA_CELL_RE = re.compile(
+    r'<c r="([A-Z]+[0-9]+)"([^>]*?)(?:><f([^>]*)>(.*?)</f><v\s*/></c>|\s*/>)', re.DOTALL
+)
+
+
+class LedgerSummary:
+    """Acumuladores de una pasada sobre las tuplas del ledger (ver normalize_ledger_rows)."""
+
+    __slots__ = ("rows", "ingreso", "egreso", "efectivo", "tarjeta", "egresos_5000",
+                 "con_categoria", "por_categoria", "top", "first", "pagos", "categorias")
+
+    def __init__(self):
+        self.rows = 0
+        self.ingreso = self.egreso = self.efectivo = self.tarjeta = 0.0
+        self.egresos_5000 = self.con_categoria = 0
+        self.por_categoria = {}
+        self.top = []      # min-heap (egreso, -orden, concepto, categoría) de las DASH_TOP_N filas mayores
+        self.first = {}    # egreso => (concepto, categoría) de su primera fila (MATCH exacto)
+        # casefold => primera escritura de los pagos / categorías que van a _lists (ver ledger_lists)
+        self.pagos = {}
+        self.categorias = {}
+
+    def track(self, rows):
+        """Deja pasar los rows (para el writer) acumulando al vuelo."""
+        top, first, por_categoria = self.top, self.first, self.por_categoria
+        lista_pagos, lista_categorias = self.pagos, self.categorias
+        pagos, categorias = {}, {}
+        n, ingreso, egreso, efectivo, tarjeta, e5000, con_cat = 0, 0.0, 0.0, 0.0, 0.0, 0, 0
+        try:
+            for row in rows:
+                _, concepto, categoria, pago, ing, eg = row
+                n += 1
+                ingreso += ing
+                egreso += eg
+                if pago.__class__ is str:
+                    kind = pagos.get(pago)
+                    if kind is None:
+                        p = pago.casefold()
+                        kind = pagos[pago] = (p == "efectivo", p.startswith("tarjeta"))
+                        if len(lista_pagos) < LEDGER_LISTS_MAX and ledger_list_value(pago):
+                            lista_pagos.setdefault(p, pago)
+                    if kind[0]:
+                        efectivo += ing
+                    if kind[1]:
+                        tarjeta += eg
+                if eg >= 5000:
+                    e5000 += 1
+                if categoria is not None and categoria != "":
+                    con_cat += 1
+                    if categoria.__class__ is str:
+                        key = categorias.get(categoria)
+                        if key is None:
+                            key = categorias[categoria] = categoria.casefold()
+                            if len(lista_categorias) < LEDGER_LISTS_MAX and ledger_list_value(categoria):
+                                lista_categorias.setdefault(key, categoria)
+                        por_categoria[key] = por_categoria.get(key, 0.0) + eg
+                # en empates gana la fila anterior (MATCH y SORTBY son estables)
+                if len(top) < DASH_TOP_N:
+                    heapq.heappush(top, (eg, -(self.rows + n), concepto, categoria))
+                    first.setdefault(eg, (concepto, categoria))
+                elif eg > top[0][0]:
+                    heapq.heapreplace(top, (eg, -(self.rows + n), concepto, categoria))
+                    first.setdefault(eg, (concepto, categoria))
+                    if len(first) > 8 * DASH_TOP_N:
+                        floor = top[0][0]
+                        for k in [k for k in first if k < floor]:
+                            del first[k]
+                yield row
+        finally:
+            self.rows += n
+            self.ingreso += ingreso
+            self.egreso += egreso
+            self.efectivo += efectivo
+            self.tarjeta += tarjeta
+            self.egresos_5000 += e5000
+            self.con_categoria += con_cat
+
+    def lists(self) -> LedgerLists:
+        """Listas de _lists y categorías del Dashboard según los rows vistos hasta ahora."""
+        return ledger_lists(self.pagos.values(), self.categorias.values())
+
+    def cells(self, blank_rows: int = 0, categorias=None, formulas: str = DASH_CLASSIC) -> dict:
+        """
+        {celda del Dashboard: valor}. blank_rows: filas vacías de tbl_data (cuentan en "Sin categoría").
+        categorias: las del Dashboard (default: las de self.lists()).
+        """
+        if categorias is None:
+            categorias = self.lists().categories
+        balance = self.ingreso - self.egreso
+        out = {
+            "B4": self.ingreso, "B5": self.egreso, "B6": balance,
+            "B7": self.efectivo, "B8": self.tarjeta,
+            "E4": 1 if balance < 0 else 0,
+            "E5": self.egresos_5000,
+            "E6": self.rows + blank_rows - self.con_categoria,
+        }
+        out["F4"] = "⚠️" if out["E4"] == 1 else "✅"
+        out["F5"] = "⚠️" if out["E5"] > 0 else "✅"
+        out["F6"] = "⚠️ Completar" if out["E6"] > 0 else "✅"
+        for i, cat in enumerate(categorias):
+            out[f"E{11 + i}"] = self.por_categoria.get(cat.casefold(), 0.0)
+
+        top = sorted(self.top, reverse=True)
+        for i in range(DASH_TOP_N):
+            r = 12 + i
+            if i >= len(top):
+                out[f"A{r}"] = out[f"B{r}"] = ""
+                out[f"C{r}"] = "" if formulas == DASH_DYNAMIC else "#NUM!"
+                continue
+            eg = top[i][0]
+            # classic: MATCH => primera fila con ese monto; dynamic: la fila misma
+            concepto, categoria = self.first[eg] if formulas == DASH_CLASSIC else top[i][2:]
+            # INDEX / HSTACK sobre una celda vacía => 0
+            out[f"A{r}"] = 0 if concepto is None else concepto
+            out[f"B{r}"] = 0 if categoria is None else categoria
+            out[f"C{r}"] = eg
+        return out
+
+
+def _cached_value(value) -> tuple:
+    """(atributo t, texto de <v>) del resultado de una fórmula."""
+    if isinstance(value, bool):
+        return ' t="b"', str(int(value))
+    if isinstance(value, NUMERIC_TYPES):
+        return "", safe_string(value)
+    if isinstance(value, datetime):
+        return "", safe_string(to_excel(value))
+    value = str(value)
+    if value in ERROR_CODES:
+        return ' t="e"', value
+    return ' t="str"', xml_escape(ILLEGAL_CHARACTERS_RE.sub("", value))
+
+
+_CELL_TYPE_RE = re.compile(r'\s+t="[^"]*"')
+
+
+def fill_cached_values(sheet_xml, values: dict):
+    """Pone <v>resultado</v> en las celdas con fórmula de sheet_xml (str o bytes) listadas en values."""
+    def repl(m):
+        ref = m.group(1)
+        if ref not in values:
+            return m.group(0)
+        t, text = _cached_value(values[ref])
+        attrs = _CELL_TYPE_RE.sub("", m.group(2))
+        formula = f"<f{m.group(3)}>{m.group(4)}</f>" if m.group(4) is not None else ""
+        return f'<c r="{ref}"{attrs}{t}>{formula}<v>{text}</v></c>'
+
+    if isinstance(sheet_xml, bytes):
+        return _FORMULA_CELL_RE.sub(repl, sheet_xml.decode("utf-8")).encode("utf-8")
+    return _FORMULA_CELL_RE.sub(repl, sheet_xml)
+
+
+def dashboard_path(n_data_sheets: int) -> str:
+    """El Dashboard va justo después de las hojas de datos (AUREA, AUREA (2)...)."""
+    return f"xl/worksheets/sheet{n_data_sheets + 1}.xml"
+
+
+def dashboard_patch(summary: LedgerSummary, capacity: int = 0, formulas: str = DASH_CLASSIC):
+    """Parche (bytes => bytes) para la hoja Dashboard; se evalúa al escribirla, con los rows ya consumidos."""
+    def patch(data):
+        first_sheet = min(summary.rows, STREAM_ROWS_PER_SHEET)
+        blank = max(first_sheet, capacity, 1) - first_sheet
+        return fill_cached_values(data, summary.cells(blank, formulas=formulas))
+    return patch
+
+
+# ------------------------------------------------------------
+# Capacidad del ledger: filas de datos de tbl_data según el payload
+# (datos + holgura, redondeado a STEP => pocos skeletons distintos)
+# ------------------------------------------------------------
+LEDGER_MIN_ROWS = int(os.getenv("AUREA_LEDGER_MIN_ROWS", "1000"))
+LEDGER_HEADROOM = float(os.getenv("AUREA_LEDGER_HEADROOM", "0.25"))
+LEDGER_CAPACITY_STEP = max(1, int(os.getenv("AUREA_LEDGER_CAPACITY_STEP", "500")))
+
+
+def ledger_capacity(n_rows: int) -> int:
+    want = max(LEDGER_MIN_ROWS, n_rows + int(n_rows * LEDGER_HEADROOM))
+    return -(-want // LEDGER_CAPACITY_STEP) * LEDGER_CAPACITY_STEP
+
+
+def apply_column_style(ws, col_letter: str, name: str):
+    """Estilo a nivel columna (<col style=..>): formatea filas vacías sin materializar celdas."""
+    apply_style(ws.column_dimensions[col_letter], name)
+
+
+def _style_ids(ws, names) -> list:
+    """Índices xf (atributo s="..") de estilos del registro, sin crear celdas en la hoja."""
+    ids = []
+    for name in names:
+        proto = Cell(ws)
+        apply_style(proto, name)
+        ids.append(str(proto.style_id))
+    return ids
+
+
+def build_template_workbook(template: str, capacity: int = 0, tables=None, formulas: str = DASH_CLASSIC,
+                            lists: LedgerLists = LEDGER_DEFAULT_LISTS):
+    """
+    Construye la plantilla completa (listas, validaciones, tbl_data, formato
+    condicional, dashboard y charts) SIN filas ni timestamp.
+    capacity: filas de datos del ledger (ver ledger_capacity).
+    tables: tablas de datos que suma el Dashboard (default ["tbl_data"]).
+    formulas: estrategia de fórmulas del Dashboard (DASH_CLASSIC / DASH_DYNAMIC).
+    lists: _lists y categorías del Dashboard del ledger (ver ledger_lists).
+    Regresa (wb, layout) donde layout describe el rango de datos de AUREA.
+    """
+    use_services_template = template == TEMPLATE_SERVICES
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "AUREA"
+    dash = wb.create_sheet("Dashboard")
+
+    # hoja listas oculta (validaciones pro)
+    lists_ws = wb.create_sheet("_lists")
+    lists_ws.sheet_state = "hidden"
+
+    # look
+    ws.sheet_view.showGridLines = True
+    dash.sheet_view.showGridLines = True
+
+    # Freeze panes
+    ws.freeze_panes = "A4"
+    dash.freeze_panes = "A4"
+
+    # Header
+    ws["A1"] = "AUREA 33 • AUREA"
+    style_title(ws["A1"])
+    ws.merge_cells("A1:F1")
+
+    # B2 (timestamp) queda vacío: se rellena por request
+    ws["A2"] = "Generado:"
+    apply_style(ws["A2"], "meta_label")
+    apply_style(ws["B2"], "meta_value")
+
+    # ============================================================
+    # TEMPLATE 1: Ledger contable PRO
+    # ============================================================
+    if not use_services_template:
+        header_row = 3
+        for i, h in enumerate(LEDGER_HEADERS, start=1):
+            ws.cell(row=header_row, column=i, value=h)
+        style_header_row(ws, header_row, 1, 6)
+
+        # rango data
+        data_first = header_row + 1
+        data_rows = capacity or ledger_capacity(0)
+        data_last = data_first + data_rows - 1
+        total_row = data_last + 1  # fila de totales dentro de la tabla
+
+        # columnas
+        set_col_widths(ws, LEDGER_WIDTHS)
+
+        pay_range, cat_range = _build_ledger_lists(lists_ws, lists)
+        _add_ledger_validations(ws, pay_range, cat_range, data_first, data_last)
+
+        # -------------------------
+        # Formatos / bordes base: a nivel columna (las filas vacías no se materializan;
+        # la tabla aporta el bandeado)
+        # -------------------------
+        for c, style in enumerate(LEDGER_STYLES, start=1):
+            apply_column_style(ws, get_column_letter(c), style)
+
+        # Prefill rows: se rellenan por request sobre el skeleton (ver _Skeleton.fill)
+        layout = {
+            "data_first": data_first,
+            "data_last": data_last,
+            "prefill": data_rows,
+            "style_ids": _style_ids(ws, LEDGER_STYLES),
+        }
+
+        _add_ledger_table(ws, "tbl_data", header_row, total_row)
+
+        # estilo de la totals row (fila total_row)
+        style_header_row(ws, total_row, 1, 4)
+        apply_style(ws.cell(row=total_row, column=5), "header_money")
+        apply_style(ws.cell(row=total_row, column=6), "header_money")
+
+        _add_ledger_quality_rules(ws, data_first, data_last)
+        _build_ledger_dashboard(dash, list(tables or ["tbl_data"]), lists.categories, formulas)
+
+    # ============================================================
+    # TEMPLATE 2: Servicios (se mantiene, solo mejorado leve)
+    # ============================================================
+    else:
+        ws["A3"] = "Plantilla de Servicios (precio fijo × estudios realizados)"
+        apply_style(ws["A3"], "banner")
+        ws.merge_cells("A3:F3")
+
+        headers = ["Servicio", "Nombre del servicio", "Precio unitario", "Estudios realizados", "Total generado", "Notas"]
+        start_row = 5
+        for i, h in enumerate(headers, start=1):
+            ws.cell(row=start_row, column=i, value=h)
+        style_header_row(ws, start_row, 1, 6)
+
+        data_first = start_row + 1
+        data_last = data_first + 299
+        layout = {"data_first": data_first, "data_last": data_last, "prefill": 0, "style_ids": []}
+
+        set_col_widths(ws, {
+            "A": 22, "B": 30, "C": 16, "D": 18, "E": 16, "F": 20
+        })
+
+        servicios_default = [
+            "Tomografía simple",
+            "Tomografía contrastada",
+            "Angiotomografía",
+            "Ultrasonido básico",
+            "Doppler / Ecografía Doppler",
+            "Rayos X digital",
+        ]
+
+        # listas en _lists
+        lists_ws["D1"] = "Servicios"
+        apply_style(lists_ws["D1"], "bold")
+        for i, s in enumerate(servicios_default, start=2):
+            lists_ws[f"D{i}"] = s
+        serv_range = f"_lists!$D$2:$D${len(servicios_default)+1}"
+
+        dv_serv = DataValidation(type="list", formula1=f"={serv_range}", allow_blank=True)
+        ws.add_data_validation(dv_serv)
+        dv_serv.add(f"A{data_first}:A{data_last}")
+
+        for r in range(data_first, data_last + 1):
+            ws.cell(r, 5).value = f"=C{r}*D{r}"
+            for c in (1, 2, 4, 6):
+                apply_style(ws.cell(r, c), "data")
+            apply_style(ws.cell(r, 3), "data_money")
+            apply_style(ws.cell(r, 5), "data_money")
+
+        dash["A1"] = "AUREA 33 • Dashboard (Servicios)"
+        style_title(dash["A1"])
+        dash.merge_cells("A1:E1")
+
+        dash["A3"] = "Total generado"
+        dash["B3"] = f"=SUM(AUREA!E{data_first}:AUREA!E{data_last})"
+        apply_style(dash["A3"], "bold")
+        apply_style(dash["B3"], "bold_money")
+
+        dash["A5"] = "Servicio"
+        dash["B5"] = "Total"
+        style_header_row(dash, 5, 1, 2)
+
+        for i in range(len(servicios_default)):
+            r = 6 + i
+            dash[f"A{r}"] = servicios_default[i]
+            dash[f"B{r}"] = f'=SUMIF(AUREA!A{data_first}:AUREA!A{data_last},"{servicios_default[i]}",AUREA!E{data_first}:AUREA!E{data_last})'
+            apply_style(dash[f"A{r}"], "boxed")
+            apply_style(dash[f"B{r}"], "boxed_money")
+
+        bar = BarChart()
+        bar.title = "Total por servicio"
+        bar.height = 10
+        bar.width = 20
+        cats = Reference(dash, min_col=1, min_row=6, max_row=6 + len(servicios_default) - 1)
+        vals = Reference(dash, min_col=2, min_row=5, max_row=6 + len(servicios_default) - 1)
+        bar.add_data(vals, titles_from_data=True)
+        bar.set_categories(cats)
+        bar.legend = None
+        dash.add_chart(bar, "A12")
+
+    return wb, layout
+
+
+# ============================================================
+# Build determinista: el timestamp del build (B2, core.xml y fechas de las
+# entradas zip) sale de un solo lugar => mismo payload + mismo timestamp
+# = mismos bytes.
+# ============================================================
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+BUILD_DETERMINISTIC = os.getenv("AUREA_DETERMINISTIC", "0") == "1"
+BUILD_TIMESTAMP = os.getenv("AUREA_BUILD_TIMESTAMP", "2000-01-01 00:00:00")
+
+
+def _parse_timestamp(v):
+    """'YYYY-MM-DD HH:MM:SS' o ISO 8601 (con T / Z / offset) => str TS_FORMAT, o None."""
+    if not isinstance(v, str) or not v.strip():
+        return None
+    try:
+        ts = datetime.fromisoformat(v.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return ts.replace(tzinfo=None).strftime(TS_FORMAT)
+
+
+def build_timestamp(payload: dict):
+    """
+    Regresa (now, deterministic).
+    timestamp/generatedAt del payload => se usa tal cual (determinista).
+    Modo determinista (AUREA_DETERMINISTIC=1 o payload.deterministic) => BUILD_TIMESTAMP.
+    Si no, la hora actual.
+    """
+    ts = _parse_timestamp(payload.get("timestamp") or payload.get("generatedAt"))
+    if ts:
+        return ts, True
+    if BUILD_DETERMINISTIC or payload.get("deterministic") is True:
+        return _parse_timestamp(BUILD_TIMESTAMP) or "2000-01-01 00:00:00", True
+    return _now_str(), False
+
+
+class _StampedZipFile(zipfile.ZipFile):
+    """ZipFile de escritura cuyas entradas llevan la fecha del build (no la del reloj ni la de archivos temporales)."""
+
+    def __init__(self, file, now: str, patches=None):
+        super().__init__(file, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        # {arcname: fn(data) => data}: partes que se reescriben al momento de escribirlas
+        self.patches = dict(patches or {})
+        # el formato zip no representa fechas antes de 1980
+        self.date_time = max(datetime.strptime(now, TS_FORMAT), datetime(1980, 1, 1)).timetuple()[:6]
+
+    def _info(self, name: str) -> zipfile.ZipInfo:
+        zinfo = zipfile.ZipInfo(name, self.date_time)
+        zinfo.compress_type = self.compression
+        zinfo.external_attr = 0o600 << 16
+        return zinfo
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        if isinstance(zinfo_or_arcname, str):
+            zinfo_or_arcname = self._info(zinfo_or_arcname)
+        patch = self.patches.get(zinfo_or_arcname.filename)
+        if patch is not None:
+            data = patch(data)
+        super().writestr(zinfo_or_arcname, data, compress_type, compresslevel)
+
+    def open(self, name, mode="r", pwd=None, *, force_zip64=False):
+        if mode == "w" and isinstance(name, str):
+            name = self._info(name)
+        return super().open(name, mode, pwd, force_zip64=force_zip64)
+
+    def write(self, filename, arcname=None, compress_type=None, compresslevel=None):
+        # openpyxl write-only agrega cada hoja desde su archivo temporal
+        arcname = arcname or os.path.basename(filename)
+        if arcname in self.patches:
+            with open(filename, "rb") as src:
+                return self.writestr(arcname, src.read())
+        force = os.path.getsize(filename) > zipfile.ZIP64_LIMIT
+        with open(filename, "rb") as src, self.open(arcname, "w", force_zip64=force) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def _save_workbook(wb, out, now: str, patches=None):
+    """wb.save(out) con las fechas del build en core.xml y en las entradas del zip."""
+    wb.properties.created = wb.properties.modified = datetime.strptime(now, TS_FORMAT)
+    if wb.write_only and not wb.worksheets:
+        wb.create_sheet()
+    with _StampedZipFile(out, now, patches) as archive:
+        ExcelWriter(wb, archive).save()
+
+
+# ============================================================
+# Skeleton cache
+# La plantilla se construye y serializa UNA vez por proceso; cada request
+# solo reescribe las filas prellenadas y el timestamp de la hoja AUREA.
+# La llave incluye las listas del ledger (cambian con las categorías de los
+# rows) => LRU acotado; los XML templates del engine XML usan el mismo tope.
+# ============================================================
+SKELETON_CACHE_SIZE = max(1, int(os.getenv("AUREA_SKELETON_CACHE", "32")))
+SKELETON_STATS = {"hits": 0, "misses": 0}
+_SKELETONS = OrderedDict()
+_SKELETON_LOCK = threading.Lock()
+
+_ROW_RE = re.compile(r'<row r="(\d+)"')
+# celda vacía: "<c ... />" (et_xmlfile) o "<c ...></c>" (lxml)
+_TS_CELL_RE = re.compile(r'<c r="B2" s="(\d+)" t="n"\s*(?:/>|></c>)')
+_CORE_DATES_RE = re.compile(r"(<dcterms:(?:created|modified) [^>]*>)[^<]*(</dcterms:(?:created|modified)>)")
+
+
+def _xml_cell(ref: str, style_id: str, value) -> str:
+    """Serializa una celda igual que openpyxl (inlineStr, t="n", <f> para fórmulas)."""
+    if value is None or value == "":
+        return f'<c r="{ref}" s="{style_id}" t="n" />'
+    if isinstance(value, bool):
+        return f'<c r="{ref}" s="{style_id}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, NUMERIC_TYPES):
+        return f'<c r="{ref}" s="{style_id}" t="n"><v>{safe_string(value)}</v></c>'
+    if isinstance(value, datetime):
+        return f'<c r="{ref}" s="{style_id}" t="n"><v>{safe_string(to_excel(value))}</v></c>'
+    if not isinstance(value, str):
+        raise ValueError(f"Cannot convert {value!r} to Excel")
+    if value.startswith("=") and len(value) > 1:
+        return f'<c r="{ref}" s="{style_id}"><f>{xml_escape(value[1:])}</f><v /></c>'
+    if value in ERROR_CODES:
+        return f'<c r="{ref}" s="{style_id}" t="e"><v>{value}</v></c>'
+    text = ILLEGAL_CHARACTERS_RE.sub("", value)[:32767]
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    return f'<c r="{ref}" s="{style_id}" t="inlineStr"><is><t{space}>{xml_escape(text)}</t></is></c>'
+
+
+class _Skeleton:
+    """
+    Partes zip serializadas de una plantilla. La hoja AUREA se guarda
+    partida en head (hasta la 1a fila de datos) / body (resto de la hoja).
+    """
+
+    def __init__(self, template: str, capacity: int = 0, formulas: str = DASH_CLASSIC,
+                 lists: LedgerLists = LEDGER_DEFAULT_LISTS):
+        wb, layout = build_template_workbook(template, capacity, formulas=formulas, lists=lists)
+        bio = BytesIO()
+        wb.save(bio)
+
+        self.template = template
+        self.data_first = layout["data_first"]
+        self.data_last = layout["data_last"]
+        self.prefill = layout["prefill"]
+        self.style_ids = layout["style_ids"]
+
+        with zipfile.ZipFile(bio) as z:
+            self.parts = [(i.filename, z.read(i.filename)) for i in z.infolist()]
+
+        self.sheet_path = "xl/worksheets/sheet1.xml"
+        sheet = dict(self.parts)[self.sheet_path].decode("utf-8")
+
+        first = next((m.start() for m in _ROW_RE.finditer(sheet) if int(m.group(1)) >= self.data_first), None)
+        if first is None:
+            first = sheet.index("</sheetData>")
+        head, self.body = sheet[:first], sheet[first:]
+
+        m = _TS_CELL_RE.search(head)
+        self.head_pre, self.ts_style, self.head_post = head[:m.start()], m.group(1), head[m.end():]
+
+        # filas ya materializadas dentro del rango de datos (ej. fórmulas de servicios):
+        # al prellenar n filas, el body sigue desde la primera con r >= data_first + n
+        self.row_numbers, self.row_offsets = [], []
+        region_end = self.body.index("</sheetData>")
+        for m in _ROW_RE.finditer(self.body):
+            r = int(m.group(1))
+            if r > self.data_last:
+                region_end = m.start()
+                break
+            self.row_numbers.append(r)
+            self.row_offsets.append(m.start())
+        self.row_offsets.append(region_end)
+
+    def fill(self, out, rows, now: str, patches=None):
+        """Escribe el xlsx en out: cualquier archivo escribible, seekable o no."""
+        with _StampedZipFile(out, now, patches) as z:
+            for name, data in self.parts:
+                if name == self.sheet_path:
+                    data = self._sheet_xml(rows, now).encode("utf-8")
+                elif name == "docProps/core.xml":
+                    iso = now.replace(" ", "T") + "Z"
+                    data = _CORE_DATES_RE.sub(lambda m: m.group(1) + iso + m.group(2), data.decode("utf-8")).encode("utf-8")
+                z.writestr(name, data)
+
+    def _sheet_xml(self, rows, now: str) -> str:
+        chunks = [self.head_pre, _xml_cell("B2", self.ts_style, now), self.head_post]
+        letters = [get_column_letter(c) for c in range(1, len(self.style_ids) + 1)]
+
+        n = 0
+        for values in rows[:self.prefill]:
+            r = self.data_first + n
+            chunks.append(f'<row r="{r}">')
+            chunks.extend(_xml_cell(f"{L}{r}", s, v) for L, s, v in zip(letters, self.style_ids, values))
+            chunks.append("</row>")
+            n += 1
+
+        k = bisect_left(self.row_numbers, self.data_first + n)
+        chunks.append(self.body[self.row_offsets[k]:])
+        return "".join(chunks)
+
+
+def get_skeleton(template: str, capacity: int = 0, formulas: str = DASH_CLASSIC,
+                 lists: LedgerLists = LEDGER_DEFAULT_LISTS) -> _Skeleton:
+    key = (template, capacity, formulas, lists)
+    with _SKELETON_LOCK:
+        skel = _SKELETONS.get(key)
+        if skel is None:
+            SKELETON_STATS["misses"] += 1
+            skel = _SKELETONS[key] = _Skeleton(*key)
+            while len(_SKELETONS) > SKELETON_CACHE_SIZE:
+                _SKELETONS.popitem(last=False)
+        else:
+            _SKELETONS.move_to_end(key)
+            SKELETON_STATS["hits"] += 1
+    return skel
+
+
+# ============================================================
+# Streaming engine (openpyxl write-only) para ledgers grandes
+# Las filas van directo al XML temporal de cada hoja => memoria plana.
+# ============================================================
+EXCEL_MAX_ROWS = 1048576
+STREAM_ROW_THRESHOLD = int(os.getenv("AUREA_STREAM_THRESHOLD", "5000"))
+# título + Generado + headers + totals row = 4 filas fijas por hoja
+STREAM_ROWS_PER_SHEET = int(os.getenv("AUREA_STREAM_ROWS_PER_SHEET", str(EXCEL_MAX_ROWS - 4)))
+
+
+# add_table en write-only avisa aunque las columnas ya vengan definidas (_add_ledger_table)
+warnings.filterwarnings("ignore", message="In write-only mode you must add table columns manually")
+
+
+def _styled_cells(ws, values, styles):
+    cells = []
+    for v, style in zip(values, styles):
+        cell = WriteOnlyCell(ws, v)
+        apply_style(cell, style)
+        cells.append(cell)
+    return cells
+
+
+def _open_stream_sheet(wb, title: str, now: str):
+    """Hoja de datos write-only con el mismo encabezado que AUREA (filas 1-3)."""
+    ws = wb.create_sheet(title)
+    ws.sheet_view.showGridLines = True
+    ws.freeze_panes = "A4"
+    set_col_widths(ws, LEDGER_WIDTHS)
+    for c, style in enumerate(LEDGER_STYLES, start=1):
+        apply_column_style(ws, get_column_letter(c), style)
+    ws.merged_cells.add("A1:F1")
+
+    ws.append(_styled_cells(ws, ["AUREA 33 • AUREA"], ["title"]))
+    ws.append(_styled_cells(ws, ["Generado:", now], ["meta_label", "meta_value"]))
+    ws.append(_styled_cells(ws, LEDGER_HEADERS, ["header"] * 6))
+    return ws
+
+
+def _replay_sheet(src, dst):
+    """
+    Copia una hoja normal ya construida (Dashboard, _lists) a una hoja
+    write-only: valores, estilos, merges, anchos, CF, validaciones y charts.
+    """
+    dst.sheet_state = src.sheet_state
+    dst.sheet_view.showGridLines = src.sheet_view.showGridLines
+    dst.freeze_panes = src.freeze_panes
+    for key, dim in src.column_dimensions.items():
+        if dim.width:
+            dst.column_dimensions[key].width = dim.width
+    for rng in src.merged_cells.ranges:
+        dst.merged_cells.add(rng.coord)
+    for cf in src.conditional_formatting:
+        for rule in cf.rules:
+            dst.conditional_formatting.add(str(cf.sqref), rule)
+    for dv in src.data_validations.dataValidation:
+        dst.data_validations.append(dv)
+    for chart in src._charts:
+        dst.add_chart(chart, chart.anchor)
+
+    for row in src.iter_rows():
+        out = []
+        for cell in row:
+            if isinstance(cell, MergedCell):
+                out.append(None)
+                continue
+            wc = WriteOnlyCell(dst, cell.value)
+            if cell.has_style:
+                wc.font = copy(cell.font)
+                wc.fill = copy(cell.fill)
+                wc.border = copy(cell.border)
+                wc.alignment = copy(cell.alignment)
+                wc.number_format = cell.number_format
+            out.append(wc)
+        dst.append(out)
+
+
+def build_ledger_streaming(out, values, now: str, formulas: str = DASH_CLASSIC):
+    """
+    Ledger completo en modo write-only.
+    values: iterable de tuplas de 6 columnas (ver normalize_ledger_rows); se consume una vez.
+    tbl_data se dimensiona a los datos reales; al llegar al límite de filas de
+    Excel se continúa en "AUREA (2)", "AUREA (3)"... con tbl_data_2, tbl_data_3...
+    """
+    wb = Workbook(write_only=True)
+
+    ws = _open_stream_sheet(wb, "AUREA", now)
+    dash = wb.create_sheet("Dashboard")
+    lists = wb.create_sheet("_lists")
+
+    # sheet_lists: listas vistas al llenarse cada hoja (sus validaciones; igual que el engine XML)
+    data_sheets, counts, sheet_lists = [ws], [0], []
+    cells = _styled_cells(ws, [None] * 6, LEDGER_STYLES)
+    summary = LedgerSummary()
+    with phase("rows"):
+        for row in summary.track(values):
+            if counts[-1] == STREAM_ROWS_PER_SHEET:
+                ws = _open_stream_sheet(wb, f"AUREA ({len(data_sheets) + 1})", now)
+                wb.move_sheet(ws.title, offset=-2)  # antes de Dashboard y _lists
+                data_sheets.append(ws)
+                counts.append(0)
+                cells = _styled_cells(ws, [None] * 6, LEDGER_STYLES)
+            for cell, v in zip(cells, row):
+                cell.value = v
+            ws.append(cells)
+            counts[-1] += 1
+            if counts[-1] == STREAM_ROWS_PER_SHEET:
+                sheet_lists.append(summary.lists())
+
+    final_lists = summary.lists()
+    sheet_lists += [final_lists] * (len(data_sheets) - len(sheet_lists))
+    header_row, data_first = 3, 4
+    tables = []
+    for i, (ws, n) in enumerate(zip(data_sheets, counts)):
+        if n == 0:
+            # una tabla necesita al menos 1 fila de datos
+            ws.append(_styled_cells(ws, [None] * 6, LEDGER_STYLES))
+            n = 1
+        data_last = data_first + n - 1
+        ws.append(_styled_cells(ws, [None] * 6, ["header"] * 4 + ["header_money"] * 2))
+
+        name = "tbl_data" if i == 0 else f"tbl_data_{i + 1}"
+        _add_ledger_validations(ws, *ledger_list_ranges(sheet_lists[i]), data_first, data_last)
+        _add_ledger_table(ws, name, header_row, data_last + 1)
+        _add_ledger_quality_rules(ws, data_first, data_last)
+        tables.append(name)
+
+    with phase("dashboard"):
+        # Dashboard y _lists son chicas: se construyen normal y se copian al final
+        scratch = Workbook()
+        lists_src = scratch.active
+        lists_src.title = "_lists"
+        lists_src.sheet_state = "hidden"
+        _build_ledger_lists(lists_src, final_lists)
+        dash_src = scratch.create_sheet("Dashboard")
+        dash_src.freeze_panes = "A4"
+        _build_ledger_dashboard(dash_src, tables, final_lists.categories, formulas)
+
+        _replay_sheet(dash_src, dash)
+        _replay_sheet(lists_src, lists)
+
+    with phase("save"):
+        _save_workbook(wb, out, now, {dashboard_path(len(data_sheets)): dashboard_patch(summary, 0, formulas)})
+
+
+# ============================================================
+# Engine XML directo: escribe las partes del xlsx desde fragmentos
+# precompilados, sin el modelo de objetos de openpyxl por request.
+# styles, theme, Dashboard, _lists, drawing y charts se compilan UNA vez
+# desde la misma plantilla (build_template_workbook) => ambos engines
+# comparten definición. La hoja AUREA, tbl_data, workbook y core se
+# escriben por request, con las filas en streaming directo al zip.
+# ============================================================
+ENGINE_OPENPYXL = "openpyxl"
+ENGINE_XML = "xml"
+EXCEL_ENGINES = (ENGINE_OPENPYXL, ENGINE_XML)
+EXCEL_ENGINE = os.getenv("AUREA_EXCEL_ENGINE", ENGINE_OPENPYXL)
+if EXCEL_ENGINE not in EXCEL_ENGINES:
+    EXCEL_ENGINE = ENGINE_OPENPYXL
+
+# chunks de filas acumulados antes de escribir al zip
+XML_FLUSH_CHUNKS = 8192
+
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG = "http://schemas.openxmlformats.org/package/2006/relationships"
+_CT_OFFICE = "application/vnd.openxmlformats-officedocument."
+
+_CONTENT_TYPES = [
+    ("xl/workbook.xml", "spreadsheetml.sheet.main+xml"),
+    ("xl/worksheets/", "spreadsheetml.worksheet+xml"),
+    ("xl/tables/", "spreadsheetml.table+xml"),
+    ("xl/drawings/drawing", "drawing+xml"),
+    ("xl/charts/", "drawingml.chart+xml"),
+    ("xl/styles.xml", "spreadsheetml.styles+xml"),
+    ("xl/theme/", "theme+xml"),
+    ("docProps/app.xml", "extended-properties+xml"),
+]
+
+_CORE_XML = (
+    '<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+    'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"><dc:creator>openpyxl</dc:creator>'
+    '<dcterms:created xsi:type="dcterms:W3CDTF">{iso}</dcterms:created>'
+    '<dcterms:modified xsi:type="dcterms:W3CDTF">{iso}</dcterms:modified></cp:coreProperties>'
+)
+
+_ROOT_RELS = (
+    f'<Relationships xmlns="{_NS_PKG}">'
+    f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml" />'
+    f'<Relationship Id="rId2" Type="{_NS_PKG}/metadata/core-properties" Target="docProps/core.xml" />'
+    f'<Relationship Id="rId3" Type="{_NS_REL}/extended-properties" Target="docProps/app.xml" />'
+    '</Relationships>'
+)
+
+_LEDGER_SHEET_VIEW = (
+    '<sheetPr><outlinePr summaryBelow="1" summaryRight="1" /><pageSetUpPr /></sheetPr>'
+    '<sheetViews><sheetView showGridLines="1" workbookViewId="0">'
+    '<pane ySplit="3" topLeftCell="A4" activePane="bottomLeft" state="frozen" />'
+    '<selection pane="bottomLeft" activeCell="A1" sqref="A1" /></sheetView></sheetViews>'
+    '<sheetFormatPr baseColWidth="8" defaultRowHeight="15" />'
+)
+
+_LEDGER_SHEET_TAIL = (
+    '</sheetData><mergeCells count="1"><mergeCell ref="A1:F1" /></mergeCells>'
+    '<conditionalFormatting sqref="C{first}:C{last}"><cfRule type="expression" priority="1" dxfId="0">'
+    '<formula>=AND($C{first}="",OR($E{first}&gt;0,$F{first}&gt;0))</formula></cfRule></conditionalFormatting>'
+    '<conditionalFormatting sqref="E{first}:F{last}"><cfRule type="expression" priority="2" dxfId="0">'
+    '<formula>=AND($E{first}&gt;0,$F{first}&gt;0)</formula></cfRule></conditionalFormatting>'
+    '<dataValidations count="2">'
+    '<dataValidation type="list" allowBlank="1" showDropDown="0" showInputMessage="0" showErrorMessage="0" '
+    'error="Elige un valor del listado." prompt="Selecciona forma de pago" sqref="D{first}:D{last}">'
+    '<formula1>={pay_range}</formula1></dataValidation>'
+    '<dataValidation type="list" allowBlank="1" showDropDown="0" showInputMessage="0" showErrorMessage="0" '
+    'error="Elige una categoría del listado." prompt="Selecciona categoría" sqref="C{first}:C{last}">'
+    '<formula1>={cat_range}</formula1></dataValidation></dataValidations>'
+    '<pageMargins left="0.75" right="0.75" top="1" bottom="1" header="0.5" footer="0.5" />'
+    f'<tableParts count="1"><tablePart xmlns:r="{_NS_REL}" r:id="rId1" /></tableParts></worksheet>'
+)
+
+_LEDGER_TABLE = (
+    f'<table xmlns="{_NS_MAIN}" id="{{id}}" name="{{name}}" displayName="{{name}}" ref="A{{header}}:F{{total}}" '
+    'headerRowCount="1" totalsRowCount="1"><tableColumns count="6">{columns}</tableColumns>'
+    '<tableStyleInfo name="TableStyleMedium9" showFirstColumn="0" showLastColumn="0" '
+    'showRowStripes="1" showColumnStripes="0" /></table>'
+).replace("{columns}", "".join(
+    f'<tableColumn id="{i}" name="{xml_escape(h)}"'
+    + (' totalsRowFunction="sum"' if h in ("Ingreso", "Egreso") else "")
+    + " />"
+    for i, h in enumerate(LEDGER_HEADERS, start=1)
+))
+
+
+def _xml_rels(targets) -> str:
+    """targets: [(tipo, ruta)] => rId1, rId2..."""
+    rels = "".join(
+        f'<Relationship Id="rId{i}" Type="{_NS_REL}/{kind}" Target="{target}" />'
+        for i, (kind, target) in enumerate(targets, start=1)
+    )
+    return f'<Relationships xmlns="{_NS_PKG}">{rels}</Relationships>'
+
+
+def _xml_content_types(names) -> str:
+    overrides = []
+    for name in names:
+        for prefix, ct in _CONTENT_TYPES:
+            if name.startswith(prefix) and name.endswith(".xml"):
+                overrides.append(f'<Override PartName="/{name}" ContentType="{_CT_OFFICE}{ct}" />')
+                break
+    overrides.append('<Override PartName="/docProps/core.xml" '
+                     'ContentType="application/vnd.openxmlformats-package.core-properties+xml" />')
+    return (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml" />'
+        '<Default Extension="xml" ContentType="application/xml" />'
+        + "".join(overrides) + "</Types>"
+    )
+
+
+class _XmlTemplate:
+    """
+    Fragmentos precompilados de una plantilla para el engine XML.
+    tables: tablas de datos que suma el Dashboard (cambia solo con hojas de continuación).
+    lists: _lists y categorías del Dashboard; la hoja de datos no depende de
+    ellas (sus validaciones se arman al cerrarla, ver write_ledger_sheet).
+    """
+
+    def __init__(self, template: str, tables=("tbl_data",), formulas: str = DASH_CLASSIC,
+                 lists: LedgerLists = LEDGER_DEFAULT_LISTS):
+        wb, layout = build_template_workbook(template, 1, tables, formulas, lists)
+        self.template = template
+        self.data_first = layout["data_first"]
+
+        if template == TEMPLATE_LEDGER:
+            ws = wb["AUREA"]
+            names = ["title", "meta_label", "meta_value", "header", "header_money"]
+            ids = dict(zip(names, _style_ids(ws, names)))
+            self.style_ids = layout["style_ids"]
+            self.letters = [get_column_letter(c) for c in range(1, len(self.style_ids) + 1)]
+
+            cols = "".join(
+                f'<col min="{c}" max="{c}" width="{LEDGER_WIDTHS[L]}" customWidth="1" style="{s}" />'
+                for c, (L, s) in enumerate(zip(self.letters, self.style_ids), start=1)
+            )
+            self.head = (
+                f'<worksheet xmlns="{_NS_MAIN}">{_LEDGER_SHEET_VIEW}<cols>{cols}</cols><sheetData>'
+                f'<row r="1">{_xml_cell("A1", ids["title"], "AUREA 33 • AUREA")}</row>'
+                f'<row r="2">{_xml_cell("A2", ids["meta_label"], "Generado:")}'
+            )
+            self.ts_style = ids["meta_value"]
+            self.headers_row = (
+                '</row><row r="3">'
+                + "".join(_xml_cell(f"{L}3", ids["header"], h) for L, h in zip(self.letters, LEDGER_HEADERS))
+                + "</row>"
+            )
+            self.total_ids = [ids["header"]] * 4 + [ids["header_money"]] * 2
+
+        bio = BytesIO()
+        wb.save(bio)
+        with zipfile.ZipFile(bio) as z:
+            parts = {i.filename: z.read(i.filename) for i in z.infolist()}
+
+        if template == TEMPLATE_SERVICES:
+            # AUREA fija (300 filas con fórmula): solo cambia el timestamp
+            sheet = parts["xl/worksheets/sheet1.xml"].decode("utf-8")
+            m = _TS_CELL_RE.search(sheet)
+            self.sheet_pre, self.ts_style, self.sheet_post = sheet[:m.start()], m.group(1), sheet[m.end():]
+
+        # partes estáticas; Dashboard y _lists se renumeran tras las hojas de datos
+        self.dash = parts["xl/worksheets/sheet2.xml"]
+        self.dash_rels = parts["xl/worksheets/_rels/sheet2.xml.rels"]
+        self.lists = parts["xl/worksheets/sheet3.xml"]
+        skip = ("[Content_Types].xml", "_rels/.rels", "docProps/core.xml", "xl/workbook.xml", "xl/_rels/workbook.xml.rels")
+        self.static = [
+            (name, data) for name, data in parts.items()
+            if name not in skip and not name.startswith(("xl/worksheets/", "xl/tables/"))
+        ]
+
+    def write_ledger_sheet(self, z, index: int, rows, now: str, capacity: int, force_zip64: bool,
+                           lists=lambda: LEDGER_DEFAULT_LISTS) -> int:
+        """
+        Hoja de datos sheet{index}.xml + table{index}.xml. Regresa el número de filas escritas.
+        lists: callable => LedgerLists de las validaciones, evaluado ya consumidos los rows.
+        """
+        first = self.data_first
+        name = "tbl_data" if index == 1 else f"tbl_data_{index}"
+        cells = list(zip(self.letters, self.style_ids))
+
+        with z.open(f"xl/worksheets/sheet{index}.xml", "w", force_zip64=force_zip64) as fh:
+            buf = [self.head, _xml_cell("B2", self.ts_style, now), self.headers_row]
+            r = first - 1
+            for values in rows:
+                r += 1
+                buf.append(f'<row r="{r}">')
+                buf.extend(_xml_cell(f"{L}{r}", s, v) for (L, s), v in zip(cells, values))
+                buf.append("</row>")
+                if len(buf) >= XML_FLUSH_CHUNKS:
+                    fh.write("".join(buf).encode("utf-8"))
+                    buf.clear()
+
+            n = r - first + 1
+            last = first + max(n, capacity, 1) - 1
+            total = last + 1
+            buf.append(f'<row r="{total}">')
+            buf.extend(_xml_cell(f"{L}{total}", s, None) for L, s in zip(self.letters, self.total_ids))
+            buf.append("</row>")
+            pay_range, cat_range = ledger_list_ranges(lists())
+            buf.append(_LEDGER_SHEET_TAIL.format(
+                first=first, last=last, pay_range=pay_range, cat_range=cat_range,
+            ))
+            fh.write("".join(buf).encode("utf-8"))
+
+        z.writestr(f"xl/worksheets/_rels/sheet{index}.xml.rels",
+                   _xml_rels([("table", f"/xl/tables/table{index}.xml")]))
+        z.writestr(f"xl/tables/table{index}.xml",
+                   _LEDGER_TABLE.format(id=index, name=name, header=first - 1, total=total))
+        return n
+
+    def write_package(self, z, data_sheets, now: str):
+        """Todo lo demás: Dashboard, _lists, partes estáticas, workbook, rels, content types y core."""
+        n = len(data_sheets)
+        dash_path = f"xl/worksheets/sheet{n + 1}.xml"
+        lists_path = f"xl/worksheets/sheet{n + 2}.xml"
+        z.writestr(dash_path, self.dash)
+        z.writestr(f"xl/worksheets/_rels/sheet{n + 1}.xml.rels", self.dash_rels)
+        z.writestr(lists_path, self.lists)
+        for name, data in self.static:
+            z.writestr(name, data)
+
+        titles = [(t, "visible") for t in data_sheets] + [("Dashboard", "visible"), ("_lists", "hidden")]
+        sheets = "".join(
+            f'<sheet name="{xml_escape(t)}" sheetId="{i}" state="{state}" r:id="rId{i}" />'
+            for i, (t, state) in enumerate(titles, start=1)
+        )
+        z.writestr("xl/workbook.xml", (
+            f'<workbook xmlns:r="{_NS_REL}" xmlns="{_NS_MAIN}"><workbookPr />'
+            '<bookViews><workbookView activeTab="0" /></bookViews>'
+            f'<sheets>{sheets}</sheets><calcPr calcId="124519" fullCalcOnLoad="1" /></workbook>'
+        ))
+        z.writestr("xl/_rels/workbook.xml.rels", _xml_rels(
+            [("worksheet", f"/xl/worksheets/sheet{i}.xml") for i in range(1, len(titles) + 1)]
+            + [("styles", "styles.xml"), ("theme", "theme/theme1.xml")]
+        ))
+        z.writestr("docProps/core.xml", _CORE_XML.format(iso=now.replace(" ", "T") + "Z"))
+        z.writestr("_rels/.rels", _ROOT_RELS)
+        z.writestr("[Content_Types].xml", _xml_content_types(z.namelist()))
+
+
+_XML_TEMPLATES = OrderedDict()
+_XML_TEMPLATE_LOCK = threading.Lock()
+
+
+def get_xml_template(template: str, tables=("tbl_data",), formulas: str = DASH_CLASSIC,
+                     lists: LedgerLists = LEDGER_DEFAULT_LISTS) -> _XmlTemplate:
+    key = (template, tuple(tables), formulas, lists)
+    with _XML_TEMPLATE_LOCK:
+        tpl = _XML_TEMPLATES.get(key)
+        if tpl is None:
+            tpl = _XML_TEMPLATES[key] = _XmlTemplate(*key)
+            while len(_XML_TEMPLATES) > SKELETON_CACHE_SIZE:
+                _XML_TEMPLATES.popitem(last=False)
+        else:
+            _XML_TEMPLATES.move_to_end(key)
+    return tpl
+
+
+def build_ledger_xml(out, values, now: str, capacity: int = 0, formulas: str = DASH_CLASSIC):
+    """
+    Ledger con el engine XML.
+    values: iterable de tuplas de 6 columnas (ver normalize_ledger_rows); se consume una vez.
+    capacity: filas mínimas de tbl_data (ver ledger_capacity); 0 => a la medida de los datos.
+    Mismas reglas de continuación que build_ledger_streaming ("AUREA (2)", tbl_data_2...).
+    """
+    with phase("template"):
+        tpl = get_xml_template(TEMPLATE_LEDGER)
+    summary = LedgerSummary()
+    with _StampedZipFile(out, now) as z:
+        with phase("rows"):
+            it = iter(summary.track(values))
+            data_sheets, tables = [], []
+            head = next(it, None)
+            while True:
+                index = len(data_sheets) + 1
+                rows = chain([head], islice(it, STREAM_ROWS_PER_SHEET - 1)) if head is not None else ()
+                tpl.write_ledger_sheet(z, index, rows, now, capacity if index == 1 else 0,
+                                       force_zip64=not capacity, lists=summary.lists)
+                data_sheets.append("AUREA" if index == 1 else f"AUREA ({index})")
+                tables.append("tbl_data" if index == 1 else f"tbl_data_{index}")
+                head = next(it, None)
+                if head is None:
+                    break
+        with phase("template"):
+            package = get_xml_template(TEMPLATE_LEDGER, tables, formulas, summary.lists())
+        with phase("save"):
+            z.patches[dashboard_path(len(data_sheets))] = dashboard_patch(summary, capacity, formulas)
+            package.write_package(z, data_sheets, now)
+
+
+def build_services_xml(out, now: str):
+    tpl = get_xml_template(TEMPLATE_SERVICES)
+    with _StampedZipFile(out, now) as z:
+        z.writestr("xl/worksheets/sheet1.xml", tpl.sheet_pre + _xml_cell("B2", tpl.ts_style, now) + tpl.sheet_post)
+        tpl.write_package(z, ["AUREA"], now)
+
+
+# ============================================================
+# Spec v1.1 (el payload real del frontend: sheets / columns / kpis / charts / totals)
+# Cada spec se compila UNA vez a un plan inmutable (columnas, formatos, rangos,
+# KPIs con KPI("…") resuelto, charts) y se cachea en un LRU por hash canónico:
+# el mismo spec con otras filas solo renderiza.
+# ============================================================
+SPEC_PLAN_CACHE_SIZE = max(1, int(os.getenv("AUREA_SPEC_PLAN_CACHE", "128")))
+SPEC_PLAN_STATS = {"hits": 0, "misses": 0}
+_SPEC_PLANS = OrderedDict()
+_SPEC_PLAN_LOCK = threading.Lock()
+
+SPEC_SUMMABLE = ("currency", "number", "integer")
+SPEC_NUMERIC = SPEC_SUMMABLE + ("percent",)
+SPEC_PAYMENT_KEYS = {"pago", "metodo_pago", "metodopago", "forma_pago", "formapago", "payment", "payment_method"}
+SPEC_DEFAULT_COLUMNS = [
+    {"header": h, "key": k, "type": t, "width": LEDGER_WIDTHS[L]}
+    for h, k, t, L in zip(
+        LEDGER_HEADERS,
+        ["fecha", "concepto", "categoria", "pago", "ingreso", "egreso"],
+        ["date", "text", "text", "text", "currency", "currency"],
+        "ABCDEF",
+    )
+]
+SPEC_CHARTS = {"bar": BarChart, "col": BarChart, "column": BarChart, "pie": PieChart, "line": LineChart}
+
+_KPI_REF_RE = re.compile(r'KPI\(\s*"([^"]*)"\s*\)', re.IGNORECASE)
+# Hoja!E:E (columna completa) => se reescribe a la columna #Data de la tabla
+_COLUMN_REF_RE = re.compile(r"(?:'((?:[^']|'')+)'|([A-Za-z_][\w.]*))!\$?([A-Z]{1,3}):\$?([A-Z]{1,3})\b")
+
+SpecColumn = namedtuple("SpecColumn", "key header type width lookup style total_style computed validation")
+SpecDataSheet = namedtuple("SpecDataSheet", "name table columns totals freeze")
+SpecKpi = namedtuple("SpecKpi", "label formula style")
+SpecChart = namedtuple("SpecChart", "kind title source cat_col value_cols anchor")
+SpecDashboard = namedtuple("SpecDashboard", "name kpis charts")
+SpecPlan = namedtuple("SpecPlan", "title sheets")
+
+
+def _spec_list(x) -> list:
+    return x if isinstance(x, list) else []
+
+
+def _spec_unique(name: str, used: set, limit: int = 0) -> str:
+    base, n = name, 1
+    while name.lower() in used:
+        n += 1
+        suffix = f" ({n})"
+        name = (base[:limit - len(suffix)] if limit else base) + suffix
+    used.add(name.lower())
+    return name
+
+
+def _spec_sheet_name(name, fallback: str, used: set) -> str:
+    name = re.sub(r"[\[\]:*?/\\]", "", str(name or "")).strip().strip("'")[:31] or fallback
+    return _spec_unique(name, used, 31)
+
+
+def _spec_table_name(name, fallback: str, used: set) -> str:
+    name = re.sub(r"\W", "", re.sub(r"\s+", "_", str(name or ""))) or fallback
+    if not re.match(r"[A-Za-z_]", name):
+        name = f"tbl_{name}"
+    base, n = name[:50], 1
+    name = base
+    while name.lower() in used:
+        n += 1
+        name = f"{base}_{n}"
+    used.add(name.lower())
+    return name
+
+
+def _spec_header(header, fallback: str, used: set) -> str:
+    # sin [ ] # ' => se puede usar tal cual dentro de structured refs
+    h = re.sub(r"\s+", " ", str(header or "")).strip()
+    h = re.sub(r"[\[\]#'\"]", "", h)[:255] or fallback
+    return _spec_unique(h, used)
+
+
+def _spec_type_style(prefix: str, col_type: str) -> str:
+    if col_type == "currency":
+        return f"{prefix}_money"
+    return f"{prefix}_{col_type}" if f"{prefix}_{col_type}" in STYLES else prefix
+
+
+def _spec_formula(formula) -> str:
+    s = str(formula or "").strip()
+    if not s:
+        return ""
+    s = s[1:] if s.startswith("=") else s
+    return "=" + s if s.upper().startswith("IFERROR(") else f"=IFERROR({s},0)"
+
+
+def _spec_validation(col: dict, key: str):
+    """(type, formula1, formula2, error) o None. Pago sin validación => listado default."""
+    v = col.get("validation")
+    if not isinstance(v, dict):
+        if key.lower() in SPEC_PAYMENT_KEYS or "pago" in key.lower():
+            v = {"type": "list", "values": LEDGER_PAYMENTS}
+        else:
+            return None
+    vtype = str(v.get("type") or "").lower()
+    if vtype == "list":
+        values = [str(x).replace('"', "") for x in _spec_list(v.get("values")) if x is not None]
+        if values:
+            return ("list", '"' + ",".join(values) + '"', None, "Selecciona un valor de la lista.")
+    elif vtype == "number":
+        lo = v.get("min") if isinstance(v.get("min"), (int, float)) else 0
+        hi = v.get("max") if isinstance(v.get("max"), (int, float)) else 999999999
+        return ("decimal", str(lo), str(hi), "Ingresa un número dentro del rango permitido.")
+    elif vtype == "date":
+        return ("date", "DATE(2000,1,1)", "DATE(2100,12,31)", "Ingresa una fecha válida.")
+    return None
+
+
+def _compile_data_sheet(s: dict, name: str, table: str) -> SpecDataSheet:
+    data = s.get("data") if isinstance(s.get("data"), dict) else s
+    raw_cols = [c for c in _spec_list(data.get("columns")) if isinstance(c, dict)] or SPEC_DEFAULT_COLUMNS
+
+    totals = data.get("totals") if isinstance(data.get("totals"), dict) else {}
+    mode = str(totals.get("mode") or ("general" if totals.get("enabled", True) else "none")).lower()
+
+    used_headers, used_keys, columns = set(), set(), []
+    for i, c in enumerate(raw_cols, start=1):
+        key = str(c.get("key") or c.get("header") or f"col_{i}").strip()
+        used_keys.add(key.lower())
+        header = _spec_header(c.get("header") or key, f"Col {i}", used_headers)
+        col_type = str(c.get("type") or "text").lower()
+        width = c.get("width") if isinstance(c.get("width"), (int, float)) and c.get("width") > 0 else 18
+        lookup = tuple(dict.fromkeys(k for k in (c.get("key"), c.get("header"), header) if k))
+        columns.append(SpecColumn(
+            key, header, col_type, width, lookup,
+            _spec_type_style("data", col_type),
+            _spec_type_style("header", col_type) if col_type in SPEC_SUMMABLE else "header",
+            None, _spec_validation(c, key),
+        ))
+
+    if mode == "row_col":
+        wanted = {str(k) for k in _spec_list(totals.get("currencyCols"))}
+        letters = [
+            get_column_letter(i) for i, c in enumerate(columns, start=1)
+            if c.key.lower() != "total" and (c.key in wanted if wanted else c.type == "currency")
+        ]
+        if letters:
+            computed = "=SUM(" + ",".join(L + "{r}" for L in letters) + ")"
+            total_idx = next((i for i, c in enumerate(columns) if c.key.lower() == "total"), None)
+            if total_idx is None:
+                header = _spec_header("Total", "Total", used_headers)
+                columns.append(SpecColumn("total", header, "currency", 14, (), "data_money", "header_money", computed, None))
+            else:
+                columns[total_idx] = columns[total_idx]._replace(computed=computed, validation=None)
+
+    header_style = s.get("style", {}).get("header", {}) if isinstance(s.get("style"), dict) else {}
+    freeze = header_style.get("freeze", True) if isinstance(header_style, dict) else True
+    return SpecDataSheet(name, table, tuple(columns), mode in ("general", "row_col"), bool(freeze))
+
+
+def _spec_row(columns, item: dict) -> tuple:
+    out = []
+    for c in columns:
+        if c.computed:
+            out.append(None)
+            continue
+        v = next((item[k] for k in c.lookup if item.get(k) not in (None, "")), None)
+        if c.type in SPEC_NUMERIC:
+            v = _as_number(v)
+        elif c.type == "date" and isinstance(v, str):
+            v = _parse_date(v) or v
+        out.append(_text(v))
+    return tuple(out)
+
+
+def _spec_column_refs(formula: str, data_sheets: dict) -> str:
+    """Hoja!E:E => tabla[[#Data],[Header]] (no suma encabezado ni totals row)."""
+    def repl(m):
+        sheet = (m.group(1) or "").replace("''", "'") or m.group(2)
+        ds = data_sheets.get(sheet.lower())
+        if ds is None or m.group(3) != m.group(4):
+            return m.group(0)
+        idx = column_index_from_string(m.group(3)) - 1
+        if idx >= len(ds.columns):
+            return m.group(0)
+        return f"{ds.table}[[#Data],[{ds.columns[idx].header}]]"
+    return _COLUMN_REF_RE.sub(repl, formula)
+
+
+def compile_spec(spec: dict) -> SpecPlan:
+    """Interpreta un spec v1.1 (o v1.0 con workbook.sheets) y regresa su SpecPlan."""
+    wb_spec = spec.get("workbook") if isinstance(spec.get("workbook"), dict) else {}
+    raw = [s for s in (_spec_list(spec.get("sheets")) or _spec_list(wb_spec.get("sheets"))) if isinstance(s, dict)]
+
+    def kind(s):
+        k = str(s.get("kind") or "").lower()
+        return k or ("dashboard" if s.get("name") == "Dashboard" else "data")
+
+    if not any(kind(s) == "data" for s in raw):
+        raw.insert(0, {"name": "AUREA", "kind": "data"})
+    if not any(kind(s) == "dashboard" for s in raw) and _spec_list(spec.get("kpis")):
+        raw.append({"name": "Dashboard", "kind": "dashboard"})
+
+    used_sheets, used_tables = set(), set()
+    named, data_sheets = [], {}
+    for s in raw:
+        k = kind(s)
+        if k not in ("data", "dashboard"):
+            continue
+        name = _spec_sheet_name(s.get("name"), "AUREA" if k == "data" else "Dashboard", used_sheets)
+        named.append((k, name, s))
+        if k == "data":
+            fallback = "tbl_data" if not data_sheets else f"tbl_{name}"
+            table = _spec_table_name(s.get("tableName") or fallback, "tbl_data", used_tables)
+            ds = _compile_data_sheet(s, name, table)
+            data_sheets[name.lower()] = ds
+            if s.get("name"):
+                data_sheets.setdefault(str(s["name"]).lower(), ds)
+
+    # KPIs: posición fija (A=label, B=valor desde fila 4) => KPI("x") se resuelve a su celda
+    kpi_cells, dash_kpis = {}, {}
+    for k, name, s in named:
+        if k != "dashboard":
+            continue
+        kpis = [x for x in (_spec_list(s.get("kpis")) or _spec_list(spec.get("kpis"))) if isinstance(x, dict)]
+        dash_kpis[name] = kpis
+        for i, kpi in enumerate(kpis):
+            label = str(kpi.get("label") or f"KPI {i + 1}")
+            kpi_cells.setdefault(label.lower(), (name, f"B{4 + i}"))
+
+    sheets = []
+    for k, name, s in named:
+        if k == "data":
+            sheets.append(data_sheets[name.lower()])
+            continue
+
+        def resolve(m, here=name):
+            target = kpi_cells.get(m.group(1).lower())
+            if target is None:
+                raise ValueError(f'spec: KPI("{m.group(1)}") no existe en el spec')
+            sheet, cell = target
+            return cell if sheet == here else f"{quote_sheetname(sheet)}!{cell}"
+
+        kpis = []
+        for i, kpi in enumerate(dash_kpis[name]):
+            formula = _spec_column_refs(str(kpi.get("formula") or ""), data_sheets)
+            formula = _KPI_REF_RE.sub(resolve, formula)
+            fmt = str(kpi.get("format") or "").lower()
+            kpis.append(SpecKpi(str(kpi.get("label") or f"KPI {i + 1}"), _spec_formula(formula), _spec_type_style("kpi", fmt)))
+
+        charts = []
+        for i, ch in enumerate(c for c in _spec_list(s.get("charts")) if isinstance(c, dict)):
+            chart_kind = str(ch.get("type") or "bar").lower()
+            if chart_kind not in SPEC_CHARTS:
+                continue
+            src = data_sheets.get(str(ch.get("from") or "").lower())
+            if src is None and not kpis:
+                src = next(iter(data_sheets.values()))
+            anchor = f"D{3 + i * 20}"
+            if src is None:
+                # chart de los KPIs del propio dashboard
+                charts.append(SpecChart(chart_kind, str(ch.get("title") or ""), None, 1, (2,), anchor))
+                continue
+            cat_col = next((j for j, c in enumerate(src.columns, start=1) if c.type == "text"), 1)
+            values = tuple(j for j, c in enumerate(src.columns, start=1) if c.type in SPEC_SUMMABLE and not c.computed)
+            if values:
+                charts.append(SpecChart(chart_kind, str(ch.get("title") or ""), src.name, cat_col, values, anchor))
+
+        sheets.append(SpecDashboard(name, tuple(kpis), tuple(charts)))
+
+    return SpecPlan(str(wb_spec.get("title") or "AUREA Excel"), tuple(sheets))
+
+
+def spec_plan_key(spec: dict) -> str:
+    canon = json.dumps(spec, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+def get_spec_plan(spec: dict) -> SpecPlan:
+    key = spec_plan_key(spec)
+    with _SPEC_PLAN_LOCK:
+        plan = _SPEC_PLANS.get(key)
+        if plan is not None:
+            _SPEC_PLANS.move_to_end(key)
+            SPEC_PLAN_STATS["hits"] += 1
+            return plan
+    plan = compile_spec(spec)
+    with _SPEC_PLAN_LOCK:
+        SPEC_PLAN_STATS["misses"] += 1
+        _SPEC_PLANS[key] = plan
+        while len(_SPEC_PLANS) > SPEC_PLAN_CACHE_SIZE:
+            _SPEC_PLANS.popitem(last=False)
+    return plan
+
+
+def _spec_total_values(ds: SpecDataSheet) -> list:
+    """Totals row: SUBTOTAL(109) en columnas sumables y "TOTAL" en la 1a columna."""
+    return [
+        f"=SUBTOTAL(109,{ds.table}[{c.header}])" if c.type in SPEC_SUMMABLE else ("TOTAL" if i == 1 else None)
+        for i, c in enumerate(ds.columns, start=1)
+    ]
+
+
+def _add_spec_table(ws, ds: SpecDataSheet, header_row: int, data_first: int, data_last: int):
+    """Validaciones por columna + la tabla (con totals row si el spec la pide)."""
+    last_letter = get_column_letter(len(ds.columns))
+    for i, c in enumerate(ds.columns, start=1):
+        L = get_column_letter(i)
+        if c.validation:
+            vtype, f1, f2, error = c.validation
+            dv = DataValidation(type=vtype, formula1=f1, formula2=f2, allow_blank=True,
+                                operator="between" if f2 else None, showErrorMessage=True, error=error)
+            dv.add(f"{L}{data_first}:{L}{data_last}")
+            ws.data_validations.append(dv)
+
+    tab = Table(displayName=ds.table, ref=f"A{header_row}:{last_letter}{data_last + int(ds.totals)}")
+    tab.tableColumns = [TableColumn(id=i, name=c.header) for i, c in enumerate(ds.columns, start=1)]
+    if ds.totals:
+        for i, (c, tc) in enumerate(zip(ds.columns, tab.tableColumns), start=1):
+            if c.type in SPEC_SUMMABLE:
+                tc.totalsRowFunction = "sum"
+            elif i == 1:
+                tc.totalsRowLabel = "TOTAL"
+        tab.totalsRowCount = 1
+    tab.tableStyleInfo = TableStyleInfo(name="TableStyleMedium9", showFirstColumn=False, showLastColumn=False,
+                                        showRowStripes=True, showColumnStripes=False)
+    ws.add_table(tab)
+
+
+def _render_spec_data(ws, ds: SpecDataSheet, rows, now: str) -> int:
+    """Hoja de datos del plan: encabezado AUREA + tabla. Regresa la última fila de datos."""
+    last_letter = get_column_letter(len(ds.columns))
+    ws.sheet_view.showGridLines = True
+    if ds.freeze:
+        ws.freeze_panes = "A4"
+
+    ws["A1"] = f"AUREA 33 • {ds.name}"
+    style_title(ws["A1"])
+    if len(ds.columns) > 1:
+        ws.merge_cells(f"A1:{last_letter}1")
+    ws["A2"] = "Generado:"
+    ws["B2"] = now
+    apply_style(ws["A2"], "meta_label")
+    apply_style(ws["B2"], "meta_value")
+
+    header_row, data_first = 3, 4
+    for i, c in enumerate(ds.columns, start=1):
+        L = get_column_letter(i)
+        ws.cell(row=header_row, column=i, value=c.header)
+        apply_style(ws.cell(row=header_row, column=i), "header")
+        ws.column_dimensions[L].width = c.width
+        apply_column_style(ws, L, c.style)
+
+    r = data_first - 1
+    for values in rows:
+        r += 1
+        for i, (c, v) in enumerate(zip(ds.columns, values), start=1):
+            cell = ws.cell(row=r, column=i, value=c.computed.format(r=r) if c.computed else v)
+            apply_style(cell, c.style)
+    data_last = max(r, data_first)
+
+    if ds.totals:
+        for i, (c, v) in enumerate(zip(ds.columns, _spec_total_values(ds)), start=1):
+            cell = ws.cell(row=data_last + 1, column=i, value=v)
+            apply_style(cell, c.total_style)
+    _add_spec_table(ws, ds, header_row, data_first, data_last)
+    return data_last
+
+
+def _render_spec_data_streaming(ws, ds: SpecDataSheet, rows, now: str) -> int:
+    """
+    Igual que _render_spec_data pero sobre una hoja write-only: las filas se
+    agregan en orden con WriteOnlyCell reutilizadas (sin apply_style por celda).
+    """
+    ws.sheet_view.showGridLines = True
+    if ds.freeze:
+        ws.freeze_panes = "A4"
+    for i, c in enumerate(ds.columns, start=1):
+        L = get_column_letter(i)
+        ws.column_dimensions[L].width = c.width
+        apply_column_style(ws, L, c.style)
+    if len(ds.columns) > 1:
+        ws.merged_cells.add(f"A1:{get_column_letter(len(ds.columns))}1")
+
+    ws.append(_styled_cells(ws, [f"AUREA 33 • {ds.name}"], ["title"]))
+    ws.append(_styled_cells(ws, ["Generado:", now], ["meta_label", "meta_value"]))
+    ws.append(_styled_cells(ws, [c.header for c in ds.columns], ["header"] * len(ds.columns)))
+
+    header_row, data_first = 3, 4
+    styles = [c.style for c in ds.columns]
+    computed = [(cell_i, c.computed) for cell_i, c in enumerate(ds.columns) if c.computed]
+    cells = _styled_cells(ws, [None] * len(ds.columns), styles)
+    r = data_first - 1
+    for values in rows:
+        r += 1
+        if r - header_row > STREAM_ROWS_PER_SHEET:
+            raise ValueError(f"spec: máximo {STREAM_ROWS_PER_SHEET} filas en la hoja {ds.name}")
+        for cell, v in zip(cells, values):
+            cell.value = v
+        for cell_i, formula in computed:
+            cells[cell_i].value = formula.format(r=r)
+        ws.append(cells)
+    if r < data_first:
+        # una tabla necesita al menos 1 fila de datos
+        ws.append(_styled_cells(ws, [None] * len(ds.columns), styles))
+    data_last = max(r, data_first)
+
+    if ds.totals:
+        ws.append(_styled_cells(ws, _spec_total_values(ds), [c.total_style for c in ds.columns]))
+    _add_spec_table(ws, ds, header_row, data_first, data_last)
+    return data_last
+
+
+def _render_spec_dashboard(wb, dash, plan_dash: SpecDashboard, data_last: dict):
+    dash.sheet_view.showGridLines = True
+    dash.freeze_panes = "A4"
+    dash["A1"] = f"AUREA 33 • {plan_dash.name}"
+    style_title(dash["A1"])
+    dash.merge_cells("A1:F1")
+
+    dash["A3"] = "KPI"
+    dash["B3"] = "Valor"
+    style_header_row(dash, 3, 1, 2)
+    for i, kpi in enumerate(plan_dash.kpis):
+        r = 4 + i
+        dash[f"A{r}"] = kpi.label
+        dash[f"B{r}"] = kpi.formula or None
+        apply_style(dash[f"A{r}"], "kpi")
+        apply_style(dash[f"B{r}"], kpi.style)
+    set_col_widths(dash, {"A": 24, "B": 18})
+
+    for ch in plan_dash.charts:
+        chart = SPEC_CHARTS[ch.kind]()
+        if ch.title:
+            chart.title = ch.title
+        chart.height = 9
+        chart.width = 18
+        if ch.source is None:
+            src, first, last = dash, 4, 3 + len(plan_dash.kpis)
+        else:
+            src, first, last = wb[ch.source], 4, data_last[ch.source]
+        for col in ch.value_cols[:1] if ch.kind == "pie" else ch.value_cols:
+            chart.add_data(Reference(src, min_col=col, min_row=first - 1, max_row=last), titles_from_data=True)
+        chart.set_categories(Reference(src, min_col=ch.cat_col, min_row=first, max_row=last))
+        dash.add_chart(chart, ch.anchor)
+
+
+def _spec_data_rows(plan: SpecPlan, rows):
+    """
+    Filas por hoja de datos: las del payload van a la 1a hoja; el resto queda
+    con la tabla vacía. Las exampleRows del spec NO se escriben como datos
+    (entrarían a totales, KPIs y charts del Dashboard como si fueran reales).
+    """
+    first = True
+    for s in plan.sheets:
+        if isinstance(s, SpecDataSheet):
+            values = ()
+            if first and rows:
+                values = (_spec_row(s.columns, item) for item in rows if isinstance(item, dict))
+            first = False
+            yield s, values
+
+
+def render_spec(out, plan: SpecPlan, rows, now: str):
+    """Renderiza un SpecPlan. rows: filas del payload (dicts) para la 1a hoja de datos."""
+    wb = Workbook()
+    wb.remove(wb.active)
+    wb.properties.title = plan.title
+
+    sheets = {s.name: wb.create_sheet(s.name) for s in plan.sheets}
+    data_last = {}
+    with phase("rows"):
+        for s, values in _spec_data_rows(plan, rows):
+            data_last[s.name] = _render_spec_data(sheets[s.name], s, values, now)
+    with phase("dashboard"):
+        for s in plan.sheets:
+            if isinstance(s, SpecDashboard):
+                _render_spec_dashboard(wb, sheets[s.name], s, data_last)
+
+    with phase("save"):
+        _save_workbook(wb, out, now)
+
+
+def render_spec_streaming(out, plan: SpecPlan, rows, now: str):
+    """
+    SpecPlan en modo write-only (specs con muchas filas o rows por ingesta).
+    Los Dashboards son chicos: se construyen normal y se copian al final.
+    """
+    wb = Workbook(write_only=True)
+    wb.properties.title = plan.title
+
+    sheets = {s.name: wb.create_sheet(s.name) for s in plan.sheets}
+    data_last = {}
+    with phase("rows"):
+        for s, values in _spec_data_rows(plan, rows):
+            data_last[s.name] = _render_spec_data_streaming(sheets[s.name], s, values, now)
+    with phase("dashboard"):
+        scratch = Workbook()
+        for s in plan.sheets:
+            if isinstance(s, SpecDashboard):
+                dash_src = scratch.create_sheet(s.name)
+                _render_spec_dashboard(wb, dash_src, s, data_last)
+                _replay_sheet(dash_src, sheets[s.name])
+
+    with phase("save"):
+        _save_workbook(wb, out, now)
+
+
+# ============================================================
+# Ingesta por streaming: rows como CSV o NDJSON (multipart o body crudo).
+# Se parsean línea por línea y van directo al writer (un dict a la vez);
+# los errores por línea se cuentan y los primeros se reportan en headers.
+# ============================================================
+INGEST_CSV = "csv"
+INGEST_NDJSON = "ndjson"
+INGEST_MIMETYPES = {
+    "text/csv": INGEST_CSV,
+    "application/csv": INGEST_CSV,
+    "application/x-ndjson": INGEST_NDJSON,
+    "application/ndjson": INGEST_NDJSON,
+    "application/jsonl": INGEST_NDJSON,
+    "application/x-jsonlines": INGEST_NDJSON,
+}
+INGEST_EXTENSIONS = {".csv": INGEST_CSV, ".tsv": INGEST_CSV, ".ndjson": INGEST_NDJSON, ".jsonl": INGEST_NDJSON}
+INGEST_MAX_ERRORS = int(os.getenv("AUREA_INGEST_MAX_ERRORS", "20"))
+# columnas numéricas del ledger con sus alias
+INGEST_NUMERIC_KEYS = LEDGER_ALIASES[4] + LEDGER_ALIASES[5]
+
+
+class RowIngest:
+    """
+    Iterable de una sola pasada sobre los rows de un stream binario CSV/NDJSON.
+    Entrega dicts con las llaves tal cual (los alias los resuelve normalize_ledger_rows /
+    _spec_row) y acumula rows, error_count y errors [(línea, mensaje), ...].
+    """
+
+    def __init__(self, stream, fmt: str, encoding: str = "utf-8-sig"):
+        self.stream = stream
+        self.format = fmt
+        self.encoding = encoding
+        self.rows = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < INGEST_MAX_ERRORS:
+            self.errors.append((line, message))
+
+    def __iter__(self):
+        parse = self._csv if self.format == INGEST_CSV else self._ndjson
+        try:
+            for line, item in parse():
+                yield self._check(line, item)
+        except RequestEntityTooLarge:
+            # body chunked más grande que MAX_CONTENT_LENGTH
+            raise payload_too_large()
+
+    def _check(self, line: int, item: dict) -> dict:
+        check_ingest_row(item, self.rows, line)
+        for key in INGEST_NUMERIC_KEYS:
+            v = item.get(key)
+            if v and _parse_number(v) is None:
+                self.error(line, f"{key} no numérico: {str(v)[:40]!r}")
+        self.rows += 1
+        return item
+
+    def _text_lines(self):
+        return TextIOWrapper(self.stream, encoding=self.encoding, errors="replace", newline="")
+
+    def _csv(self):
+        text = self._text_lines()
+        head = text.readline()
+        if not head.strip():
+            return
+        # separador del encabezado: los estados de cuenta suelen venir con ; o tab
+        delimiter = max(",;\t|", key=head.count)
+        reader = csv.reader(chain([head], text), delimiter=delimiter)
+        header = [h.strip() for h in next(reader)]
+        for values in reader:
+            if not any(v.strip() for v in values):
+                continue
+            if len(values) > len(header):
+                self.error(reader.line_num, f"{len(values)} columnas, el encabezado tiene {len(header)}")
+            yield reader.line_num, dict(zip(header, values))
+
+    def _ndjson(self):
+        for line, raw in enumerate(self._text_lines(), 1):
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                item = json.loads(raw)
+            except ValueError as e:
+                self.error(line, f"JSON inválido: {e.msg}")
+                continue
+            if not isinstance(item, dict):
+                self.error(line, "se esperaba un objeto JSON")
+                continue
+            yield line, item
+
+
+def ingest_format(mimetype: str, filename: str = "", fmt: str = ""):
+    """Formato de ingesta por campo explícito, extensión o mimetype; None => no es ingesta."""
+    fmt = (fmt or "").lower()
+    if fmt in (INGEST_CSV, INGEST_NDJSON):
+        return fmt
+    ext = os.path.splitext(filename or "")[1].lower()
+    return INGEST_EXTENSIONS.get(ext) or INGEST_MIMETYPES.get((mimetype or "").lower())
+
+
+def ingest_headers(resp, ingest: RowIngest):
+    resp.headers["X-AUREA-Rows"] = str(ingest.rows)
+    resp.headers["X-AUREA-Row-Errors"] = str(ingest.error_count)
+    if ingest.errors:
+        # ensure_ascii: los headers HTTP son latin-1
+        resp.headers["X-AUREA-Row-Error-Detail"] = json.dumps(ingest.errors, separators=(",", ":"))
+    return resp
+
+
+def write_excel(payload: dict, out):
+    """
+    Genera el xlsx del payload directo en out (cualquier archivo escribible).
+    Si out no es seekable el zip sale con data descriptors => apto para streaming.
+    """
+    payload = _to_dict(payload)
+
+    rows = payload.get("rows")
+    ingest = isinstance(rows, RowIngest)
+    rows = rows if isinstance(rows, list) or ingest else []
+    now, _ = build_timestamp(payload)
+
+    template = excel_template(payload)
+    if template == TEMPLATE_SPEC:
+        with phase("plan"):
+            plan = get_spec_plan(payload["spec"])
+        if ingest or len(rows) > STREAM_ROW_THRESHOLD:
+            render_spec_streaming(out, plan, rows, now)
+        else:
+            render_spec(out, plan, rows, now)
+        return
+
+    engine = payload.get("engine")
+    engine = engine if engine in EXCEL_ENGINES else EXCEL_ENGINE
+    formulas = dashboard_formulas(payload)
+
+    if engine == ENGINE_XML:
+        if template == TEMPLATE_SERVICES:
+            build_services_xml(out, now)
+        else:
+            # mismo dimensionamiento de tbl_data que el engine openpyxl
+            big = ingest or len(rows) > STREAM_ROW_THRESHOLD
+            capacity = 0 if big else ledger_capacity(sum(1 for item in rows if isinstance(item, dict)))
+            build_ledger_xml(out, normalize_ledger_rows(rows), now, capacity, formulas)
+    elif template == TEMPLATE_SERVICES:
+        with phase("template"):
+            skeleton = get_skeleton(template)
+        with phase("save"):
+            skeleton.fill(out, [], now)
+    elif ingest or len(rows) > STREAM_ROW_THRESHOLD:
+        # Ledgers grandes => write-only (sin tope de filas, memoria plana)
+        build_ledger_streaming(out, normalize_ledger_rows(rows), now, formulas)
+    else:
+        summary = LedgerSummary()
+        with phase("normalize"):
+            values = list(summary.track(normalize_ledger_rows(rows)))
+        capacity = ledger_capacity(len(values))
+        with phase("template"):
+            skeleton = get_skeleton(template, capacity, formulas, summary.lists())
+        with phase("save"):
+            patches = {dashboard_path(1): dashboard_patch(summary, capacity, formulas)}
+            skeleton.fill(out, values, now, patches)
+
+
+def excel_template(payload: dict) -> str:
+    """spec / services / ledger según el payload (ya normalizado con _to_dict)."""
+    spec = payload.get("spec")
+    if isinstance(spec, dict) and (spec.get("sheets") or _to_dict(spec.get("workbook")).get("sheets")):
+        return TEMPLATE_SPEC
+    prompt = str(payload.get("prompt") or payload.get("text") or "")
+    return TEMPLATE_SERVICES if _looks_like_services_template(prompt) else TEMPLATE_LEDGER
+
+
+def excel_filename(payload: dict) -> str:
+    return _safe_filename(payload.get("fileName") or payload.get("filename") or "AUREA_excel.xlsx")
+
+
+def build_excel(payload: dict) -> BytesIO:
+    payload = _to_dict(payload)
     bio = BytesIO()
-    wb.save(bio)
+    write_excel(payload, bio)
     bio.seek(0)
-    bio.name = file_name
+    bio.name = excel_filename(payload)
     return bio
 
 
+# ============================================================
+# Validación del payload: PAYLOAD_SCHEMA (declarativo) se compila una vez al
+# importar en closures con los límites ya ligados => un payload malo se
+# rechaza con el campo que falla antes de tocar openpyxl, en vez de un 500
+# excel_build_failed a media construcción. Falla rápido: el primer error
+# corta la validación. Solo forma y tamaños: los alias y la tolerancia de
+# normalize_ledger_rows / compile_spec no cambian.
+# null equivale a campo ausente (el código usa `payload.get(...) or ...`).
+# ============================================================
+# body más grande => 413 por Content-Length, sin leerlo ni parsearlo
+PAYLOAD_MAX_BYTES = int(float(os.getenv("AUREA_PAYLOAD_MAX_MB", "256")) * 1024 * 1024)
+PAYLOAD_MAX_ROWS = int(os.getenv("AUREA_PAYLOAD_MAX_ROWS", "2000000"))
+PAYLOAD_MAX_STRING = int(os.getenv("AUREA_PAYLOAD_MAX_STRING", "32767"))  # tope de Excel por celda
+PAYLOAD_MAX_PROMPT = int(os.getenv("AUREA_PAYLOAD_MAX_PROMPT", "20000"))
+PAYLOAD_MAX_ROW_KEYS = int(os.getenv("AUREA_PAYLOAD_MAX_ROW_KEYS", "64"))
+PAYLOAD_MAX_SPEC_NODES = int(os.getenv("AUREA_PAYLOAD_MAX_SPEC_NODES", "20000"))
+PAYLOAD_STATS = {"valid": 0, "rejected": 0}
+
+PAYLOAD_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "fileName": {"type": "string", "maxLength": 255},
+        "filename": {"type": "string", "maxLength": 255},
+        "prompt": {"type": "string", "maxLength": PAYLOAD_MAX_PROMPT},
+        "text": {"type": "string", "maxLength": PAYLOAD_MAX_PROMPT},
+        "rows": {
+            "type": "array",
+            "maxItems": PAYLOAD_MAX_ROWS,
+            "items": {
+                "type": "object",
+                "maxProperties": PAYLOAD_MAX_ROW_KEYS,
+                "values": {"type": "scalar", "maxLength": PAYLOAD_MAX_STRING},
+            },
+        },
+        "spec": {
+            "type": "object",
+            "maxNodes": PAYLOAD_MAX_SPEC_NODES,
+            "maxLength": PAYLOAD_MAX_STRING,
+            "properties": {
+                "workbook": {"type": "object"},
+                "sheets": {"type": "array", "maxItems": 64, "items": {"type": "object"}},
+                "kpis": {"type": "array", "maxItems": 256, "items": {"type": "object"}},
+            },
+        },
+    },
+}
+
+# códigos de error por tamaño => 413; los demás (tipo) => 400
+PAYLOAD_LIMIT_CODES = frozenset(("max_bytes", "max_length", "max_items", "max_properties", "max_nodes"))
+_SCALAR_CLASSES = frozenset((str, int, float, bool, type(None)))
+_TYPE_NAMES = {"object": "un objeto", "array": "un arreglo", "string": "texto",
+               "scalar": "un valor escalar (texto, número, booleano o null)"}
+
+
+class PayloadError(ValueError):
+    def __init__(self, errors: list):
+        first = errors[0]
+        super().__init__(f"payload_invalid: {first['path'] or 'body'}: {first['message']}")
+        self.errors = errors
+        self.status = 413 if any(e["code"] in PAYLOAD_LIMIT_CODES for e in errors) else 400
+
+
+def _schema_error(code: str, message: str) -> tuple:
+    # (subpath, código, mensaje); el path completo se arma solo al fallar
+    return "", code, message
+
+
+def _prefixed(prefix: str, error: tuple) -> tuple:
+    return (prefix + error[0],) + error[1:]
+
+
+def compile_schema(node: dict):
+    """Nodo de schema => check(value) que regresa None o el primer error (subpath, código, mensaje)."""
+    kind = node["type"]
+    type_error = _schema_error("type", f"se esperaba {_TYPE_NAMES[kind]}")
+    max_length = node.get("maxLength")
+
+    if kind == "string":
+        def check(value):
+            if value.__class__ is not str:
+                return type_error
+            if max_length is not None and len(value) > max_length:
+                return _schema_error("max_length", f"máximo {max_length} caracteres")
+            return None
+        return check
+
+    if kind == "scalar":
+        too_long = _schema_error("max_length", f"máximo {max_length} caracteres")
+
+        def check(value):
+            cls = value.__class__
+            if cls is str:
+                return too_long if len(value) > max_length else None
+            return None if cls in _SCALAR_CLASSES else type_error
+        check.scalar_max_length = max_length
+        return check
+
+    if kind == "array":
+        max_items = node.get("maxItems")
+        item = compile_schema(node["items"]) if "items" in node else None
+
+        def check(value):
+            if value.__class__ is not list:
+                return type_error
+            if max_items is not None and len(value) > max_items:
+                return _schema_error("max_items", f"máximo {max_items} elementos (llegaron {len(value)})")
+            if item is not None:
+                for i, v in enumerate(value):
+                    e = item(v)
+                    if e:
+                        return _prefixed(f"[{i}]", e)
+            return None
+        return check
+
+    if kind == "object":
+        props = tuple((k, compile_schema(sub)) for k, sub in node.get("properties", {}).items())
+        values = compile_schema(node["values"]) if "values" in node else None
+        max_props = node.get("maxProperties")
+        max_nodes = node.get("maxNodes")
+
+        # valores escalares (celdas de rows): inline, sin una llamada por valor
+        scalar_max = getattr(values, "scalar_max_length", None)
+        scalar_classes = _SCALAR_CLASSES - {str}
+
+        def check(value):
+            if value.__class__ is not dict:
+                return type_error
+            if max_props is not None and len(value) > max_props:
+                return _schema_error("max_properties", f"máximo {max_props} campos")
+            for key, sub in props:
+                v = value.get(key)
+                if v is not None:
+                    e = sub(v)
+                    if e:
+                        return _prefixed(f".{key}", e)
+            if scalar_max is not None:
+                for v in value.values():
+                    cls = v.__class__
+                    if cls is str:
+                        if len(v) > scalar_max:
+                            break
+                    elif cls not in scalar_classes:
+                        break
+                else:
+                    return None
+            if values is not None:
+                for key, v in value.items():
+                    e = values(v)
+                    if e:
+                        return _prefixed(f".{key}", e)
+            if max_nodes is not None:
+                return _schema_walk(value, max_nodes, max_length)
+            return None
+        return check
+
+    raise ValueError(f"schema: tipo desconocido {kind!r}")
+
+
+def _schema_walk(value, max_nodes: int, max_length):
+    """Tope de nodos y de largo de textos en todo un subárbol (p. ej. el spec)."""
+    stack, n = [value], 0
+    while stack:
+        v = stack.pop()
+        n += 1
+        if n > max_nodes:
+            return _schema_error("max_nodes", f"máximo {max_nodes} nodos")
+        cls = v.__class__
+        if cls is dict:
+            stack.extend(v.values())
+        elif cls is list:
+            stack.extend(v)
+        elif cls is str and max_length is not None and len(v) > max_length:
+            return _schema_error("max_length", f"máximo {max_length} caracteres por texto")
+    return None
+
+
+_PAYLOAD_CHECK = compile_schema(PAYLOAD_SCHEMA)
+
+
+def validate_payload(payload: dict) -> dict:
+    """Regresa el payload si cumple PAYLOAD_SCHEMA; si no, PayloadError con los errores por campo."""
+    error = _PAYLOAD_CHECK(payload)
+    if error is None:
+        PAYLOAD_STATS["valid"] += 1
+        return payload
+    PAYLOAD_STATS["rejected"] += 1
+    path, code, message = error
+    raise PayloadError([{"path": path.lstrip("."), "code": code, "message": message}])
+
+
+def payload_too_large(length=None) -> PayloadError:
+    PAYLOAD_STATS["rejected"] += 1
+    got = f" (llegaron {length} bytes)" if length else ""
+    return PayloadError([{"path": "", "code": "max_bytes",
+                          "message": f"máximo {PAYLOAD_MAX_BYTES // (1024 * 1024)} MB{got}"}])
+
+
+def check_content_length(length):
+    """PayloadError (413) si el body declarado pasa PAYLOAD_MAX_BYTES."""
+    if length and length > PAYLOAD_MAX_BYTES:
+        raise payload_too_large(length)
+
+
+# sin Content-Length (chunked) el tope lo aplica Werkzeug al leer el body:
+# RequestEntityTooLarge => payload_too_large() en cada ruta
+app.config["MAX_CONTENT_LENGTH"] = PAYLOAD_MAX_BYTES
+
+
+def request_json():
+    """
+    Body JSON del request (None si viene vacío). PayloadError: 400 si no es
+    JSON válido, 413 si pasa PAYLOAD_MAX_BYTES (también sin Content-Length).
+    """
+    try:
+        data = request.get_data(cache=True)
+    except RequestEntityTooLarge:
+        raise payload_too_large()
+    # chunked: Werkzeug corta en MAX_CONTENT_LENGTH sin error al leerlo todo de una vez
+    if request.content_length is None and len(data) >= PAYLOAD_MAX_BYTES:
+        raise payload_too_large()
+    payload = request.get_json(silent=True)
+    if payload is None and data:
+        raise PayloadError([{"path": "", "code": "json", "message": "el body no es JSON válido"}])
+    return payload
+
+
+_PAYLOAD_ROW_CHECK = compile_schema(PAYLOAD_SCHEMA["properties"]["rows"]["items"])
+
+
+def check_ingest_row(item: dict, index: int, line: int):
+    """Mismos topes que rows[] del JSON (filas, campos, largo de celda) para un row de CSV/NDJSON."""
+    if index >= PAYLOAD_MAX_ROWS:
+        PAYLOAD_STATS["rejected"] += 1
+        raise PayloadError([{"path": "rows", "code": "max_items", "message": f"máximo {PAYLOAD_MAX_ROWS} filas"}])
+    error = _PAYLOAD_ROW_CHECK(item)
+    if error is not None:
+        PAYLOAD_STATS["rejected"] += 1
+        path, code, message = error
+        raise PayloadError([{"path": f"rows[{index}]{path}", "code": code, "message": f"línea {line}: {message}"}])
+
+
+def _payload_error_response(e: PayloadError):
+    return _cors(jsonify({"ok": False, "error": str(e), "errors": e.errors})), e.status
+
+
+# ============================================================
+# Cache de salida (content-addressed): xlsx terminados por hash del payload
+# normalizado, LRU acotado en bytes. El mismo hash es el ETag.
+# Solo se cachean builds deterministas: sin timestamp fijo cada build lleva
+# su propio "Generado", así que no se sirven bytes de otro build (el ETag
+# es débil, W/"...", y solo sirve para revalidar con 304).
+# ============================================================
+OUTPUT_CACHE_MAX_BYTES = int(float(os.getenv("AUREA_OUTPUT_CACHE_MB", "64")) * 1024 * 1024)
+OUTPUT_CACHE_STATS = {"hits": 0, "misses": 0, "entries": 0, "bytes": 0}
+_OUTPUT_CACHE = OrderedDict()
+_OUTPUT_CACHE_LOCK = threading.Lock()
+
+# campos del payload que no cambian los bytes del xlsx
+_OUTPUT_KEY_IGNORED = ("fileName", "filename", "timestamp", "generatedAt", "deterministic")
+
+
+def output_cache_key(payload: dict):
+    """Regresa (key, deterministic) para el payload ya normalizado con _to_dict."""
+    norm = {k: v for k, v in payload.items() if k not in _OUTPUT_KEY_IGNORED}
+    engine = norm.get("engine")
+    norm["engine"] = engine if engine in EXCEL_ENGINES else EXCEL_ENGINE
+    norm["dashboardFormulas"] = dashboard_formulas(payload)
+    now, deterministic = build_timestamp(payload)
+    if deterministic:
+        norm["timestamp"] = now
+    canon = json.dumps(norm, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest(), deterministic
+
+
+def output_cache_get(key: str):
+    with _OUTPUT_CACHE_LOCK:
+        data = _OUTPUT_CACHE.get(key)
+        if data is None:
+            OUTPUT_CACHE_STATS["misses"] += 1
+        else:
+            _OUTPUT_CACHE.move_to_end(key)
+            OUTPUT_CACHE_STATS["hits"] += 1
+        return data
+
+
+def output_cache_put(key: str, data: bytes):
+    if len(data) > OUTPUT_CACHE_MAX_BYTES:
+        return
+    with _OUTPUT_CACHE_LOCK:
+        old = _OUTPUT_CACHE.pop(key, None)
+        if old is not None:
+            OUTPUT_CACHE_STATS["bytes"] -= len(old)
+        _OUTPUT_CACHE[key] = data
+        OUTPUT_CACHE_STATS["bytes"] += len(data)
+        while OUTPUT_CACHE_STATS["bytes"] > OUTPUT_CACHE_MAX_BYTES:
+            _, evicted = _OUTPUT_CACHE.popitem(last=False)
+            OUTPUT_CACHE_STATS["bytes"] -= len(evicted)
+        OUTPUT_CACHE_STATS["entries"] = len(_OUTPUT_CACHE)
+
+
+# ============================================================
+# Respuesta sin copias: el xlsx se escribe directo al destino de la respuesta.
+#   spool  => SpooledTemporaryFile (RAM hasta AUREA_SPOOL_MAX_MB, luego disco)
+#             con Content-Length exacto; los chicos además van al cache de salida.
+#   stream => el build corre en un hilo y escribe a un pipe acotado; el
+#             generador suelta chunks mientras el zip se sigue armando
+#             (primer byte antes de que termine el archivo, RSS plano).
+#   auto   => stream si rows > STREAM_ROW_THRESHOLD, si no spool.
+# ============================================================
+RESPONSE_AUTO = "auto"
+RESPONSE_SPOOL = "spool"
+RESPONSE_STREAM = "stream"
+RESPONSE_MODES = (RESPONSE_AUTO, RESPONSE_SPOOL, RESPONSE_STREAM)
+RESPONSE_MODE = os.getenv("AUREA_RESPONSE_MODE", RESPONSE_AUTO)
+RESPONSE_MODE = RESPONSE_MODE if RESPONSE_MODE in RESPONSE_MODES else RESPONSE_AUTO
+
+SPOOL_MAX_BYTES = int(float(os.getenv("AUREA_SPOOL_MAX_MB", "8")) * 1024 * 1024)
+# solo entran al cache de salida los xlsx chicos (uno grande desalojaría todo)
+OUTPUT_CACHE_ITEM_MAX = OUTPUT_CACHE_MAX_BYTES // 8
+PIPE_CHUNK_BYTES = 64 * 1024
+PIPE_MAX_CHUNKS = 16
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def response_mode(payload: dict) -> str:
+    mode = payload.get("responseMode")
+    mode = mode if mode in RESPONSE_MODES else RESPONSE_MODE
+    if mode == RESPONSE_AUTO:
+        rows = payload.get("rows")
+        big = isinstance(rows, list) and len(rows) > STREAM_ROW_THRESHOLD
+        return RESPONSE_STREAM if big else RESPONSE_SPOOL
+    return mode
+
+
+class ClientGone(Exception):
+    """El cliente cerró la conexión: el productor deja de escribir."""
+
+
+class _PipeWriter:
+    """
+    Archivo no seekable (sin tell) entre el hilo que arma el zip y el generador
+    de la respuesta. Junta escrituras chicas en chunks de PIPE_CHUNK_BYTES y la
+    cola acotada frena al productor si el cliente lee lento => memoria acotada.
+    """
+
+    _DONE = object()
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=PIPE_MAX_CHUNKS)
+        self._buf = bytearray()
+        self.abandoned = False
+        self.error = None
+
+    def _put(self, item):
+        while True:
+            if self.abandoned:
+                raise ClientGone()
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self._buf += data
+        if len(self._buf) >= PIPE_CHUNK_BYTES:
+            self._put(bytes(self._buf))
+            self._buf.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error=None):
+        self.error = error
+        if self._buf and error is None:
+            self._put(bytes(self._buf))
+        self._buf.clear()
+        self._put(self._DONE)
+
+    def chunks(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._DONE:
+                    break
+                yield item
+            if self.error is not None:
+                # los headers ya salieron: solo queda cortar el cuerpo (zip truncado)
+                app.logger.error("excel_stream_failed: %s", self.error)
+                raise self.error
+        finally:
+            self.abandoned = True
+
+
+def stream_excel(payload: dict):
+    """Generador de chunks del xlsx; el build corre en un hilo daemon."""
+    pipe = _PipeWriter()
+
+    def produce():
+        try:
+            write_excel(payload, pipe)
+        except ClientGone:
+            return
+        except Exception as e:
+            count_error("stream", e)
+            try:
+                pipe.close(e)
+            except ClientGone:
+                pass
+            return
+        try:
+            pipe.close()
+        except ClientGone:
+            pass
+
+    # el hilo hereda el contexto => phase() suma al PhaseTimer del request
+    ctx = contextvars.copy_context()
+    threading.Thread(target=ctx.run, args=(produce,), name="aurea-excel-stream", daemon=True).start()
+    return pipe.chunks()
+
+
+def spool_excel(payload: dict):
+    """Regresa (archivo posicionado en 0, tamaño)."""
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        write_excel(payload, spool)
+        size = spool.tell()
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool, size
+
+
+# ============================================================
+# Append incremental: un xlsx ya generado por este servicio + solo las filas
+# nuevas. La hoja de datos (la última AUREA / AUREA (n)) se reescribe en
+# streaming: se descomprime y se copia tal cual hasta las 2 últimas filas,
+# se insertan las filas nuevas antes de la fila de totales y se extienden
+# tbl_data, validaciones y formato condicional. Las demás partes del zip
+# (charts, estilos...) se copian byte por byte sin recomprimir.
+# El Dashboard usa referencias estructuradas => sus fórmulas cubren las filas
+# nuevas. Sus valores cacheados (<v>) se recalculan con LedgerSummary sobre
+# las filas viejas (leídas como en analyze) + las nuevas; arriba de
+# AUREA_APPEND_RECALC_ROWS filas viejas leerlas cuesta demasiado y los <v>
+# se quitan (mejor vacío que viejo; Excel recalcula con fullCalcOnLoad).
+# ============================================================
+APPEND_READ_CHUNK = 1 << 20
+APPEND_RECALC_ROWS = int(os.getenv("AUREA_APPEND_RECALC_ROWS", "5000"))
+
+_XML_TAG_ATTRS_RE = re.compile(r'([\w:]+)="([^"]*)"')
+_APPEND_ROW_RE = re.compile(rb'<row\b[^>]*?\br="(\d+)"[^>]*>(.*?)</row>', re.S)
+_APPEND_VALUE_RE = re.compile(rb"<(?:v|is|f)>")
+_APPEND_DIMENSION_RE = re.compile(rb"<dimension\b[^>]*/>")
+# sqref="..." y, en validaciones que Excel re-guarda como x14, <xm:sqref>...</xm:sqref>
+_APPEND_SQREF_RE = re.compile(rb'(sqref="|<xm:sqref>)([^"<]*)')
+_APPEND_RANGE_RE = re.compile(rb"\b([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?\b")
+_APPEND_COL_RE = re.compile(rb"<col\b[^>]*/>")
+_TABLE_REF_RE = re.compile(r'\bref="([A-Z]+)(\d+):([A-Z]+)(\d+)"')
+_SHEET_CELL_RE = re.compile(r'<c r="([A-Z]+)(\d+)"([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+_SHEET_FORMULA_RE = re.compile(r"<f\b[^>]*/>|<f\b[^>]*>.*?</f>", re.S)
+
+
+class AppendError(Exception):
+    def __init__(self, message: str, status: int = 422):
+        super().__init__(message)
+        self.status = status
+
+
+def _xml_attrs(tag: str) -> dict:
+    return dict(_XML_TAG_ATTRS_RE.findall(tag))
+
+
+def _part_target(base: str, target: str) -> str:
+    """Target de un .rels => nombre de la parte en el zip."""
+    if target.startswith("/"):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), target))
+
+
+def _rels_targets(zin, rels_path: str) -> dict:
+    try:
+        xml = zin.read(rels_path).decode("utf-8")
+    except KeyError:
+        return {}
+    return {a.get("Id"): a.get("Target", "") for a in map(_xml_attrs, re.findall(r"<Relationship\b[^>]*>", xml))}
+
+
+class _LedgerTarget(namedtuple("_LedgerTarget", "sheet table header total title column")):
+    """Hoja de datos del ledger: partes del zip, filas de encabezado/totales, nombre y primera columna de tbl_data."""
+
+
+def ledger_targets(zin, code: str = "append") -> list:
+    """
+    [_LedgerTarget] de cada hoja AUREA / AUREA (n) con su tbl_data, en orden.
+    AppendError ("<code>_...") si el xlsx no es un ledger de AUREA.
+    """
+    try:
+        workbook = zin.read("xl/workbook.xml").decode("utf-8")
+    except KeyError:
+        raise AppendError(f"{code}_invalid_workbook: falta xl/workbook.xml")
+    sheets = [_xml_attrs(tag) for tag in re.findall(r"<sheet\b[^>]*>", workbook)]
+    data = [a for a in sheets if re.fullmatch(r"AUREA(?: \(\d+\))?", a.get("name", ""))]
+    if not data:
+        raise AppendError(f"{code}_not_a_ledger: el xlsx no tiene hoja AUREA")
+
+    parts = _rels_targets(zin, "xl/_rels/workbook.xml.rels")
+    out = []
+    for attrs in data:
+        sheet = _part_target("xl/workbook.xml", parts.get(attrs.get("r:id"), ""))
+        target = _ledger_table(zin, sheet, html_unescape(attrs["name"]))
+        if target is None:
+            raise AppendError(f"{code}_not_a_ledger: la hoja {attrs['name']} no tiene el tbl_data del ledger")
+        out.append(target)
+    return out
+
+
+def _ledger_table(zin, sheet: str, title: str):
+    rels = posixpath.join(posixpath.dirname(sheet), "_rels", posixpath.basename(sheet) + ".rels")
+    for target in _rels_targets(zin, rels).values():
+        if "/tables/" not in target:
+            continue
+        table = _part_target(sheet, target)
+        xml = zin.read(table).decode("utf-8")
+        tag = re.search(r"<table\b[^>]*>", xml)
+        attrs = _xml_attrs(tag.group(0)) if tag else {}
+        columns = [html_unescape(a.get("name", "")) for a in map(_xml_attrs, re.findall(r"<tableColumn\b[^>]*>", xml))]
+        ref = _TABLE_REF_RE.search(xml)
+        if (not re.fullmatch(r"tbl_data(?:_\d+)?", attrs.get("name", "")) or columns != LEDGER_HEADERS
+                or attrs.get("totalsRowCount") != "1" or ref is None):
+            return None
+        return _LedgerTarget(sheet, table, int(ref.group(2)), int(ref.group(4)), title,
+                             column_index_from_string(ref.group(1)))
+    return None
+
+
+def dashboard_part(zin):
+    """Parte del zip de la hoja Dashboard; None si el ledger no la tiene."""
+    workbook = zin.read("xl/workbook.xml").decode("utf-8")
+    for attrs in map(_xml_attrs, re.findall(r"<sheet\b[^>]*>", workbook)):
+        if attrs.get("name") == "Dashboard":
+            rid = _rels_targets(zin, "xl/_rels/workbook.xml.rels").get(attrs.get("r:id"))
+            return _part_target("xl/workbook.xml", rid) if rid else None
+    return None
+
+
+def strip_cached_values(sheet_xml: str):
+    """
+    Quita los resultados cacheados (<v>) de las celdas con fórmula y de los
+    rangos de fórmulas de matriz. Regresa (xml, formulas): DASH_DYNAMIC si la
+    hoja tiene fórmulas de matriz (ver _build_ledger_dashboard).
+    """
+    spills = []
+    for tag in re.findall(r"<f\b[^>]*>", sheet_xml):
+        a = _xml_attrs(tag)
+        ref = _TABLE_REF_RE.search(f'ref="{a.get("ref", "")}"') if a.get("t") == "array" else None
+        if ref:
+            spills.append((column_index_from_string(ref.group(1)), int(ref.group(2)),
+                           column_index_from_string(ref.group(3)), int(ref.group(4))))
+
+    def spilled(col: str, row: int) -> bool:
+        c = column_index_from_string(col)
+        return any(c1 <= c <= c2 and r1 <= row <= r2 for c1, r1, c2, r2 in spills)
+
+    def repl(m):
+        col, row, attrs, body = m.group(1), int(m.group(2)), m.group(3), m.group(4)
+        if body is None:
+            return m.group(0)
+        f = _SHEET_FORMULA_RE.search(body)
+        if f is None and not spilled(col, row):
+            return m.group(0)
+        attrs = _CELL_TYPE_RE.sub("", attrs)
+        # misma forma que escriben los engines => fill_cached_values la reconoce
+        return f'<c r="{col}{row}"{attrs}>{f.group(0)}<v /></c>' if f else f'<c r="{col}{row}"{attrs}/>'
+
+    return _SHEET_CELL_RE.sub(repl, sheet_xml), DASH_DYNAMIC if spills else DASH_CLASSIC
+
+
+def ledger_append_target(zin) -> _LedgerTarget:
+    """Última hoja AUREA del ledger (donde van las filas nuevas)."""
+    return ledger_targets(zin)[-1]
+
+
+class _SplicedZipFile(zipfile.ZipFile):
+    """ZipFile de escritura que además copia entradas crudas (comprimidas) de otro zip."""
+
+    def __init__(self, file):
+        super().__init__(file, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def copy_raw(self, src, zinfo: zipfile.ZipInfo, length: int):
+        """Copia la entrada zinfo de src (length bytes desde su header local)."""
+        # header local + datos (+ data descriptor) tal cual: el header no guarda su offset
+        with self._lock:
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            src.seek(zinfo.header_offset)
+            zinfo = copy(zinfo)
+            zinfo.header_offset = self.fp.tell()
+            remaining = length
+            while remaining:
+                chunk = src.read(min(remaining, APPEND_READ_CHUNK))
+                if not chunk:
+                    raise AppendError("append_invalid_workbook: zip truncado")
+                self.fp.write(chunk)
+                remaining -= len(chunk)
+            self.start_dir = self.fp.tell()
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+            self._didModify = True
+
+
+def _append_columns(head: bytes) -> list:
+    """[(letra, estilo)] de las 6 columnas del ledger según los <col style> de la hoja."""
+    styles = {}
+    for tag in _APPEND_COL_RE.findall(head):
+        a = _xml_attrs(tag.decode("utf-8"))
+        for i in range(int(a.get("min", 0)), int(a.get("max", 0)) + 1):
+            styles[i] = a.get("style", "0")
+    return [(get_column_letter(i), styles.get(i, "0")) for i in range(1, len(LEDGER_HEADERS) + 1)]
+
+
+def _append_rows_xml(rows, first: int, cols: list):
+    """(filas <row> en bytes por bloques, contador) desde la fila first."""
+    buf, r = [], first - 1
+    for values in rows:
+        r += 1
+        buf.append(f'<row r="{r}">')
+        buf.extend(_xml_cell(f"{L}{r}", s, v) for (L, s), v in zip(cols, values))
+        buf.append("</row>")
+        if len(buf) >= XML_FLUSH_CHUNKS:
+            yield "".join(buf).encode("utf-8"), r
+            buf = []
+    yield "".join(buf).encode("utf-8"), r
+
+
+def _append_sqref(tail: bytes, first: int, old_last: int, new_last: int) -> bytes:
+    """Extiende los rangos first:old_last de los sqref (validaciones, formato condicional, también x14)."""
+    def token(m):
+        a, r1, b, r2 = m.group(1), int(m.group(2)), m.group(3) or m.group(1), int(m.group(4) or m.group(2))
+        if r1 != first or r2 != old_last:
+            return m.group(0)
+        return b"%s%d:%s%d" % (a, first, b, new_last)
+
+    def patch(m):
+        return m.group(1) + _APPEND_RANGE_RE.sub(token, m.group(2))
+    return _APPEND_SQREF_RE.sub(patch, tail)
+
+
+def _append_sheet(src, dst, target: _LedgerTarget, values) -> tuple:
+    """
+    Copia la hoja de src a dst (streams descomprimidos) con las filas nuevas.
+    Regresa (filas agregadas, última fila de datos nueva, fila de totales nueva).
+    """
+    first, total = target.header + 1, target.total
+    buf, head = b"", True
+    while True:
+        chunk = src.read(APPEND_READ_CHUNK)
+        buf += chunk
+        if head:
+            i = buf.find(b"<sheetData")
+            if i < 0:
+                if chunk:
+                    continue
+                raise AppendError("append_invalid_workbook: hoja sin sheetData")
+            # <dimension> es opcional; quitarla evita tener que conocer la última fila antes de escribir
+            buf = _APPEND_DIMENSION_RE.sub(b"", buf[:i], 1) + buf[i:]
+            cols = _append_columns(buf[:i])
+            head = False
+        if b"</sheetData>" in buf:
+            buf += src.read()  # lo que sigue (mergeCells, validaciones, tableParts...) es chico
+            break
+        if not chunk:
+            raise AppendError("append_invalid_workbook: hoja sin </sheetData>")
+        # se retienen las 2 últimas filas (última de datos y totales); lo anterior sale tal cual
+        last = buf.rfind(b"<row ")
+        prev = buf.rfind(b"<row ", 0, last) if last > 0 else -1
+        if prev > 0:
+            dst.write(buf[:prev])
+            buf = buf[prev:]
+
+    end = buf.index(b"</sheetData>")
+    rows = list(_APPEND_ROW_RE.finditer(buf, 0, end))
+    if not rows or int(rows[-1].group(1)) != total:
+        raise AppendError("append_invalid_workbook: la fila de totales no coincide con tbl_data")
+    totals = rows[-1]
+    cut, used = totals.start(), target.header
+    if len(rows) > 1 and int(rows[-2].group(1)) >= first:
+        prev = rows[-2]
+        if _APPEND_VALUE_RE.search(prev.group(2)):
+            used = int(prev.group(1))
+        else:
+            # fila vacía de relleno (tabla sin datos): se reemplaza
+            cut, used = prev.start(), int(prev.group(1)) - 1
+
+    dst.write(buf[:cut])
+    r = used
+    for data, r in _append_rows_xml(values, used + 1, cols):
+        dst.write(data)
+    added = r - used
+
+    last = max(total - 1, r)
+    new_total = last + 1
+    if new_total > EXCEL_MAX_ROWS:
+        raise AppendError(f"append_too_large: {added} filas nuevas no caben en la hoja (máximo {EXCEL_MAX_ROWS} filas)", 413)
+    totals_xml = buf[totals.start():totals.end()]
+    if new_total != total:
+        totals_xml = re.sub(rb'(\br="[A-Z]*)%d"' % total, rb'\g<1>%d"' % new_total, totals_xml)
+    dst.write(totals_xml)
+    tail = buf[totals.end():]
+    if last != total - 1:
+        tail = _append_sqref(tail, first, total - 1, last)
+    dst.write(tail)
+    return added, last, new_total
+
+
+def append_excel(src, values, out) -> int:
+    """
+    Agrega values (tuplas de normalize_ledger_rows) al ledger xlsx de src
+    (archivo seekable) y escribe el resultado en out (seekable).
+    Regresa el número de filas agregadas.
+    """
+    try:
+        zin = zipfile.ZipFile(src)
+    except zipfile.BadZipFile:
+        raise AppendError("append_invalid_workbook: no es un xlsx")
+    with zin:
+        targets = ledger_targets(zin)
+        target = targets[-1]
+        dash = dashboard_part(zin)
+        body_rows = sum(t.total - t.header - 1 for t in targets)
+        summary = categorias = None
+        if dash is not None and body_rows <= APPEND_RECALC_ROWS:
+            summary, _, categorias = read_ledger(src, targets)
+            values = summary.track(values)
+        infos = sorted(zin.infolist(), key=lambda i: i.header_offset)
+        ends = [i.header_offset for i in infos[1:]] + [zin.start_dir]
+        patched = {target.sheet: None, target.table: None}
+        if dash is not None:
+            patched[dash] = None
+        with _SplicedZipFile(out) as z:
+            for info, end in zip(infos, ends):
+                if info.filename in patched:
+                    patched[info.filename] = info
+                else:
+                    z.copy_raw(src, info, end - info.header_offset)
+
+            # la hoja y la tabla van al final: la tabla depende de la nueva fila de totales
+            info = patched[target.sheet]
+            zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.external_attr = info.external_attr
+            with zin.open(info) as rd, z.open(zinfo, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT // 2) as wr:
+                added, _, total = _append_sheet(rd, wr, target, values)
+
+            info = patched[target.table]
+            table = zin.read(info).decode("utf-8")
+            if total != target.total:
+                table = _TABLE_REF_RE.sub(
+                    lambda m: f'ref="{m.group(1)}{m.group(2)}:{m.group(3)}{total}"'
+                    if int(m.group(4)) == target.total else m.group(0),
+                    table,
+                )
+            zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.external_attr = info.external_attr
+            z.writestr(zinfo, table)
+
+            if dash is not None:
+                info = patched[dash]
+                xml, formulas = strip_cached_values(zin.read(info).decode("utf-8"))
+                if summary is not None:
+                    # filas vacías de todos los tbl_data (cuentan en "Sin categoría")
+                    blank = body_rows + total - target.total - summary.rows
+                    xml = fill_cached_values(xml, summary.cells(blank, categorias, formulas))
+                zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.external_attr = info.external_attr
+                z.writestr(zinfo, xml)
+    return added
+
+
+# ============================================================
+# Analyze: KPIs de un ledger ya generado (y quizá editado en Excel) para el
+# dashboard web, sin recalcular en el cliente. openpyxl read_only + values_only
+# recorre solo el cuerpo de cada tbl_data (según el ref de la tabla: sin
+# encabezado ni totales) y las filas pasan por el mismo LedgerSummary que
+# calcula los valores cacheados del Dashboard => mismas cifras que sus
+# fórmulas. Memoria plana en filas: solo quedan totales, top N y categorías.
+# ============================================================
+def _analyze_amount(v) -> float:
+    # SUM / SUMIFS ignoran texto, booleanos y vacíos
+    return float(v) if v.__class__ is int or v.__class__ is float else 0.0
+
+
+def _analyze_rows(ws, target: _LedgerTarget, blank: list):
+    """
+    Tuplas como las de normalize_ledger_rows del cuerpo de tbl_data. Las filas
+    vacías solo cuentan en blank[0] (COUNTBLANK de "Sin categoría").
+    """
+    first = target.column
+    for values in ws.iter_rows(min_row=target.header + 1, max_row=target.total - 1, min_col=first,
+                               max_col=first + len(LEDGER_HEADERS) - 1, values_only=True):
+        fecha, concepto, categoria, pago, ing, eg = values
+        if all(v is None or v == "" for v in values):
+            blank[0] += 1
+            continue
+        yield fecha, concepto, categoria, pago, _analyze_amount(ing), _analyze_amount(eg)
+
+
+def _dashboard_categories(wb) -> list:
+    """Categorías de la tabla "Gastos por Categoría" del Dashboard del workbook (D11 hacia abajo)."""
+    if "Dashboard" not in wb.sheetnames:
+        return []
+    out = []
+    for (value,) in wb["Dashboard"].iter_rows(min_row=11, max_row=10 + LEDGER_LISTS_MAX, min_col=4, max_col=4,
+                                               values_only=True):
+        if value is None or value == "":
+            break
+        out.append(str(value))
+    return out
+
+
+def read_ledger(src, targets) -> tuple:
+    """
+    (LedgerSummary, filas vacías, categorías del Dashboard) de los tbl_data de
+    src (archivo seekable, se lee desde el inicio).
+    """
+    src.seek(0)
+    summary, blank = LedgerSummary(), [0]
+    wb = load_workbook(src, read_only=True, data_only=True, keep_links=False)
+    try:
+        for target in targets:
+            for _ in summary.track(_analyze_rows(wb[target.title], target, blank)):
+                pass
+        categorias = _dashboard_categories(wb)
+    finally:
+        wb.close()
+        src.seek(0)
+    return summary, blank[0], categorias
+
+
+def analyze_ledger(src) -> dict:
+    """Cifras del Dashboard del ledger xlsx de src (archivo seekable); AppendError si no es un ledger."""
+    try:
+        with zipfile.ZipFile(src) as zin:
+            targets = ledger_targets(zin, "analyze")
+    except zipfile.BadZipFile:
+        raise AppendError("analyze_invalid_workbook: no es un xlsx")
+
+    summary, blank, dashboard = read_ledger(src, targets)
+
+    balance = summary.ingreso - summary.egreso
+    sin_categoria = summary.rows + blank - summary.con_categoria
+    # las categorías que de verdad tiene el Dashboard del xlsx, en su orden; luego las demás
+    known = {c.casefold() for c in dashboard}
+    categorias = [
+        {"categoria": c, "egreso": summary.por_categoria.get(c.casefold(), 0.0), "dashboard": True}
+        for c in dashboard
+    ] + [
+        {"categoria": summary.categorias.get(k, k), "egreso": v, "dashboard": False}
+        for k, v in sorted(summary.por_categoria.items()) if k not in known
+    ]
+    return {
+        "rows": summary.rows,
+        "blankRows": blank,
+        "sheets": [t.title for t in targets],
+        "kpi": {
+            "ingresos": summary.ingreso,
+            "egresos": summary.egreso,
+            "balance": balance,
+            "ingresosEfectivo": summary.efectivo,
+            "egresosTarjeta": summary.tarjeta,
+        },
+        "alertas": {
+            "balanceNegativo": balance < 0,
+            "egresos5000": summary.egresos_5000,
+            "sinCategoria": sin_categoria,
+        },
+        "categorias": categorias,
+        # filas reales del top (como el modo dynamic; en empates gana la fila anterior)
+        "top": [
+            {"concepto": concepto, "categoria": categoria, "egreso": eg}
+            for eg, _, concepto, categoria in sorted(summary.top, reverse=True)
+        ],
+    }
+
+
+# ============================================================
+# Admission control de generate, append, analyze y batch: cada request
+# reserva un costo estimado (en "filas equivalentes": base por plantilla +
+# filas, o bytes del body / ADMISSION_ROW_BYTES mientras no se conocen las
+# filas; un xlsx subido cuenta ADMISSION_XLSX_ROW_BYTES por fila). Por worker se
+# limita el costo y el número de builds en vuelo; lo que no cabe recibe un 429
+# inmediato con Retry-After según los tiempos de build observados.
+# Con gunicorn gthread (gunicorn.conf.py) los builds nunca ocupan todos los
+# hilos => /healthz y /metrics (que no pasan por aquí) siempre tienen uno libre.
+# ============================================================
+ADMISSION_ENABLED = os.getenv("AUREA_ADMISSION", "1") == "1"
+ADMISSION_MAX_COST = int(os.getenv("AUREA_ADMISSION_MAX_COST", "600000"))
+ADMISSION_MAX_BUILDS = max(1, int(os.getenv(
+    "AUREA_ADMISSION_MAX_BUILDS", str(max(1, int(os.getenv("AUREA_THREADS", "4")) - 1)))))
+ADMISSION_ROW_BYTES = 120  # bytes de JSON/CSV por fila, para estimar antes de parsear
+ADMISSION_BASE_COST = {TEMPLATE_LEDGER: 2000, TEMPLATE_SERVICES: 500, TEMPLATE_SPEC: 3000}
+# append reescribe el xlsx completo; analyze solo lo lee
+ADMISSION_UPLOAD_COST = {"append": 2000, "analyze": 500}
+ADMISSION_XLSX_ROW_BYTES = 40  # bytes comprimidos por fila de un ledger ya generado
+ADMISSION_RETRY_MAX = int(os.getenv("AUREA_ADMISSION_RETRY_MAX", "60"))
+ADMISSION_STATS = {"admitted": 0, "rejected": 0}
+
+METRIC_REJECTED = Counter(
+    "aurea_excel_rejected_total", "Requests rechazados con 429 por admission control.")
+METRIC_INFLIGHT_COST = Gauge(
+    "aurea_excel_in_flight_cost", "Costo estimado (filas equivalentes) de los builds en curso.")
+METRICS += (METRIC_REJECTED, METRIC_INFLIGHT_COST)
+
+
+def request_cost(payload=None, body_bytes: int = 0) -> int:
+    """Costo estimado de un build; sin payload (aún no parseado) solo por tamaño del body."""
+    by_size = (body_bytes or 0) // ADMISSION_ROW_BYTES
+    if payload is None:
+        return ADMISSION_BASE_COST[TEMPLATE_LEDGER] + by_size
+    rows = payload.get("rows")
+    n = len(rows) if isinstance(rows, list) else 0
+    return ADMISSION_BASE_COST[excel_template(payload)] + max(n, by_size)
+
+
+def upload_cost(route: str, body_bytes: int = 0) -> int:
+    """Costo de append/analyze: base de la ruta + filas estimadas del xlsx subido."""
+    return ADMISSION_UPLOAD_COST[route] + (body_bytes or 0) // ADMISSION_XLSX_ROW_BYTES
+
+
+def batch_cost(items: list) -> int:
+    """Costo de un lote: la suma de sus items (corren en el pool, pero el stream ocupa un hilo todo el lote)."""
+    return sum(request_cost(item) for item in items if isinstance(item, dict)) or ADMISSION_BASE_COST[TEMPLATE_LEDGER]
+
+
+class AdmissionTicket:
+    __slots__ = ("control", "cost", "start", "built", "released")
+
+    def __init__(self, control, cost: int):
+        self.control = control
+        self.cost = cost
+        self.start = time.perf_counter()
+        self.built = True  # False => no alimenta el promedio de tiempos (cache hit, 304)
+        self.released = False
+
+    def resize(self, cost: int):
+        self.control.resize(self, cost)
+
+    def release(self):
+        self.control.release(self)
+
+
+class AdmissionControl:
+    """Costo y builds en vuelo de este proceso, con segundos por unidad de costo observados (EWMA)."""
+
+    def __init__(self, max_cost: int, max_builds: int, secs_per_cost: float = 4e-5):
+        self.max_cost = max_cost
+        self.max_builds = max_builds
+        self.secs_per_cost = secs_per_cost
+        self.cost = 0
+        self.tickets = set()
+        self._lock = threading.Lock()
+
+    def admit(self, cost: int):
+        """AdmissionTicket o None si no cabe (un build solo siempre cabe: si no, nunca correría)."""
+        with self._lock:
+            if self.tickets and (len(self.tickets) >= self.max_builds or self.cost + cost > self.max_cost):
+                ADMISSION_STATS["rejected"] += 1
+                return None
+            ticket = AdmissionTicket(self, cost)
+            self.tickets.add(ticket)
+            self.cost += cost
+            ADMISSION_STATS["admitted"] += 1
+        if METRICS_ENABLED:
+            METRIC_INFLIGHT_COST.inc(amount=cost)
+        return ticket
+
+    def resize(self, ticket: AdmissionTicket, cost: int):
+        # ajuste después de parsear: el request ya fue admitido, solo se corrige la cuenta
+        with self._lock:
+            if ticket.released:
+                return
+            delta, ticket.cost = cost - ticket.cost, cost
+            self.cost += delta
+        if METRICS_ENABLED:
+            METRIC_INFLIGHT_COST.inc(amount=delta)
+
+    def release(self, ticket: AdmissionTicket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.tickets.discard(ticket)
+            self.cost -= ticket.cost
+            if ticket.built and ticket.cost:
+                spc = (time.perf_counter() - ticket.start) / ticket.cost
+                self.secs_per_cost = 0.8 * self.secs_per_cost + 0.2 * spc
+        if METRICS_ENABLED:
+            METRIC_INFLIGHT_COST.inc(amount=-ticket.cost)
+
+    def retry_after(self, cost: int) -> int:
+        """Segundos hasta que, según los tiempos observados, terminan los builds que hacen lugar."""
+        now = time.perf_counter()
+        with self._lock:
+            pending = sorted(
+                (max(0.0, t.cost * self.secs_per_cost - (now - t.start)), t.cost) for t in self.tickets
+            )
+            in_flight, builds = self.cost, len(self.tickets)
+        wait_s = 0.0
+        for remaining, c in pending:
+            if builds < self.max_builds and in_flight + cost <= self.max_cost:
+                break
+            wait_s, in_flight, builds = remaining, in_flight - c, builds - 1
+        return min(ADMISSION_RETRY_MAX, max(1, -(-int(wait_s * 1000) // 1000)))
+
+
+ADMISSION = AdmissionControl(ADMISSION_MAX_COST, ADMISSION_MAX_BUILDS)
+
+
+def admission_rejected(cost: int):
+    if METRICS_ENABLED:
+        METRIC_REJECTED.inc()
+    retry = ADMISSION.retry_after(cost)
+    resp = _cors(jsonify({"ok": False, "error": "excel_busy: demasiados builds en curso", "retryAfter": retry}))
+    resp.headers["Retry-After"] = str(retry)
+    return resp, 429
+
+
+# ============================================================
+# Batch: muchos payloads => un zip. Los build_excel corren en un pool de
+# procesos (no en el GIL) y cada xlsx se agrega al zip de respuesta en
+# cuanto termina (streaming, sin esperar al lote completo).
+# ============================================================
+BATCH_WORKERS = max(1, int(os.getenv("AUREA_BATCH_WORKERS", str(os.cpu_count() or 2))))
+BATCH_MAX_ITEMS = int(os.getenv("AUREA_BATCH_MAX_ITEMS", "500"))
+# los pools se crean desde hilos de gthread / del stream: con fork el hijo
+# puede heredar tomado un lock (_SKELETON_LOCK, logging...) y colgarse.
+# forkserver: los hijos salen de un proceso de un solo hilo que ya importó
+# este módulo (warm-up incluido); spawn donde no hay forkserver.
+POOL_START_METHOD = os.getenv("AUREA_POOL_START_METHOD", "forkserver")
+_BATCH_POOL = None
+_BATCH_POOL_LOCK = threading.Lock()
+
+
+def process_pool(workers: int):
+    # concurrent.futures.process (y multiprocessing) solo se importan si hay lotes/jobs
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    method = POOL_START_METHOD
+    if method not in multiprocessing.get_all_start_methods():
+        method = "spawn"
+    ctx = multiprocessing.get_context(method)
+    if method == "forkserver" and __name__ != "__main__":
+        ctx.set_forkserver_preload([__name__])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+
+
+def _batch_pool():
+    global _BATCH_POOL
+    with _BATCH_POOL_LOCK:
+        if _BATCH_POOL is None:
+            _BATCH_POOL = process_pool(BATCH_WORKERS)
+        return _BATCH_POOL
+
+
+def _drop_batch_pool(pool):
+    """Descarta un pool roto. Solo ese: otro lote concurrente pudo haber creado ya uno nuevo."""
+    global _BATCH_POOL
+    with _BATCH_POOL_LOCK:
+        if _BATCH_POOL is pool:
+            _BATCH_POOL = None
+    # libera hilos y pipes del executor viejo (shutdown sin esperar)
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _batch_submit(item):
+    """
+    (future, pool) del build. El pool se pide en cada submit: si otro lote lo
+    descartó entre tanto (RuntimeError / BrokenProcessPool) se reintenta una
+    vez con el pool nuevo.
+    """
+    for attempt in range(2):
+        pool = _batch_pool()
+        try:
+            return pool.submit(_batch_build, item), pool
+        except RuntimeError:
+            _drop_batch_pool(pool)
+            if attempt:
+                raise
+
+
+def _batch_build(payload):
+    """Corre en el proceso hijo. Regresa (bytes, None) o (None, error) => nada que des-picklear de más."""
+    try:
+        return build_excel(payload).getvalue(), None
+    except Exception as e:
+        return None, f"excel_build_failed: {e}"
+
+
+class _ChunkSink:
+    """Destino de escritura no seekable para ZipFile: acumula bytes que el generador va soltando."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _batch_names(items) -> list:
+    names, used = [], set()
+    for i, item in enumerate(items, start=1):
+        name = _safe_filename((item.get("fileName") or item.get("filename")) if isinstance(item, dict) else None)
+        if name == "AUREA_excel.xlsx":
+            name = f"AUREA_excel_{i}.xlsx"
+        base, n = name[:-5], 1
+        while name.lower() in used:
+            n += 1
+            name = f"{base}_{n}.xlsx"
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+def stream_batch_zip(items, now: str):
+    """
+    Generador de bytes del zip del lote. Cada xlsx se escribe al terminar;
+    al final va _manifest.json con el estado por item (los errores no tiran el lote).
+    """
+    from concurrent.futures import FIRST_COMPLETED, CancelledError, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    names = _batch_names(items)
+    manifest = [{"index": i, "fileName": n, "ok": False, "error": None, "bytes": 0} for i, n in enumerate(names)]
+    sink = _ChunkSink()
+
+    with _StampedZipFile(sink, now) as z:
+        pending = {}
+        queue = iter(enumerate(items))
+        while True:
+            # en vuelo a lo más 2 por worker => memoria acotada aunque el cliente lea lento
+            while len(pending) < BATCH_WORKERS * 2:
+                nxt = next(queue, None)
+                if nxt is None:
+                    break
+                i, item = nxt
+                if not isinstance(item, dict):
+                    manifest[i]["error"] = "invalid_item: se esperaba un objeto JSON"
+                    continue
+                try:
+                    validate_payload(item)
+                except PayloadError as e:
+                    manifest[i].update(error=str(e), errors=e.errors)
+                    continue
+                try:
+                    fut, pool = _batch_submit(item)
+                except RuntimeError as e:
+                    manifest[i]["error"] = f"excel_build_failed: {e}"
+                    continue
+                pending[fut] = i, pool
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                i, pool = pending.pop(fut)
+                try:
+                    data, error = fut.result()
+                except BrokenProcessPool:
+                    data, error = None, "excel_build_failed: worker process died"
+                    _drop_batch_pool(pool)
+                except CancelledError:
+                    # el pool se apagó con el build todavía en cola (otro lote lo descartó)
+                    data, error = None, "excel_build_failed: build cancelled"
+                except Exception as e:
+                    data, error = None, f"excel_build_failed: {e}"
+                if error:
+                    manifest[i]["error"] = error
+                    continue
+                z.writestr(names[i], data)
+                manifest[i].update(ok=True, bytes=len(data))
+                yield sink.drain()
+
+        z.writestr("_manifest.json", json.dumps({
+            "generated": now,
+            "total": len(manifest),
+            "ok": sum(1 for m in manifest if m["ok"]),
+            "failed": sum(1 for m in manifest if not m["ok"]),
+            "items": manifest,
+        }, ensure_ascii=False, indent=2))
+    yield sink.drain()
+
+
+# ============================================================
+# Jobs asíncronos: POST /api/excel/jobs regresa un id al instante, el build
+# corre en un pool de procesos acotado y GET /api/excel/jobs/<id> reporta
+# estado o entrega el archivo. Cola y store son enchufables
+# (AUREA_JOB_QUEUE / AUREA_JOB_STORE = "modulo:factory"); el default vive
+# en el proceso => funciona en una sola máquina sin servicios externos.
+# ============================================================
+JOB_WORKERS = max(1, int(os.getenv("AUREA_JOB_WORKERS", "2")))
+JOB_MAX_PENDING = int(os.getenv("AUREA_JOB_MAX_PENDING", "64"))
+JOB_TTL = int(os.getenv("AUREA_JOB_TTL", "900"))  # segundos que se conserva un resultado
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class InMemoryJobStore:
+    """
+    Store default: estado + bytes en memoria del proceso, con expiración (TTL).
+    Interfaz: create / update / get / put_result / get_result.
+    """
+
+    def __init__(self, ttl: int = JOB_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float):
+        for job_id in [k for k, job in self._jobs.items() if job["expires"] <= now]:
+            self._jobs.pop(job_id, None)
+            self._results.pop(job_id, None)
+
+    def create(self, job_id: str, meta: dict):
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            self._jobs[job_id] = dict(meta, id=job_id, status="queued", created=now, updated=now, expires=now + self.ttl)
+
+    def update(self, job_id: str, **fields):
+        now = time.time()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated=now, expires=now + self.ttl)
+
+    def get(self, job_id: str):
+        with self._lock:
+            self._purge(time.time())
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def put_result(self, job_id: str, data: bytes):
+        with self._lock:
+            if job_id in self._jobs:
+                self._results[job_id] = data
+
+    def get_result(self, job_id: str):
+        with self._lock:
+            return self._results.get(job_id)
+
+
+class ProcessPoolJobQueue:
+    """
+    Cola default: ProcessPoolExecutor propio con backlog acotado.
+    Interfaz: submit(job_id, payload, store) / is_running(job_id).
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_pending: int = JOB_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job_id: str, payload: dict, store):
+        with self._lock:
+            if len(self._futures) >= self.max_pending:
+                raise JobQueueFull(f"jobs_busy: {len(self._futures)} jobs en cola")
+            if self._pool is None:
+                self._pool = process_pool(self.workers)
+            pool = self._pool
+            fut = pool.submit(_batch_build, payload)
+            self._futures[job_id] = fut
+        fut.add_done_callback(lambda f: self._finish(job_id, f, store, pool))
+
+    def is_running(self, job_id: str) -> bool:
+        fut = self._futures.get(job_id)
+        return fut is not None and fut.running()
+
+    def _finish(self, job_id: str, fut, store, pool):
+        from concurrent.futures.process import BrokenProcessPool
+
+        with self._lock:
+            self._futures.pop(job_id, None)
+        try:
+            data, error = fut.result()
+        except BrokenProcessPool:
+            data, error = None, "excel_build_failed: worker process died"
+            with self._lock:
+                # solo el pool roto: otro submit pudo haber creado ya uno nuevo
+                if self._pool is pool:
+                    self._pool = None
+            # libera hilos y pipes del executor viejo (shutdown sin esperar)
+            pool.shutdown(wait=False, cancel_futures=True)
+        except Exception as e:
+            data, error = None, f"excel_build_failed: {e}"
+        if error:
+            store.update(job_id, status="failed", error=error)
+        else:
+            store.put_result(job_id, data)
+            store.update(job_id, status="done", bytes=len(data))
+
+
+def _load_factory(spec: str, default):
+    """'paquete.modulo:factory' => factory() ; vacío => default()."""
+    if not spec:
+        return default()
+    module, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module), attr or "create")()
+
+
+JOB_STORE = _load_factory(os.getenv("AUREA_JOB_STORE", ""), InMemoryJobStore)
+JOB_QUEUE = _load_factory(os.getenv("AUREA_JOB_QUEUE", ""), ProcessPoolJobQueue)
+
+
+def _job_json(job: dict) -> dict:
+    out = {
+        "ok": job["status"] != "failed",
+        "jobId": job["id"],
+        "status": job["status"],
+        "fileName": job["fileName"],
+        "created": datetime.fromtimestamp(job["created"]).strftime(TS_FORMAT),
+        "expiresIn": max(0, int(job["expires"] - time.time())),
+    }
+    if job.get("error"):
+        out["error"] = job["error"]
+    if job.get("bytes"):
+        out["bytes"] = job["bytes"]
+    return out
+
+
+def warm_skeletons():
+    get_skeleton(TEMPLATE_LEDGER, ledger_capacity(0), DASHBOARD_FORMULAS)
+    get_skeleton(TEMPLATE_SERVICES)
+    if EXCEL_ENGINE == ENGINE_XML:
+        get_xml_template(TEMPLATE_LEDGER, formulas=DASHBOARD_FORMULAS)
+        get_xml_template(TEMPLATE_SERVICES)
+
+
+# ============================================================
+# Arranque en frío: warm-up al importar. Además de los skeletons corre un
+# build completo por plantilla (ledger chico, ledger en streaming, servicios,
+# spec, con 1 fila) => el primer request ya no paga el primer Workbook(), los regex y
+# las partes perezosas de openpyxl/zipfile. Con gunicorn preload_app
+# (gunicorn.conf.py) esto corre una vez en el master y los workers lo
+# heredan copy-on-write. /healthz responde 503 hasta que termina.
+# Si el warm-up falla, /healthz arranca un hilo que lo reintenta en segundo
+# plano (uno a la vez, con backoff desde AUREA_WARMUP_RETRY_S hasta
+# AUREA_WARMUP_RETRY_MAX_S); /healthz solo lee WARMUP_STATE. Tras
+# AUREA_WARMUP_ATTEMPTS fallos el worker se marca listo de todos modos
+# (sirve requests, solo sin el warm-up) y el error queda en /healthz.
+# ============================================================
+WARMUP_STATE = {"ready": False, "seconds": None, "error": None, "attempts": 0}
+WARMUP_ATTEMPTS = max(1, int(os.getenv("AUREA_WARMUP_ATTEMPTS", "3")))
+WARMUP_RETRY_S = float(os.getenv("AUREA_WARMUP_RETRY_S", "10"))
+WARMUP_RETRY_MAX_S = float(os.getenv("AUREA_WARMUP_RETRY_MAX_S", "60"))
+_WARMUP_LOCK = threading.Lock()
+_WARMUP_LAST = 0.0
+_WARMUP_THREAD = None
+_WARMUP_SPEC = {"sheets": [{"name": "AUREA", "kind": "data"}, {"name": "Dashboard", "kind": "dashboard"}],
+                "kpis": [{"label": "Total", "formula": "=SUM(tbl_data[Ingreso])"}]}
+
+
+_WARMUP_ROW = {"Fecha": "2024-01-01", "Concepto": "warm-up", "Categoría": LEDGER_CATEGORIES[0],
+               "Forma de pago": LEDGER_PAYMENTS[0], "Ingreso": "1,000.00", "Egreso": 0}
+
+
+def warm_up():
+    """Skeletons + un build por plantilla a un sink descartable; marca WARMUP_STATE."""
+    global _WARMUP_LAST
+    t = _WARMUP_LAST = time.perf_counter()
+    WARMUP_STATE["attempts"] += 1
+    error = None
+    try:
+        warm_skeletons()
+        for payload in ({"rows": [_WARMUP_ROW]},
+                        {"prompt": "servicios y estudios realizados"},
+                        {"spec": _WARMUP_SPEC, "rows": [_WARMUP_ROW]}):
+            write_excel(dict(payload, deterministic=True), BytesIO())
+        if EXCEL_ENGINE == ENGINE_OPENPYXL:
+            # ledgers grandes van por write-only: mismo código con 1 fila
+            now, _ = build_timestamp({"deterministic": True})
+            build_ledger_streaming(_ChunkSink(), normalize_ledger_rows([_WARMUP_ROW]), now, DASHBOARD_FORMULAS)
+        with app.test_request_context("/api/excel/generate", method="POST"):
+            # mimetypes, send_file y jsonify se inicializan en su primer uso
+            _cors(send_file(BytesIO(b""), as_attachment=True, download_name="warmup.xlsx", mimetype=XLSX_MIMETYPE))
+            jsonify({"ok": True})
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        app.logger.exception("warm-up falló")
+    # el error del intento anterior sigue visible en /healthz mientras corre el reintento
+    WARMUP_STATE.update(error=error, seconds=round(time.perf_counter() - t, 3))
+    WARMUP_STATE["ready"] = error is None
+    if not WARMUP_STATE["ready"] and WARMUP_STATE["attempts"] >= WARMUP_ATTEMPTS:
+        app.logger.error("warm-up falló %d veces; el worker queda listo sin warm-up", WARMUP_STATE["attempts"])
+        WARMUP_STATE["ready"] = True
+
+
+def _warm_up_retries():
+    """Hilo de reintentos: espera WARMUP_RETRY_S (x2 por fallo, tope WARMUP_RETRY_MAX_S) y reintenta."""
+    delay = WARMUP_RETRY_S
+    while not WARMUP_STATE["ready"]:
+        time.sleep(max(0.0, _WARMUP_LAST + delay - time.perf_counter()))
+        warm_up()
+        delay = min(delay * 2, WARMUP_RETRY_MAX_S)
+
+
+def retry_warm_up():
+    """Arranca el hilo de reintentos si no hay uno vivo; no bloquea a quien llama (/healthz)."""
+    global _WARMUP_THREAD
+    with _WARMUP_LOCK:
+        if WARMUP_STATE["ready"] or (_WARMUP_THREAD is not None and _WARMUP_THREAD.is_alive()):
+            return
+        # con preload_app el hilo del master no pasa al fork => cada worker arranca el suyo
+        _WARMUP_THREAD = threading.Thread(target=_warm_up_retries, name="aurea-warmup", daemon=True)
+        _WARMUP_THREAD.start()
+
+
+# AUREA_WARMUP=0 (o el legado AUREA_SKELETON_WARMUP=0) => sin warm-up, listo de inmediato
+if os.getenv("AUREA_WARMUP", os.getenv("AUREA_SKELETON_WARMUP", "1")) == "1":
+    warm_up()
+else:
+    WARMUP_STATE["ready"] = True
+
+
 # ============================================================
 # Routes
 # ============================================================
 @app.route("/healthz", methods=["GET"])
 def healthz():
-    return _cors(jsonify({"ok": True, "service": "aurea-excel-generator"}))
+    if not WARMUP_STATE["ready"]:
+        retry_warm_up()
+    ready = WARMUP_STATE["ready"]
+    return _cors(jsonify({
+        "ok": ready,
+        "service": "aurea-excel-generator",
+        "warmup": dict(WARMUP_STATE),
+        "skeletons": dict(SKELETON_STATS),
+        "spec_plans": dict(SPEC_PLAN_STATS),
+        "output_cache": dict(OUTPUT_CACHE_STATS),
+        "admission": dict(ADMISSION_STATS, in_flight=len(ADMISSION.tickets), cost=ADMISSION.cost),
+        "payloads": dict(PAYLOAD_STATS),
+    })), 200 if ready else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not METRICS_ENABLED:
+        return _cors(make_response("", 404))
+    resp = make_response(render_metrics())
+    resp.mimetype = "text/plain"
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return resp
+
+
+@app.route("/debug/alloc", methods=["GET"])
+def debug_alloc():
+    """Últimos perfiles de memoria (solo con AUREA_PROFILE_ENDPOINT=1)."""
+    if not PROFILE_ENDPOINT:
+        return _cors(make_response("", 404))
+    with _PROFILE_STATS_LOCK:
+        stats = dict(PROFILE_STATS)
+    return _cors(jsonify({
+        "ok": True,
+        "rate": PROFILE_ALLOC_RATE,
+        "release": PROFILE_RELEASE,
+        "stats": stats,
+        "profiles": list(_PROFILES),
+    }))
+
+
+# campos del payload que se aceptan como form fields / query string en la ingesta
+_INGEST_FIELDS = ("fileName", "filename", "prompt", "text", "engine", "timestamp", "generatedAt", "deterministic")
+_INGEST_TRUE = ("1", "true", "yes", "on")
+
+
+def _ingest_payload():
+    """
+    (payload, RowIngest) si el request trae los rows como CSV/NDJSON; None => JSON normal.
+      multipart: archivo en "file" (o "rows"), payload JSON opcional en el campo "payload"
+      body crudo: Content-Type text/csv o application/x-ndjson, payload por query string
+    """
+    if request.mimetype == "multipart/form-data":
+        try:
+            upload = request.files.get("file") or request.files.get("rows")
+        except RequestEntityTooLarge:
+            raise payload_too_large()
+        if upload is None:
+            return None
+        fields = request.form
+        fmt = ingest_format(upload.mimetype, upload.filename, fields.get("format")) or INGEST_CSV
+        try:
+            payload = _to_dict(json.loads(fields["payload"])) if fields.get("payload") else {}
+        except ValueError as e:
+            raise PayloadError([{"path": "payload", "code": "json", "message": f"el campo payload no es JSON válido: {e}"}])
+        stream = upload.stream
+    else:
+        fields = request.args
+        fmt = ingest_format(request.mimetype, fmt=fields.get("format"))
+        if fmt is None:
+            return None
+        payload = {}
+        stream = request.stream
+    for k in _INGEST_FIELDS:
+        if k in fields and k not in payload:
+            payload[k] = fields[k]
+    if isinstance(payload.get("deterministic"), str):
+        # form / query string solo traen texto; build_timestamp espera un bool
+        payload["deterministic"] = payload["deterministic"].strip().lower() in _INGEST_TRUE
+    return payload, RowIngest(stream, fmt, fields.get("encoding") or "utf-8-sig")
+
+
+def _generate_ingest(payload: dict, ingest: RowIngest, timer):
+    # rows de una sola pasada => sin cache ni ETag; spool para poder poner
+    # los conteos de errores en headers (el build ya terminó al responder)
+    body, size = spool_excel(dict(payload, rows=ingest))
+    resp = send_file(body, as_attachment=True, download_name=excel_filename(payload), mimetype=XLSX_MIMETYPE)
+    resp.content_length = size
+    resp = _cors(resp)
+    resp.headers["X-AUREA-Cache"] = "bypass"
+    _finish_timing(resp, timer, "bypass", size)
+    return ingest_headers(resp, ingest)
+
+
+def _finish_timing(resp, timer, cache: str, size):
+    if timer is not None and METRICS_ENABLED:
+        resp.headers["Server-Timing"] = timer.server_timing()
+        observe_request(timer, cache, size)
+
+
+class _TimedStream:
+    """
+    Cuerpo chunked con métricas: Server-Timing no cabe (los headers ya
+    salieron) => se registran en close(), que el servidor WSGI llama al
+    terminar o al cortarse el stream (aunque no se haya leído ningún chunk).
+    """
+
+    __slots__ = ("chunks", "timer", "size", "status", "closed")
+
+    def __init__(self, chunks, timer):
+        self.chunks = chunks
+        self.timer = timer
+        self.size = 0
+        self.status = "error"
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            yield chunk
+        self.status = "ok"
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.chunks.close()
+        observe_request(self.timer, "bypass", self.size)
+        finish_profile(self.timer, self.status)
+        if METRICS_ENABLED:
+            METRIC_IN_FLIGHT.dec()
 
 
 @app.route("/api/excel/generate", methods=["POST", "OPTIONS"])
@@ -562,26 +4478,334 @@ def generate_excel():
     if request.method == "OPTIONS":
         return _cors(make_response("", 204))
 
+    # antes de leer el body: ni un 413 ni un 429 pagan el parseo
     try:
-        payload = request.get_json(silent=True) or {}
-        payload = _to_dict(payload)
+        check_content_length(request.content_length)
+    except PayloadError as e:
+        count_error("generate", e)
+        return _payload_error_response(e)
+    ticket = None
+    if ADMISSION_ENABLED:
+        cost = request_cost(body_bytes=request.content_length)
+        ticket = ADMISSION.admit(cost)
+        if ticket is None:
+            return admission_rejected(cost)
 
-        out = build_excel(payload)
-        filename = _safe_filename(payload.get("fileName") or "AUREA_excel.xlsx")
+    timer = start_phase_timer()
+    streaming, status = False, "error"
+    if METRICS_ENABLED:
+        METRIC_IN_FLIGHT.inc()
+    try:
+        with phase("parse"):
+            ingest = _ingest_payload()
+        if ingest is not None:
+            if timer is not None:
+                timer.template = TEMPLATE_LEDGER
+            validate_payload(ingest[0])
+            resp = _generate_ingest(*ingest, timer)
+            status = "ok"
+            return resp
 
-        resp = send_file(
-            out,
-            as_attachment=True,
-            download_name=filename,
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
-        return _cors(resp)
+        with phase("parse"):
+            payload = validate_payload(_to_dict(request_json() or {}))
+        if timer is not None:
+            timer.template = excel_template(payload)
+        if ticket is not None:
+            ticket.resize(request_cost(payload, request.content_length))
+        filename = excel_filename(payload)
 
+        key, deterministic = output_cache_key(payload)
+        etag = f'"{key}"' if deterministic else f'W/"{key}"'
+        if request.if_none_match.contains_weak(key):
+            resp = _cors(make_response("", 304))
+            _finish_timing(resp, timer, "not_modified", None)
+            if ticket is not None:
+                ticket.built = False
+        else:
+            data = output_cache_get(key) if deterministic else None
+            if data is not None:
+                cache, body, size = "hit", BytesIO(data), len(data)
+                if ticket is not None:
+                    ticket.built = False
+            elif response_mode(payload) == RESPONSE_STREAM:
+                cache, body, size = "bypass", None, None
+            else:
+                cache = "miss" if deterministic else "bypass"
+                body, size = spool_excel(payload)
+                if deterministic and size <= OUTPUT_CACHE_ITEM_MAX:
+                    data = body.read()
+                    body.close()
+                    output_cache_put(key, data)
+                    body = BytesIO(data)
+
+            if body is None:
+                # Transfer-Encoding: chunked, sin Content-Length
+                chunks = stream_excel(payload)
+                if timer is not None:
+                    chunks = _TimedStream(chunks, timer)
+                resp = Response(chunks, mimetype=XLSX_MIMETYPE)
+                resp.headers.set("Content-Disposition", "attachment", filename=filename)
+                # el build sigue mientras sale el cuerpo => la reserva se libera al cerrarlo
+                if ticket is not None:
+                    resp.call_on_close(ticket.release)
+                streaming = True
+            else:
+                resp = send_file(body, as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE)
+                resp.content_length = size
+                _finish_timing(resp, timer, cache, size)
+            resp = _cors(resp)
+            resp.headers["X-AUREA-Cache"] = cache
+
+        # el navegador guarda la respuesta pero revalida siempre (If-None-Match)
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "private, no-cache"
+        status = "ok"
+        return resp
+
+    except PayloadError as e:
+        count_error("generate", e)
+        status = "invalid"
+        if ticket is not None:
+            ticket.built = False  # sin build: no cuenta en los tiempos de Retry-After
+        return _payload_error_response(e)
     except Exception as e:
+        count_error("generate", e)
         return _cors(jsonify({
             "ok": False,
             "error": f"excel_build_failed: {str(e)}"
         })), 500
+    finally:
+        # en modo stream gauge, perfil y reserva cierran con el cuerpo (_TimedStream.close / call_on_close)
+        if not streaming:
+            finish_profile(timer, status)
+            if METRICS_ENABLED:
+                METRIC_IN_FLIGHT.dec()
+            if ticket is not None:
+                ticket.release()
+
+
+def _append_request():
+    """
+    (xlsx, rows, fileName) del multipart de /api/excel/append:
+      "workbook" (o "file"): el xlsx generado antes por este servicio
+      rows: archivo CSV/NDJSON en "rows" o arreglo JSON en el campo "rows"
+    """
+    fields = request.form
+    upload = request.files.get("workbook") or request.files.get("file")
+    if upload is None:
+        raise AppendError("append_missing_workbook: falta el xlsx en el campo 'workbook'", 400)
+    rows_file = request.files.get("rows")
+    if rows_file is not None:
+        fmt = ingest_format(rows_file.mimetype, rows_file.filename, fields.get("format")) or INGEST_CSV
+        rows = RowIngest(rows_file.stream, fmt, fields.get("encoding") or "utf-8-sig")
+    else:
+        try:
+            rows = json.loads(fields.get("rows") or "[]")
+        except ValueError as e:
+            raise AppendError(f"append_invalid_rows: {e}", 400)
+        if not isinstance(rows, list):
+            raise AppendError("append_invalid_rows: se esperaba un arreglo JSON", 400)
+        validate_payload({"rows": rows})
+    name = fields.get("fileName") or fields.get("filename") or upload.filename
+    return upload.stream, rows, _safe_filename(name)
+
+
+@app.route("/api/excel/append", methods=["POST", "OPTIONS"])
+def append_excel_route():
+    if request.method == "OPTIONS":
+        return _cors(make_response("", 204))
+
+    ticket = None
+    if ADMISSION_ENABLED:
+        cost = upload_cost("append", request.content_length)
+        ticket = ADMISSION.admit(cost)
+        if ticket is None:
+            return admission_rejected(cost)
+
+    size = None
+    try:
+        src, rows, filename = _append_request()
+        if not src.seekable():
+            spooled = SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+            shutil.copyfileobj(src, spooled, APPEND_READ_CHUNK)
+            src = spooled
+        out = SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        try:
+            added = append_excel(src, normalize_ledger_rows(rows), out)
+            size = out.tell()
+            out.seek(0)
+        except Exception:
+            out.close()
+            raise
+    except AppendError as e:
+        count_error("append", e)
+        return _cors(jsonify({"ok": False, "error": str(e)})), e.status
+    except RequestEntityTooLarge as e:
+        count_error("append", e)
+        return _payload_error_response(payload_too_large())
+    except PayloadError as e:
+        count_error("append", e)
+        return _payload_error_response(e)
+    except Exception as e:
+        count_error("append", e)
+        return _cors(jsonify({"ok": False, "error": f"excel_append_failed: {e}"})), 500
+    finally:
+        # el xlsx ya quedó completo en out (send_file solo lo copia); sin append no cuenta en Retry-After
+        if ticket is not None:
+            ticket.built = size is not None
+            ticket.release()
+
+    resp = send_file(out, as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE)
+    resp.content_length = size
+    resp = _cors(resp)
+    resp.headers["X-AUREA-Cache"] = "bypass"
+    if isinstance(rows, RowIngest):
+        ingest_headers(resp, rows)
+    resp.headers["X-AUREA-Rows"] = str(added)
+    return resp
+
+
+@app.route("/api/excel/analyze", methods=["POST", "OPTIONS"])
+def analyze_excel_route():
+    """KPIs del ledger subido: multipart "workbook" (o "file"), o el xlsx como body."""
+    if request.method == "OPTIONS":
+        return _cors(make_response("", 204))
+
+    ticket = None
+    if ADMISSION_ENABLED:
+        cost = upload_cost("analyze", request.content_length)
+        ticket = ADMISSION.admit(cost)
+        if ticket is None:
+            return admission_rejected(cost)
+
+    result = None
+    try:
+        upload = request.files.get("workbook") or request.files.get("file")
+        if upload is not None:
+            src = upload.stream
+        elif request.mimetype in (XLSX_MIMETYPE, "application/octet-stream"):
+            src = request.stream
+        else:
+            raise AppendError("analyze_missing_workbook: falta el xlsx en el campo 'workbook'", 400)
+        if not src.seekable():
+            spooled = SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+            shutil.copyfileobj(src, spooled, APPEND_READ_CHUNK)
+            src = spooled
+        with src:
+            result = analyze_ledger(src)
+    except AppendError as e:
+        count_error("analyze", e)
+        return _cors(jsonify({"ok": False, "error": str(e)})), e.status
+    except RequestEntityTooLarge as e:
+        count_error("analyze", e)
+        return _payload_error_response(payload_too_large())
+    except Exception as e:
+        count_error("analyze", e)
+        return _cors(jsonify({"ok": False, "error": f"excel_analyze_failed: {e}"})), 500
+    finally:
+        if ticket is not None:
+            ticket.built = result is not None
+            ticket.release()
+    return _cors(jsonify(dict(result, ok=True)))
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    # rutas sin manejo propio (batch): mismo 413 que el resto
+    count_error("request", e)
+    return _payload_error_response(payload_too_large())
+
+
+@app.route("/api/excel/generate/batch", methods=["POST", "OPTIONS"])
+def generate_excel_batch():
+    if request.method == "OPTIONS":
+        return _cors(make_response("", 204))
+
+    # como generate: la reserva por tamaño del body va antes de parsear
+    ticket = None
+    if ADMISSION_ENABLED:
+        cost = request_cost(body_bytes=request.content_length)
+        ticket = ADMISSION.admit(cost)
+        if ticket is None:
+            return admission_rejected(cost)
+
+    streaming = False
+    try:
+        try:
+            body = request_json()
+        except PayloadError as e:
+            count_error("batch", e)
+            return _payload_error_response(e)
+        items = body if isinstance(body, list) else _to_dict(body).get("items")
+        if not isinstance(items, list) or not items:
+            return _cors(jsonify({"ok": False, "error": "batch_invalid: se esperaba items: [payload, ...]"})), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return _cors(jsonify({"ok": False, "error": f"batch_too_large: máximo {BATCH_MAX_ITEMS} items"})), 413
+
+        zip_name = _safe_filename(_to_dict(body).get("fileName") or "AUREA_batch").rsplit(".", 1)[0] + ".zip"
+        resp = Response(stream_with_context(stream_batch_zip(items, _now_str())), mimetype="application/zip")
+        resp.headers["Content-Disposition"] = f'attachment; filename="{zip_name}"'
+        if ticket is not None:
+            ticket.resize(batch_cost(items))
+            # los builds corren en paralelo en el pool: su tiempo no es el de un build en este hilo
+            ticket.built = False
+            resp.call_on_close(ticket.release)
+        streaming = True
+        return _cors(resp)
+    finally:
+        if ticket is not None and not streaming:
+            ticket.built = False
+            ticket.release()
+
+
+@app.route("/api/excel/jobs", methods=["POST", "OPTIONS"])
+def create_excel_job():
+    if request.method == "OPTIONS":
+        return _cors(make_response("", 204))
+
+    try:
+        check_content_length(request.content_length)
+        payload = validate_payload(_to_dict(request_json() or {}))
+    except PayloadError as e:
+        count_error("jobs", e)
+        return _payload_error_response(e)
+    job_id = uuid.uuid4().hex
+    JOB_STORE.create(job_id, {"fileName": _safe_filename(payload.get("fileName") or "AUREA_excel.xlsx")})
+    try:
+        JOB_QUEUE.submit(job_id, payload, JOB_STORE)
+    except JobQueueFull as e:
+        JOB_STORE.update(job_id, status="failed", error=str(e))
+        resp = _cors(jsonify({"ok": False, "error": str(e)}))
+        resp.headers["Retry-After"] = "5"
+        return resp, 503
+
+    resp = _cors(jsonify(_job_json(JOB_STORE.get(job_id))))
+    resp.headers["Location"] = f"/api/excel/jobs/{job_id}"
+    return resp, 202
+
+
+@app.route("/api/excel/jobs/<job_id>", methods=["GET", "OPTIONS"])
+def get_excel_job(job_id):
+    if request.method == "OPTIONS":
+        return _cors(make_response("", 204))
+
+    job = JOB_STORE.get(job_id)
+    if job is None:
+        return _cors(jsonify({"ok": False, "error": "job_not_found"})), 404
+    if job["status"] == "queued" and JOB_QUEUE.is_running(job_id):
+        job["status"] = "running"
+
+    data = JOB_STORE.get_result(job_id) if job["status"] == "done" else None
+    if data is None or request.args.get("format") == "json":
+        return _cors(jsonify(_job_json(job)))
+
+    resp = send_file(
+        BytesIO(data),
+        as_attachment=True,
+        download_name=job["fileName"],
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+    return _cors(resp)
 
 
 # ============================================================
@@ -0,0 +1,242 @@
+"""
+Benchmark de build_excel y de /api/excel/generate (Flask test client, sin red).
+
+Matriz: plantillas (ledger, servicios) x engines x filas, más payloads reales
+(aurea_last_request.json con filas generadas a partir de su spec). Cada caso
+corre en un proceso hijo para que el pico de RSS sea solo suyo.
+
+Por caso se registra: tiempo por fase (normalize, build, route), pico de
+RSS, pico de memoria asignada (tracemalloc) y tamaño del xlsx.
+
+    python bench.py                                  # matriz completa => bench_results.json
+    python bench.py --rows 0,300,5000 --repeat 5
+    python bench.py --save-baseline                  # guarda bench_baseline.json
+    python bench.py --baseline bench_baseline.json   # sale con 1 si hay regresión > --threshold
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROWS = (0, 300, 5_000, 50_000, 200_000)
+SPEC_ROWS = (0, 300, 5_000)
+SERVICES_PROMPT = "Precio fijo por servicios y estudios realizados"
+REAL_PAYLOADS = ("aurea_last_request.json",)
+
+# diferencias absolutas por debajo de esto son ruido (no cuentan como regresión)
+NOISE_FLOOR = {"s": 0.02, "mb": 2.0, "bytes": 512}
+# casos grandes: una sola corrida (200k filas con openpyxl tarda decenas de segundos)
+LARGE_ROWS = 50_000
+
+
+def _matrix(rows, engines) -> list:
+    cases = []
+    for engine in engines:
+        for n in rows:
+            cases.append({"name": f"ledger/{engine}/{n}", "template": "ledger", "engine": engine, "rows": n})
+            cases.append({"name": f"services/{engine}/{n}", "template": "services", "engine": engine, "rows": n})
+    for fname in REAL_PAYLOADS:
+        if os.path.exists(os.path.join(HERE, fname)):
+            for n in SPEC_ROWS:
+                if n <= max(rows):
+                    cases.append({"name": f"spec/{fname}/{n}", "template": "spec", "payload": fname, "rows": n})
+    return cases
+
+
+# ------------------------------------------------------------
+# Proceso hijo: un caso
+# ------------------------------------------------------------
+def _ledger_rows(app, n: int) -> list:
+    cats, pays = app.LEDGER_CATEGORIES, app.LEDGER_PAYMENTS
+    return [
+        {
+            "Fecha": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            "Concepto": f"Movimiento {i}",
+            "Categoría": cats[i % len(cats)],
+            "Forma de pago": pays[i % len(pays)],
+            "Ingreso": f"MXN {(i * 37) % 50000:,}.50" if i % 3 == 0 else "",
+            "Egreso": (i * 53) % 7000 if i % 3 else None,
+        }
+        for i in range(n)
+    ]
+
+
+def _spec_rows(app, spec: dict, n: int) -> list:
+    data = next(s for s in app.compile_spec(spec).sheets if isinstance(s, app.SpecDataSheet))
+    make = {
+        "date": lambda i: f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}",
+        "currency": lambda i: round((i * 37) % 9000 + 0.5, 2),
+        "number": lambda i: (i * 13) % 1000,
+        "integer": lambda i: i % 100,
+        "percent": lambda i: (i % 100) / 100,
+    }
+    cols = [(c.key, make.get(c.type, lambda i: f"{c.header} {i % 50}")) for c in data.columns if not c.computed]
+    return [{key: fn(i) for key, fn in cols} for i in range(n)]
+
+
+def _payload(app, case: dict) -> dict:
+    if case["template"] == "spec":
+        with open(os.path.join(HERE, case["payload"]), encoding="utf-8") as fh:
+            payload = json.load(fh)
+        payload["rows"] = _spec_rows(app, payload["spec"], case["rows"])
+        return payload
+    payload = {"engine": case["engine"], "rows": _ledger_rows(app, case["rows"])}
+    if case["template"] == "services":
+        payload["prompt"] = SERVICES_PROMPT
+    return payload
+
+
+def _rss_mb() -> float:
+    import resource
+    # Linux: KiB; macOS: bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_case(case: dict, repeat: int, alloc: bool) -> dict:
+    os.environ["AUREA_SKELETON_WARMUP"] = "0"
+    os.environ["AUREA_OUTPUT_CACHE_MB"] = "0"  # medir builds, no hits de cache
+    sys.path.insert(0, HERE)
+    import app
+
+    payload = _payload(app, case)
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    client = app.app.test_client()
+
+    # warm-up: skeletons / plantillas XML / plan del spec ya compilados
+    app.build_excel(dict(payload, rows=payload["rows"][:1]))
+    rss_base = _rss_mb()
+
+    phases = {"normalize": [], "build": [], "route": []}
+    size = 0
+    for _ in range(repeat):
+        t = time.perf_counter()
+        if case["template"] == "ledger":
+            for _row in app.normalize_ledger_rows(payload["rows"]):
+                pass
+        phases["normalize"].append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        size = len(app.build_excel(payload).getvalue())
+        phases["build"].append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        resp = client.post("/api/excel/generate", data=body, content_type="application/json")
+        route_bytes = len(resp.get_data())
+        phases["route"].append(time.perf_counter() - t)
+        if resp.status_code != 200 or route_bytes == 0:
+            raise RuntimeError(f"{case['name']}: /api/excel/generate => {resp.status_code}")
+
+    result = {
+        "phases_s": {k: round(min(v), 4) for k, v in phases.items()},
+        "peak_rss_mb": round(_rss_mb(), 1),
+        "rss_growth_mb": round(_rss_mb() - rss_base, 1),
+        "bytes": size,
+    }
+    if alloc:
+        import tracemalloc
+        tracemalloc.start()
+        app.build_excel(payload)
+        result["alloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        tracemalloc.stop()
+    return result
+
+
+# ------------------------------------------------------------
+# Proceso padre: matriz, resultados y comparación con baseline
+# ------------------------------------------------------------
+def _metrics(result: dict) -> dict:
+    """Métricas comparables: nombre => (valor, unidad)."""
+    out = {f"{k}_s": (v, "s") for k, v in result.get("phases_s", {}).items()}
+    out["peak_rss_mb"] = (result.get("peak_rss_mb"), "mb")
+    if "alloc_peak_mb" in result:
+        out["alloc_peak_mb"] = (result["alloc_peak_mb"], "mb")
+    out["bytes"] = (result.get("bytes"), "bytes")
+    return out
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or "error" in result or "error" in base:
+            continue
+        base_metrics = _metrics(base)
+        for metric, (value, unit) in _metrics(result).items():
+            old = base_metrics.get(metric, (None, unit))[0]
+            if value is None or not old:
+                continue
+            if value - old > NOISE_FLOOR[unit] and value > old * (1 + threshold):
+                regressions.append(f"{name} {metric}: {old} -> {value} (+{(value / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", default=",".join(str(n) for n in ROWS), help="filas de la matriz, separadas por coma")
+    ap.add_argument("--engines", default="openpyxl,xml")
+    ap.add_argument("--filter", default="", help="solo casos cuyo nombre contiene este texto")
+    ap.add_argument("--repeat", type=int, default=5, help=f"se reporta el mínimo de N corridas (1 desde {LARGE_ROWS} filas)")
+    ap.add_argument("--no-alloc", action="store_true", help="sin la corrida extra con tracemalloc")
+    ap.add_argument("--out", default=os.path.join(HERE, "bench_results.json"))
+    ap.add_argument("--baseline", default=os.path.join(HERE, "bench_baseline.json"))
+    ap.add_argument("--save-baseline", action="store_true", help="escribe los resultados como baseline")
+    ap.add_argument("--threshold", type=float, default=float(os.getenv("AUREA_BENCH_THRESHOLD", "0.25")),
+                    help="regresión permitida contra el baseline (0.25 = +25%%)")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(json.loads(args.child), args.repeat, not args.no_alloc)))
+        return 0
+
+    rows = [int(n) for n in args.rows.split(",") if n.strip()]
+    cases = [c for c in _matrix(rows, args.engines.split(",")) if args.filter in c["name"]]
+    results = {}
+    for case in cases:
+        repeat = args.repeat if case["rows"] < LARGE_ROWS else 1
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", json.dumps(case), "--repeat", str(repeat)]
+        if args.no_alloc:
+            cmd.append("--no-alloc")
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            results[case["name"]] = {"error": (proc.stderr.strip().splitlines() or ["?"])[-1]}
+            print(f"{case['name']:40s} ERROR {results[case['name']]['error']}")
+            continue
+        result = results[case["name"]] = json.loads(proc.stdout.strip().splitlines()[-1])
+        ph = result["phases_s"]
+        print(f"{case['name']:40s} build {ph['build']:8.3f}s  route {ph['route']:8.3f}s  "
+              f"rss {result['peak_rss_mb']:7.1f}MB  alloc {result.get('alloc_peak_mb', '-')!s:>7}MB  "
+              f"{result['bytes'] / 1024:9.1f}KB")
+
+    report = {
+        "python": sys.version.split()[0],
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2, ensure_ascii=False)
+    print(f"=> {args.out}")
+
+    failed = any("error" in r for r in results.values())
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2, ensure_ascii=False)
+        print(f"baseline => {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh).get("results", {})
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print("REGRESIÓN", r)
+        print(f"{len(regressions)} regresiones (umbral +{args.threshold * 100:.0f}%)")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
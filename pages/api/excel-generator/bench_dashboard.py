@@ -0,0 +1,64 @@
+"""
+Libros de benchmark de recálculo del Dashboard: el mismo ledger generado con
+las fórmulas classic y dynamic (ver DASHBOARD_FORMULAS en app.py).
+
+    python bench_dashboard.py [rows] [carpeta]     # default 50000 filas, ./bench_out
+
+Para medir el recálculo abrir cada libro en Excel 365 y, en la ventana
+Inmediato del editor de VBA (Alt+F11, Ctrl+G):
+
+    t = Timer: Application.CalculateFull: ? Timer - t
+
+El script también reporta cuántas referencias a columnas de tabla evalúa el
+Dashboard de cada modo en un recálculo completo (cada una es un recorrido
+de la columna).
+"""
+import os
+import re
+import sys
+import time
+from io import BytesIO
+
+os.environ.setdefault("AUREA_SKELETON_WARMUP", "0")
+
+from openpyxl import load_workbook
+
+import app
+from bench_normalize import _rows
+
+_COLUMN_REF_RE = re.compile(r"tbl_data(?:_\d+)?\[\[#Data\],\[[^\]]+\]\]")
+
+
+def _column_scans(data: bytes) -> int:
+    ws = load_workbook(BytesIO(data))["Dashboard"]
+    n = 0
+    for row in ws.iter_rows():
+        for cell in row:
+            v = cell.value
+            text = getattr(v, "text", v)
+            if isinstance(text, str) and text.startswith("="):
+                n += len(_COLUMN_REF_RE.findall(text))
+    return n
+
+
+def main() -> int:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    folder = sys.argv[2] if len(sys.argv) > 2 else "bench_out"
+    os.makedirs(folder, exist_ok=True)
+    rows = _rows(n)
+
+    print(f"{n} rows")
+    for mode in app.DASH_FORMULA_MODES:
+        t = time.perf_counter()
+        data = app.build_excel({"rows": rows, "dashboardFormulas": mode, "engine": app.ENGINE_XML}).getvalue()
+        elapsed = time.perf_counter() - t
+        path = os.path.join(folder, f"AUREA_bench_{mode}.xlsx")
+        with open(path, "wb") as fh:
+            fh.write(data)
+        print(f"  {mode:8s} {path}  {len(data) / 1e6:.1f} MB  build {elapsed:.2f}s  "
+              f"columnas recorridas por recálculo: {_column_scans(data)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Benchmark de normalización de rows: el loop por item de antes (alias con
+`or` y _as_number con str.replace por celda) contra normalize_ledger_rows
+(mapeo de alias por bloque + conversión por columna).
+
+    python bench_normalize.py [rows]      # default 100000
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault("AUREA_SKELETON_WARMUP", "0")
+
+import app
+
+
+def _as_number_loop(v):
+    if v is None:
+        return 0.0
+    if isinstance(v, (int, float)):
+        return float(v)
+    s = str(v).strip()
+    if not s:
+        return 0.0
+    s = s.replace("MXN", "").replace("$", "").replace(",", "").strip()
+    try:
+        return float(s)
+    except Exception:
+        return 0.0
+
+
+def _ledger_row_loop(item: dict) -> tuple:
+    return (
+        app._text(item.get("Fecha") or item.get("fecha")),
+        app._text(item.get("Concepto") or item.get("concepto")),
+        app._text(item.get("Categoría") or item.get("categoria") or item.get("category")),
+        app._text(item.get("Forma de pago") or item.get("pago") or item.get("payment")),
+        _as_number_loop(item.get("Ingreso") or item.get("ingreso")),
+        _as_number_loop(item.get("Egreso") or item.get("egreso")),
+    )
+
+
+def _rows(n: int) -> list:
+    cats, pays = app.LEDGER_CATEGORIES, app.LEDGER_PAYMENTS
+    return [
+        {
+            "fecha": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            "concepto": f"Movimiento {i % 500}",
+            "categoria": cats[i % len(cats)],
+            "pago": pays[i % len(pays)],
+            "ingreso": f"MXN {(i * 37) % 50000:,}.50" if i % 3 == 0 else "",
+            "egreso": (i * 53) % 7000 if i % 3 else None,
+        }
+        for i in range(n)
+    ]
+
+
+def _best(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main() -> int:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = _rows(n)
+
+    loop = _best(lambda: [_ledger_row_loop(item) for item in rows if isinstance(item, dict)])
+    cols = _best(lambda: list(app.normalize_ledger_rows(rows)))
+
+    print(f"{n} rows")
+    print(f"  loop por item:  {loop:.3f}s  ({n / loop:,.0f} rows/s)")
+    print(f"  por columnas:   {cols:.3f}s  ({n / cols:,.0f} rows/s)  x{loop / cols:.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Benchmark de arranque en frío: cada medición corre en un proceso nuevo.
+
+  import        import app (Flask + openpyxl + módulo), sin warm-up
+  warm-up       WARMUP_STATE["seconds"] con AUREA_WARMUP=1
+  1er request   primer POST por plantilla (test client), con y sin warm-up
+  gunicorn      (--gunicorn) arranque real con gunicorn.conf.py hasta que
+                /healthz responde 200 y latencia del primer POST, con y sin preload
+
+    python bench_startup.py [--repeat 5] [--gunicorn]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PAYLOADS = {
+    "ledger": {"rows": [{"Fecha": "2024-01-01", "Concepto": "x", "Ingreso": 10}]},
+    "services": {"prompt": "Precio fijo por servicios y estudios realizados"},
+    "spec": {"spec": {"sheets": [{"name": "AUREA", "kind": "data"}, {"name": "Dashboard", "kind": "dashboard"}]},
+             "rows": [{"fecha": "2024-01-01", "concepto": "x"}]},
+}
+
+_CHILD = """
+import json, sys, time
+t = time.perf_counter()
+import app
+out = {"import_s": time.perf_counter() - t, "warmup_s": app.WARMUP_STATE["seconds"]}
+client = app.app.test_client()
+template = sys.argv[1]
+t = time.perf_counter()
+resp = client.post("/api/excel/generate", json=json.loads(sys.argv[2]))
+out["first_request_s"] = time.perf_counter() - t
+out["status"] = resp.status_code
+print(json.dumps(out))
+"""
+
+
+def _child(template: str, warmup: bool) -> dict:
+    env = dict(os.environ, AUREA_WARMUP="1" if warmup else "0", AUREA_SKELETON_WARMUP="1" if warmup else "0")
+    proc = subprocess.run(
+        [sys.executable, "-c", _CHILD, template, json.dumps(PAYLOADS[template])],
+        cwd=HERE, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _gunicorn(preload: bool) -> dict:
+    port = _free_port()
+    env = dict(os.environ, PORT=str(port), AUREA_PRELOAD="1" if preload else "0")
+    t = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        base = f"http://127.0.0.1:{port}"
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError("gunicorn terminó antes de estar listo")
+            try:
+                with urllib.request.urlopen(base + "/healthz", timeout=5) as r:
+                    if r.status == 200:
+                        break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        ready = time.perf_counter() - t
+        req = urllib.request.Request(base + "/api/excel/generate", data=json.dumps(PAYLOADS["ledger"]).encode(),
+                                     headers={"Content-Type": "application/json"})
+        t = time.perf_counter()
+        with urllib.request.urlopen(req, timeout=30) as r:
+            r.read()
+        return {"ready_s": ready, "first_request_s": time.perf_counter() - t}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _fmt(values: list) -> str:
+    return f"min {min(values) * 1000:7.1f} ms  mediana {statistics.median(values) * 1000:7.1f} ms"
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--gunicorn", action="store_true", help="también mide el arranque real con gunicorn")
+    args = ap.parse_args()
+
+    for warmup in (False, True):
+        label = "con warm-up" if warmup else "sin warm-up"
+        for template in PAYLOADS:
+            runs = [_child(template, warmup) for _ in range(args.repeat)]
+            if template == "ledger":
+                print(f"{label}: import           {_fmt([r['import_s'] for r in runs])}")
+                if warmup:
+                    print(f"{label}:   (warm-up)      {_fmt([r['warmup_s'] for r in runs])}")
+            print(f"{label}: 1er {template:12s} {_fmt([r['first_request_s'] for r in runs])}")
+
+    if args.gunicorn:
+        for preload in (False, True):
+            runs = [_gunicorn(preload) for _ in range(args.repeat)]
+            label = "preload" if preload else "sin preload"
+            print(f"gunicorn {label:11s} listo     {_fmt([r['ready_s'] for r in runs])}")
+            print(f"gunicorn {label:11s} 1er POST  {_fmt([r['first_request_s'] for r in runs])}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
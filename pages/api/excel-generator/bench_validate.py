@@ -0,0 +1,79 @@
+"""
+Benchmark de validación del payload: cuánto cuesta rechazar un payload malo
+(validate_payload y el request completo a /api/excel/generate, que devuelve
+400/413) contra el build del mismo payload ya corregido.
+
+    python bench_validate.py [rows]      # default 100000
+"""
+import json
+import os
+import sys
+
+os.environ.setdefault("AUREA_SKELETON_WARMUP", "0")
+os.environ.setdefault("AUREA_WARMUP", "0")
+os.environ.setdefault("AUREA_OUTPUT_CACHE_MB", "0")
+
+import app
+from bench_normalize import _rows, _best
+
+
+def _cases(n: int) -> dict:
+    rows = _rows(n)
+    return {
+        "fila 0 no es objeto": {"rows": ["x"] + rows[1:]},
+        "última fila no es objeto": {"rows": rows[:-1] + [["x"]]},
+        "texto > tope de celda": {"rows": [dict(rows[0], concepto="x" * (app.PAYLOAD_MAX_STRING + 1))] + rows[1:]},
+        "demasiadas filas": {"rows": rows, "_max_rows": n - 1},
+        "body > tope (413 sin parsear)": {"rows": rows, "_max_bytes": 1024},
+        "fileName no es texto": {"rows": rows, "fileName": {"a": 1}},
+    }
+
+
+def _us(s: float) -> str:
+    return f"{s * 1e6:12,.0f} us"
+
+
+def main() -> int:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    client = app.app.test_client()
+    valid = {"rows": _rows(n)}
+
+    check = _best(lambda: app.validate_payload(valid))
+    build = _best(lambda: app.build_excel(valid), repeat=1)
+    print(f"{n} rows")
+    print(f"  validar payload válido:         {_us(check)}")
+    print(f"  build_excel:                    {_us(build)}")
+
+    max_rows = app.PAYLOAD_SCHEMA["properties"]["rows"]["maxItems"]
+    max_bytes = app.PAYLOAD_MAX_BYTES
+    for name, payload in _cases(n).items():
+        app.PAYLOAD_MAX_BYTES = payload.pop("_max_bytes", max_bytes)
+        app.PAYLOAD_SCHEMA["properties"]["rows"]["maxItems"] = payload.pop("_max_rows", max_rows)
+        app._PAYLOAD_CHECK = app.compile_schema(app.PAYLOAD_SCHEMA)
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+        def reject():
+            try:
+                app.check_content_length(len(body))
+                app.validate_payload(payload)
+            except app.PayloadError:
+                return
+            raise RuntimeError(f"{name}: el payload pasó la validación")
+
+        def route():
+            resp = client.post("/api/excel/generate", data=body, content_type="application/json")
+            if resp.status_code not in (400, 413):
+                raise RuntimeError(f"{name}: /api/excel/generate => {resp.status_code}")
+
+        t_reject, t_route = _best(reject), _best(route)
+        print(f"  {name:30s} rechazo {_us(t_reject)}  request {_us(t_route)}  "
+              f"(build x{build / t_route:,.0f})")
+
+    app.PAYLOAD_MAX_BYTES = max_bytes
+    app.PAYLOAD_SCHEMA["properties"]["rows"]["maxItems"] = max_rows
+    app._PAYLOAD_CHECK = app.compile_schema(app.PAYLOAD_SCHEMA)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+Prueba diferencial de engines: genera los mismos payloads con el engine
+openpyxl y con el engine XML, abre ambos xlsx con openpyxl y compara
+valores, fórmulas, estilos, tablas, validaciones, formato condicional, charts
+y los resultados cacheados del Dashboard.
+
+    python engine_diff.py          # sale con código 1 si hay diferencias
+"""
+import os
+import sys
+from copy import copy
+
+os.environ.setdefault("AUREA_SKELETON_WARMUP", "0")
+
+from openpyxl import load_workbook
+from openpyxl.worksheet.formula import ArrayFormula
+
+import app
+
+
+STYLE_ATTRS = ("font", "fill", "border", "alignment", "number_format")
+
+
+def _style(obj) -> tuple:
+    # copy() desenvuelve los StyleProxy de openpyxl (dos proxies nunca son ==)
+    return tuple(copy(getattr(obj, attr)) for attr in STYLE_ATTRS)
+
+
+def _describe(a, b) -> str:
+    if a is None or b is None:
+        return f"{a!r} != {b!r}"
+    if a[0] != b[0]:
+        return f"valor {a[0]!r} != {b[0]!r}"
+    return ", ".join(f"{attr} {x!r} != {y!r}" for attr, x, y in zip(STYLE_ATTRS, a[1:], b[1:]) if x != y)
+
+
+def _sheet_signature(ws) -> dict:
+    cells = {}
+    for cell in ws._cells.values():
+        value = cell.value
+        if isinstance(value, ArrayFormula):
+            value = (value.ref, value.text)
+        cells[cell.coordinate] = (value,) + _style(cell)
+    return {
+        "state": ws.sheet_state,
+        "freeze": ws.freeze_panes,
+        "merged": sorted(str(r) for r in ws.merged_cells.ranges),
+        "columns": {
+            key: (dim.width,) + _style(dim)
+            for key, dim in ws.column_dimensions.items() if dim.width or dim.has_style
+        },
+        "cells": cells,
+        "tables": sorted(
+            (t.name, t.displayName, t.ref, t.headerRowCount, t.totalsRowCount,
+             tuple((c.name, c.totalsRowFunction) for c in t.tableColumns),
+             (t.tableStyleInfo.name, t.tableStyleInfo.showRowStripes, t.tableStyleInfo.showColumnStripes))
+            for t in ws.tables.values()
+        ),
+        "validations": sorted(
+            (str(dv.sqref), dv.type, dv.formula1, dv.allow_blank, dv.prompt, dv.error)
+            for dv in ws.data_validations.dataValidation
+        ),
+        "conditional": sorted(
+            (str(cf.sqref), tuple((r.type, tuple(r.formula), r.priority, r.dxf.fill if r.dxf else None) for r in cf.rules))
+            for cf in ws.conditional_formatting
+        ),
+        "charts": [
+            (type(ch).__name__, ch.anchor._from.col, ch.anchor._from.row,
+             tuple((s.tx.strRef.f if s.tx and s.tx.strRef else None,
+                    s.cat.numRef.f if s.cat and s.cat.numRef else None,
+                    s.val.numRef.f if s.val and s.val.numRef else None) for s in ch.series))
+            for ch in ws._charts
+        ],
+    }
+
+
+def _diff(case: str, payload: dict) -> list:
+    books, cached = {}, {}
+    for engine in app.EXCEL_ENGINES:
+        bio = app.build_excel(dict(payload, engine=engine))
+        books[engine] = load_workbook(bio)
+        bio.seek(0)
+        # resultados cacheados (<v>) de las fórmulas del Dashboard
+        values = load_workbook(bio, data_only=True)
+        cached[engine] = {
+            c.coordinate: c.value for row in values["Dashboard"].iter_rows() for c in row
+        } if "Dashboard" in values.sheetnames else {}
+    a, b = books[app.ENGINE_OPENPYXL], books[app.ENGINE_XML]
+
+    errors = []
+    ca, cb = cached[app.ENGINE_OPENPYXL], cached[app.ENGINE_XML]
+    for coord in sorted(set(ca) | set(cb)):
+        if ca.get(coord) != cb.get(coord):
+            errors.append(f"{case}: Dashboard!{coord} cacheado {ca.get(coord)!r} != {cb.get(coord)!r}")
+    if a.sheetnames != b.sheetnames:
+        return [f"{case}: hojas {a.sheetnames} != {b.sheetnames}"]
+    for title in a.sheetnames:
+        sa, sb = _sheet_signature(a[title]), _sheet_signature(b[title])
+        # el timestamp (B2) cambia entre llamadas
+        for sig in (sa, sb):
+            for coord in list(sig["cells"]):
+                if coord == "B2" and title.startswith("AUREA"):
+                    sig["cells"][coord] = sig["cells"][coord][1:]
+        for key in sa:
+            if key == "cells":
+                for coord in sorted(set(sa["cells"]) | set(sb["cells"])):
+                    if sa["cells"].get(coord) != sb["cells"].get(coord):
+                        errors.append(f"{case}: {title}!{coord} {_describe(sa['cells'].get(coord), sb['cells'].get(coord))}")
+            elif sa[key] != sb[key]:
+                errors.append(f"{case}: {title} {key} {sa[key]!r} != {sb[key]!r}")
+    return errors
+
+
+def _rows(n: int) -> list:
+    cats, pays = app.LEDGER_CATEGORIES, app.LEDGER_PAYMENTS
+    return [
+        {
+            "Fecha": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            "Concepto": f"Concepto {i}",
+            "Categoría": cats[i % len(cats)],
+            "Forma de pago": pays[i % len(pays)],
+            "Ingreso": (i * 37) % 5000 if i % 3 == 0 else "",
+            "Egreso": f"MXN {(i * 53) % 7000:,}.50" if i % 3 else None,
+        }
+        for i in range(n)
+    ]
+
+
+def _custom_rows(n: int) -> list:
+    # categorías / pagos fuera de los defaults (con comillas, mayúsculas distintas y un comodín que no entra a _lists)
+    cats = ["Renta", "salud", 'Proveedor "A"', "Nómina", "Otros*", None]
+    pays = ["Cheque", "efectivo", "Vales", ""]
+    return [dict(row, **{"Categoría": cats[i % len(cats)], "Forma de pago": pays[i % len(pays)]})
+            for i, row in enumerate(_rows(n))]
+
+
+CASES = {
+    "vacío": {"rows": []},
+    "alias y tipos": {"rows": [
+        {"fecha": "2024-01-01", "concepto": "  espacios  ", "categoria": "Salud", "pago": "Efectivo", "ingreso": "1,200.50"},
+        {"Concepto": "=1+1", "category": "<&>", "payment": "#N/A", "egreso": 10},
+        {"Concepto": "control\x01char", "Ingreso": True},
+        "no-dict",
+    ]},
+    "capacidad": {"rows": _rows(1200)},
+    "streaming": {"rows": _rows(app.STREAM_ROW_THRESHOLD + 1)},
+    "servicios": {"prompt": "Precio fijo por servicios y estudios realizados"},
+    "fórmulas dynamic": {"rows": _rows(300), "dashboardFormulas": "dynamic"},
+    "fórmulas dynamic streaming": {"rows": _rows(app.STREAM_ROW_THRESHOLD + 1), "dashboardFormulas": "dynamic"},
+    "listas de los rows": {"rows": _custom_rows(300)},
+    "listas de los rows dynamic streaming": {"rows": _custom_rows(app.STREAM_ROW_THRESHOLD + 1), "dashboardFormulas": "dynamic"},
+}
+
+
+def main() -> int:
+    errors = []
+    for case, payload in CASES.items():
+        errors += _diff(case, payload)
+
+    # hojas de continuación (tbl_data_2, VSTACK en Dashboard) con un tope chico
+    per_sheet = app.STREAM_ROWS_PER_SHEET
+    app.STREAM_ROWS_PER_SHEET = 2500
+    try:
+        errors += _diff("continuación", {"rows": _rows(app.STREAM_ROW_THRESHOLD + 1)})
+    finally:
+        app.STREAM_ROWS_PER_SHEET = per_sheet
+
+    for e in errors[:50]:
+        print(e)
+    print(f"{len(CASES) + 1} casos, {len(errors)} diferencias")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
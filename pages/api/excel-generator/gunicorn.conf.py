@@ -0,0 +1,27 @@
+"""
+Config de gunicorn para el generador (gunicorn -c gunicorn.conf.py app:app).
+
+preload_app: el master importa app.py (Flask, openpyxl) y corre el warm-up
+UNA vez antes de hacer fork => cada worker nace con módulos, skeletons y
+plantillas XML listos, compartidos copy-on-write. gc.freeze() saca esos
+objetos del GC para que las pasadas del recolector no toquen (y copien)
+sus páginas en los workers.
+
+threads > 1 => gthread: admission control (app.py) deja al menos un hilo sin
+builds, así /healthz y los 429 se responden aunque el worker esté ocupado.
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("AUREA_THREADS", "4"))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.getenv("AUREA_TIMEOUT", "30"))
+preload_app = os.getenv("AUREA_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    # master con la app ya cargada (preload), antes del fork de los workers
+    if preload_app:
+        gc.freeze()